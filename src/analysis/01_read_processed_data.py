@@ -46,9 +46,11 @@ import pandas as pd
 
 SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(SRC_DIR)
+sys.path.append(os.path.join(SRC_DIR, 'processing'))
 from config_common import processed_data_dir, user, host
-from config_eeg import thin_bands, wide_bands, select_task_segments, channels
+from config_eeg import fname, thin_bands, wide_bands, select_task_segments, channels
 from pickle_data_handler import PickleDataHandler
+import psds_io
 
 
 def initialize_argparser_and_metadata():
@@ -60,24 +62,38 @@ def initialize_argparser_and_metadata():
     #parser.add_argument('--threads', type=int, help="Number of threads, using multiprocessing", default=1) 
     args = parser.parse_args()
 
+    print('######## \nINFO: Starting to run 01_read_processed_data.py')
+    metadata = create_metadata(args.task, args.freq_band_type, args.not_normalized)
+    return metadata, args
+
+def create_metadata(task, freq_band_type, not_normalized):
+    """
+    Create the metadata dictionary describing the data that is read in.
+
+    Arguments
+    ---------
+    - task: str
+            Each of the four tasks: 'ec', 'eo', 'PASAT_1' or 'PASAT_2'
+    - freq_band_type: str
+            Frequency bins, 'thin' or 'wide'
+    - not_normalized: boolean
+            If True, normalization of the PSD data for all channels will not be performed
+
+    Returns
+    -------
+    - metadata: dict
+            The arguments. The number of segments in the task is added when the data is read in.
+    """
     # Create dictonary with metadata information
     # NOTE: It is important that it is CREATED here and not that stuff gets appended
-    metadata = {"task": args.task, "freq_band_type": args.freq_band_type, "normalization": not args.not_normalized}
-    # Define the number of segments per task
-    if metadata["task"] in ('eo', 'ec'):
-        segments = 3
-    elif metadata["task"] in ('PASAT_1', 'PASAT_2'):
-        segments = 2
-    metadata["segments"] = segments
-
-    print('######## \nINFO: Starting to run 01_read_processed_data.py')
+    metadata = {"task": task, "freq_band_type": freq_band_type, "normalization": not not_normalized}
 
     # Print out the chosen configuration
-    if args.not_normalized:
-        print(f"INFO: Reading in data from task {args.task}, using {args.freq_band_type} frequency bands. Data **will NOT** be normalized.")
+    if not_normalized:
+        print(f"INFO: Reading in data from task {task}, using {freq_band_type} frequency bands. Data **will NOT** be normalized.")
     else:
-        print(f"INFO: Reading in data from task '{args.task}', using '{args.freq_band_type}' frequency bands. Data **will** be normalized.")
-    return metadata, args
+        print(f"INFO: Reading in data from task '{task}', using '{freq_band_type}' frequency bands. Data **will** be normalized.")
+    return metadata
 
 def read_subjects():
     """
@@ -108,6 +124,37 @@ def read_subjects():
 
     return subjects
 
+def read_segment_index(subjects, processed_data_dir=processed_data_dir):
+    """
+    Read which segments the PSDs (and so the bandpowers) of the subjects were computed for, from the index stored in their PSD files
+
+    Arguments
+    ---------
+    - subjects: list of str
+            The subjects, e.g. as returned by read_subjects()
+    - processed_data_dir: str
+            path to the processed data directory as defined in config_common
+
+    Returns
+    -------
+    - segments: dict
+            The segments that all the subjects have, by segment name, see read_index() in processing/psds_io.py
+
+    """
+    indexes = []
+    for subject in subjects:
+        indexes.append(psds_io.read_index(fname.psds(subject=subject, ses='01', processed_data_dir=processed_data_dir)))
+    if not indexes:
+        return dict()
+
+    # Only the segments of all the subjects fill the subjects x segments table
+    segments = {name: segment for name, segment in indexes[0].items()
+                if all(name in index for index in indexes)}
+    left_out = sorted({name for index in indexes for name in index} - set(segments))
+    if left_out:
+        print(f'WARNING: Segments {left_out} are missing for some subjects and are left out.')
+    return segments
+
 def create_subjects_and_tasks(chosen_tasks, subjects):
 
     """
@@ -149,14 +196,35 @@ def read_data(subjects_and_tasks, freq_band_type, not_normalized, processed_data
     - all_bands_vector: list of np arrays
             Each row contains the PSD data (for the chosen frquency bands and for all channels) per subject_and_tasks
     """
+    all_bands_arrays = read_band_arrays(subjects_and_tasks, freq_band_type, processed_data_dir)
+    return create_band_vectors(subjects_and_tasks, all_bands_arrays, freq_band_type, not_normalized)
+
+def read_band_arrays(subjects_and_tasks, freq_band_type, processed_data_dir):
+    """
+    Read in processed bandpower data for each subject_and_tasks from files, without normalizing it
+
+    Arguments
+    ---------
+    - subjects_and_tasks: list of 2-uples
+            Contains the combinations of subjects and segments (e.g., (Subject1, Task1_segment1), (Subject1, Task1_segment2), ...)
+    - freq_band_type: str
+            Frequency bins, 'thin' or 'wide'
+    - processed_data_dir: str
+            path to the processed data directory as defined in config_common
+
+    Returns
+    -----
+    - all_bands_arrays: list of np arrays
+            The bandpowers (frequency bands x channels) per subject_and_tasks
+    """
     # Initialize a list to store processed data for each unique subject+segment combination
-    all_bands_vectors = []
+    all_bands_arrays = []
     if freq_band_type == 'thin':
         freqs = thin_bands
     if freq_band_type == 'wide':
         freqs = wide_bands
 
-    # Iterate over all combinations of (subject, subtask) and populate 'all_bands_vectors' with numpy array 'sub_bands_array' containing processed data for each subject_and_tasks
+    # Iterate over all combinations of (subject, subtask) and populate 'all_bands_arrays' with numpy array 'sub_bands_array' containing processed data for each subject_and_tasks
     for pair in subjects_and_tasks:
         # Construct the path pointing to where processed data for (subject,task) is stored
         subject, task = pair[0].rstrip(), pair[1]
@@ -181,7 +249,38 @@ def read_data(subjects_and_tasks, freq_band_type, not_normalized, processed_data
             subject_and_task_bands_array = np.array(subject_and_task_bands_list[:len(freqs)])
         else:
             subject_and_task_bands_array = np.array(subject_and_task_bands_list)
+        all_bands_arrays.append(subject_and_task_bands_array)
+
+    return all_bands_arrays
+
+def create_band_vectors(subjects_and_tasks, all_bands_arrays, freq_band_type, not_normalized):
+    """
+    Normalize (if needed) and flatten the bandpower data of each subject_and_tasks
+
+    Arguments
+    ---------
+    - subjects_and_tasks: list of 2-uples
+            Contains the combinations of subjects and segments (e.g., (Subject1, Task1_segment1), (Subject1, Task1_segment2), ...)
+    - all_bands_arrays: list of np arrays
+            The bandpowers per subject_and_tasks, as returned by read_band_arrays(). They are not modified.
+    - freq_band_type: str
+            Frequency bins, 'thin' or 'wide'
+    - not_normalized: boolean
+            If True, normalization of the PSD data for all channels will not be performed
 
+    Returns
+    -----
+    - all_bands_vector: list of np arrays
+            Each row contains the PSD data (for the chosen frquency bands and for all channels) per subject_and_tasks
+    """
+    all_bands_vectors = []
+    if freq_band_type == 'thin':
+        freqs = thin_bands
+    if freq_band_type == 'wide':
+        freqs = wide_bands
+
+    for (subject, _), subject_and_task_bands_array in zip(subjects_and_tasks, all_bands_arrays):
+        subject = subject.rstrip()
         # Normalize each band
         if not not_normalized:
             ch_tot_powers = np.sum(subject_and_task_bands_array, axis=0)
@@ -238,6 +337,87 @@ def create_data_frame(subjects_and_tasks, all_bands_vectors):
 
     return dataframe
 
+def add_dataset_info(metadata, processed_data_dir=processed_data_dir):
+    """Add information about the dataset and the user to metadata."""
+    if "k22" in processed_data_dir:
+        metadata["dataset"] = "k22"
+    metadata["user"] = f'{user}@{host}'
+    metadata["license"] = "MIT License"
+    return metadata
+
+def read_processed_data_variants(task, freq_band_type, subjects, processed_data_dir=processed_data_dir):
+    """
+    Read in the processed data of all subjects for one task once, and create both the
+    normalized and the not normalized dataframes from it.
+
+    Arguments
+    ---------
+    - task: str
+            Each of the four tasks: 'ec', 'eo', 'PASAT_1' or 'PASAT_2'
+    - freq_band_type: str
+            Frequency bins, 'thin' or 'wide'
+    - subjects: list of str
+            The subjects to read in, e.g. as returned by read_subjects()
+    - processed_data_dir: str
+            path to the processed data directory as defined in config_common
+
+    Returns
+    -------
+    - variants: dict
+            For not_normalized False and True, the (dataframe, metadata) pair, as returned by run_read_processed_data()
+    """
+    chosen_tasks = select_task_segments(task, read_segment_index(subjects, processed_data_dir))
+    subjects_and_tasks = create_subjects_and_tasks(chosen_tasks, subjects)
+    all_bands_arrays = read_band_arrays(subjects_and_tasks, freq_band_type, processed_data_dir)
+
+    variants = dict()
+    for not_normalized in (False, True):
+        metadata = create_metadata(task, freq_band_type, not_normalized)
+        metadata["segments"] = len(chosen_tasks)
+        all_bands_vectors = create_band_vectors(subjects_and_tasks, all_bands_arrays, freq_band_type, not_normalized)
+        dataframe = create_data_frame(subjects_and_tasks, all_bands_vectors)
+        variants[not_normalized] = (dataframe, add_dataset_info(metadata, processed_data_dir))
+    return variants
+
+def run_read_processed_data(task, freq_band_type, not_normalized, subjects, processed_data_dir=processed_data_dir, metadata=None):
+    """
+    Read in the processed data of all subjects for one task into a dataframe.
+    Importable equivalent of running this script.
+
+    Arguments
+    ---------
+    - task: str
+            Each of the four tasks: 'ec', 'eo', 'PASAT_1' or 'PASAT_2'
+    - freq_band_type: str
+            Frequency bins, 'thin' or 'wide'
+    - not_normalized: boolean
+            If True, normalization of the PSD data for all channels will not be performed
+    - subjects: list of str
+            The subjects to read in, e.g. as returned by read_subjects()
+    - processed_data_dir: str
+            path to the processed data directory as defined in config_common
+    - metadata: dict | None
+            Metadata to add the information to. If None, it is created with create_metadata()
+
+    Returns
+    -------
+    - dataframe: panda dataframe
+            The data, see create_data_frame()
+    - metadata: dict
+            The information about the arguments used, and the number of segments in the task
+    """
+    if metadata is None:
+        metadata = create_metadata(task, freq_band_type, not_normalized)
+    chosen_tasks = select_task_segments(task, read_segment_index(subjects, processed_data_dir))
+    metadata["segments"] = len(chosen_tasks)
+    subjects_and_tasks = create_subjects_and_tasks(chosen_tasks, subjects)
+    all_bands_vectors = read_data(subjects_and_tasks, freq_band_type, not_normalized, processed_data_dir)
+    dataframe = create_data_frame(subjects_and_tasks, all_bands_vectors)
+
+    # Add info to metadata
+    metadata = add_dataset_info(metadata, processed_data_dir)
+    return dataframe, metadata
+
 
 if __name__ == '__main__':
 
@@ -247,28 +427,13 @@ if __name__ == '__main__':
     # 1 - Initialize command line arguments and save arguments to metadata
     metadata, args = initialize_argparser_and_metadata()
 
-    # 2 - Define subtasks according to input arguments
-    chosen_tasks = select_task_segments(args.task)
-
-    # 3 - Read in the list of subjects from file subjects.txt
+    # 2 - Read in the list of subjects from file subjects.txt
     subjects = read_subjects()
 
-    # 4 - Read in list of subjects from file and create subjects_and_tasks list
-    subjects_and_tasks = create_subjects_and_tasks(chosen_tasks, subjects)
-
-    # 5 - Create list: each row contains all frequency bands and all channels per subject_and_task
-    all_bands_vectors = read_data(subjects_and_tasks, args.freq_band_type, args.not_normalized, processed_data_dir)
-
-    # 6 - Create dataframe
-    dataframe = create_data_frame(subjects_and_tasks, all_bands_vectors)
-
-    # 7 - Add info to metadata
-    if "k22" in processed_data_dir:
-        metadata["dataset"] = "k22"
-    metadata["user"] = f'{user}@{host}'
-    metadata["license"] = "MIT License"
+    # 3 - Read in the data of all subjects_and_tasks into a dataframe and add info to metadata
+    dataframe, metadata = run_read_processed_data(args.task, args.freq_band_type, args.not_normalized, subjects, metadata=metadata)
 
-    # 8 - Outputs the pickle object composed by the dataframe file and metadata to be used by 02_plot_processed_data.py and 03_fit_classifier_and_plot.py
+    # 4 - Outputs the pickle object composed by the dataframe file and metadata to be used by 02_plot_processed_data.py and 03_fit_classifier_and_plot.py
     handler = PickleDataHandler()
     handler.export_data(dataframe=dataframe, metadata=metadata)
 
@@ -59,11 +59,14 @@ def initialize_argparser(metadata):
     #parser.add_argument('--threads', type=int, help="Number of threads, using multiprocessing", default=1) #skipped for now
     args = parser.parse_args()
 
-    # Add the input arguments to the metadata dictionary
-    metadata["control_plot_segment"] = args.control_plot_segment
+    return add_arguments_to_metadata(metadata, args.control_plot_segment, args.roi)
+
+def add_arguments_to_metadata(metadata, control_plot_segment=1, roi='All'):
+    """ Add the plotting arguments to metadata."""
+    metadata["control_plot_segment"] = control_plot_segment
     if metadata["control_plot_segment"] > metadata["segments"]:
         raise IndexError(f'List index out of range. The segment you chose is not allowed for task {metadata["task"]}. Please choose a value between 1 and {metadata["segments"]}.')
-    metadata["roi"] = args.roi
+    metadata["roi"] = roi
     return metadata
 
 def define_freq_bands(metadata):
@@ -115,7 +118,7 @@ def create_df_for_plotting(df, metadata, freqs, global_averages):
 
     return plot_df
 
-def plot_control_figures(plot_df, metadata):
+def plot_control_figures(plot_df, metadata, freqs):
     '''
     Plot a figure with two subplots: one with individual patients and another with group means and SD
     '''
@@ -176,6 +179,34 @@ def save_fig(metadata):
     print(f'INFO: Figure "{fig_filename}" has been saved to folder {figures_dir}')
     return metadata
 
+def run_plot_processed_data(dataframe, metadata, control_plot_segment=1, roi='All'):
+    """
+    Plot the control figure of the data and save it to disk.
+    Importable equivalent of running this script.
+
+    Arguments
+    ---------
+    - dataframe: panda dataframe
+            The data, as created by 01_read_processed_data.py
+    - metadata: dict
+            The information about the arguments used so far
+    - control_plot_segment: int
+            Which of the segments from the task will be used for plotting
+    - roi: str
+            Region Of Interest to be plotted
+
+    Returns
+    -------
+    - metadata: dict
+            The metadata, with the plotting information added
+    """
+    metadata = add_arguments_to_metadata(metadata, control_plot_segment, roi)
+    freqs = define_freq_bands(metadata)
+    global_averages = global_averaging(dataframe, metadata, freqs)
+    plot_df = create_df_for_plotting(dataframe, metadata, freqs, global_averages)
+    plot_control_figures(plot_df, metadata, freqs)
+    return save_fig(metadata)
+
 
 if __name__ == '__main__':
 
@@ -200,7 +231,7 @@ if __name__ == '__main__':
     plot_df = create_df_for_plotting(dataframe, metadata, freqs, global_averages)
 
     # 6 - Plot control plot
-    plot_control_figures(plot_df, metadata)
+    plot_control_figures(plot_df, metadata, freqs)
 
     # 7 - Save active figure and add information to metadata
     metadata = save_fig(metadata)
@@ -77,35 +77,60 @@ from pickle_data_handler import PickleDataHandler
 if not os.path.isdir(figures_dir):
     os.makedirs(figures_dir)
 
+# Define scaling methods and classifiers
+scaling_methods = {
+    'StandardScaler': StandardScaler,
+    'MinMaxScaler': MinMaxScaler,
+    'RobustScaler': RobustScaler,
+}
+
+def create_classifiers(seed=seed):
+    """Create the four classifiers that are fitted, as (name, classifier) pairs"""
+    classifiers = [
+        ('Support Vector Machine', SVC(kernel='rbf', probability=True, random_state=seed)),
+        ('Logistic Regression', LogisticRegression(penalty='l1', solver='liblinear', random_state=seed)),
+        ('Random Forest', RandomForestClassifier(random_state=seed)),
+        ('Linear Discriminant Analysis', LinearDiscriminantAnalysis(solver='svd'))
+    ]
+    return classifiers
+
 def initialize_argparser(metadata):
     """ Initialize argparser and add args to metadata."""
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbosity', action='store_true', help='Define the verbosity of the output. Default: False', default=False)
     parser.add_argument('-s', '--seed', type=int, help=f'Seed value used for CV splits, and for classifiers and for CV splits. Default: {seed}', metavar='int', default=seed) # Note: different sklearn versions could yield different results 
     parser.add_argument('--scaling', action='store_true', help='Scaling of data before fitting. Can only be used if data is not normalized. Default: False', default=False)
-    parser.add_argument('--scaling_method', choices=scaling_methods, help='Method for scaling data, choose from the options. Default: RobustScaler', default=scaling_methods[2]) 
+    parser.add_argument('--scaling_method', choices=list(scaling_methods), help='Method for scaling data, choose from the options. Default: RobustScaler', default='RobustScaler')
     parser.add_argument('--one_segment_per_task', action='store_true',  help='Utilizes only one of the segments from the tasks. Default: False', default=False)
     parser.add_argument('--which_segment', type=int, help='Define which number of segment to use: 1, 2, etc. Default is 1', metavar='', default=1)
     parser.add_argument('--display_fig', action='store_true', help='Displays the figure. Default: False', default=False)
     parser.add_argument('--dont_save_fig', action='store_true', help='Saves figure to disk. Default: True', default=False)
     #parser.add_argument('--threads', type=int, help="Number of threads, using multiprocessing", default=1) #skipped for now
     args = parser.parse_args()
-    
-    # Add the input arguments to the metadata dictionary
+
+    metadata = add_arguments_to_metadata(metadata, verbosity=args.verbosity, scaling=args.scaling,
+                                         scaling_method=args.scaling_method,
+                                         one_segment_per_task=args.one_segment_per_task,
+                                         which_segment=args.which_segment, display_fig=args.display_fig)
+    return metadata, args
+
+def add_arguments_to_metadata(metadata, verbosity=False, scaling=False, scaling_method='RobustScaler',
+                              one_segment_per_task=False, which_segment=1, display_fig=False):
+    """ Add the classification arguments to metadata."""
     metadata["folds"] = folds
     metadata["seed"] = seed
-    metadata["verbosity"] = args.verbosity
-    if args.scaling and metadata["normalization"]:
+    metadata["verbosity"] = verbosity
+    if scaling and metadata["normalization"]:
         raise TypeError("You are trying to scale data that has been already normalized.")
-    metadata["scaling"] = args.scaling
-    metadata["scaling_method"] = args.scaling_method
-    metadata["one_segment_per_task"] = args.one_segment_per_task
-    metadata["which_segment"] = args.which_segment
-    if  args.one_segment_per_task and (args.which_segment > metadata["segments"]):
+    metadata["scaling"] = scaling
+    metadata["scaling_method"] = scaling_methods[scaling_method]()
+    metadata["one_segment_per_task"] = one_segment_per_task
+    metadata["which_segment"] = which_segment
+    if  one_segment_per_task and (which_segment > metadata["segments"]):
         raise TypeError(f'The segment you chose is larger than the number of available segments for task {metadata["task"]}. Please choose a value between 1 and {metadata["segments"]}.')
-    metadata["display_fig"] = args.display_fig
+    metadata["display_fig"] = display_fig
 
-    return metadata, args
+    return metadata
 
 def initialize_cv(dataframe, metadata):
     """Initialize Cross Validation and gets data splits as a list """
@@ -168,7 +193,7 @@ def initialize_subplots(metadata):
         print('INFO: Figure will not be displayed.')
     return fig_roc, axs, metadata
 
-def perform_data_split(X, y, split, train_index, test_index):
+def perform_data_split(X, y, split, train_index, test_index, metadata):
     """Splits X and y data into training and testing according to the data split indexes"""
     skip_split = False
     # Generate train and test sets for this split
@@ -295,7 +320,7 @@ def fit_and_plot(X, y, classifiers, data_split, metadata):
         for split, (train_index, test_index) in enumerate(data_split):
             # Submethod 4.2 - Slice the X and y data according to CV's data_split
             X_train, X_test, y_train, y_test, skip_split = \
-                perform_data_split(X, y, split, train_index, test_index)
+                perform_data_split(X, y, split, train_index, test_index, metadata)
             # Skip this split if class balance is bad
             if skip_split:
                 continue
@@ -393,7 +418,7 @@ def plot_boxplot(metadata):
     for j, clf in enumerate(df["Classifiers"]):
         handle = plt.Line2D([0], [0], marker=markers[j], color='w', label=clf, markerfacecolor=colors[j], markersize=10)
         handles.append(handle)
-    fig.legend(handles=handles, loc='center', bbox_to_anchor=(0.5, 0.05), ncol=len(classifiers))
+    fig.legend(handles=handles, loc='center', bbox_to_anchor=(0.5, 0.05), ncol=len(df["Classifiers"]))
     
     # Adjust spacing between subplots
     fig.subplots_adjust(wspace=0.3)
@@ -405,7 +430,7 @@ def plot_boxplot(metadata):
     return fig
 
 
-def save_figures(metadata):
+def save_figures(metadata, fig_roc, fig_boxplot):
     """Saves active  figure to disk"""
     # Define filename
     if metadata["normalization"] and not metadata["scaling"]:
@@ -433,6 +458,42 @@ def save_csv(metadata):
         df.to_csv(file, index=False)
     print(f'INFO: CSV data with metrics "{csv_filename}" has been saved to folder {figures_dir}')
 
+def run_fit_classifier(dataframe, metadata, verbosity=False, scaling=False, scaling_method='RobustScaler',
+                       one_segment_per_task=False, which_segment=1, display_fig=False, dont_save_fig=False):
+    """
+    Fit the classifiers, plot the ROC curves and save the figures and metrics.
+    Importable equivalent of running this script.
+
+    Arguments
+    ---------
+    - dataframe: panda dataframe
+            The data, as created by 01_read_processed_data.py
+    - metadata: dict
+            The information about the arguments used so far
+    - the rest of the arguments are the same as the command line arguments of this script
+
+    Returns
+    -------
+    - metadata: dict
+            The metadata, with the classification metrics and arguments added
+    """
+    classifiers = create_classifiers(seed)
+    metadata["Classifiers"] = classifiers
+    metadata = add_arguments_to_metadata(metadata, verbosity=verbosity, scaling=scaling,
+                                         scaling_method=scaling_method,
+                                         one_segment_per_task=one_segment_per_task,
+                                         which_segment=which_segment, display_fig=display_fig)
+    X, y, data_split = initialize_cv(dataframe, metadata)
+    fig_roc, metadata = fit_and_plot(X, y, classifiers, data_split, metadata)
+    fig_boxplot = plot_boxplot(metadata)
+    metadata["timestamp"] = datetime.now()
+    if dont_save_fig:
+        print('INFO: Figures will not be saved to disk.')
+    else:
+        save_figures(metadata, fig_roc, fig_boxplot)
+    save_csv(metadata)
+    return metadata
+
 if __name__ == "__main__":
 
     # Save time of beginning of the execution to measure running time
@@ -442,14 +503,8 @@ if __name__ == "__main__":
     handler = PickleDataHandler()
     dataframe, metadata = handler.load_data()
 
-    # Define scaling methods and classifiers
-    scaling_methods = [StandardScaler(), MinMaxScaler(), RobustScaler()]
-    classifiers = [
-        ('Support Vector Machine', SVC(kernel='rbf', probability=True, random_state=seed)),
-        ('Logistic Regression', LogisticRegression(penalty='l1', solver='liblinear', random_state=seed)),
-        ('Random Forest', RandomForestClassifier(random_state=seed)),
-        ('Linear Discriminant Analysis', LinearDiscriminantAnalysis(solver='svd'))
-    ]
+    # Define classifiers
+    classifiers = create_classifiers(seed)
     metadata["Classifiers"] = classifiers
 
     # 2 - Initialize command line arguments and save arguments to metadata
@@ -470,7 +525,7 @@ if __name__ == "__main__":
     if args.dont_save_fig:
         print('INFO: Figures will not be saved to disk.')
     else:
-        save_figures(metadata)
+        save_figures(metadata, fig_roc, fig_boxplot)
     
     # 7 - Save CSV data to reports dir
     save_csv(metadata)
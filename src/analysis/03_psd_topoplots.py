@@ -17,10 +17,8 @@ Created on Fri Apr 14 10:15:13 2023
 
 import os
 import sys
-import mne
 import numpy as np
 import pandas as pd
-import h5py
 
 import matplotlib.pyplot as plt
 from mne.viz import iter_topography
@@ -28,7 +26,9 @@ from mne.viz import iter_topography
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname('src'), '..'))
 sys.path.append(parent_dir)
-from config_eeg import fname
+sys.path.append(os.path.join(parent_dir, 'processing'))
+import cohort_psds
+import psds_io
 
 # COMMENT/Question: is it ok if this cannot be run from console?
 
@@ -47,43 +47,21 @@ task = 'PASAT_run2'
 #  'age' : int, could be added but omitted for now. 
 # }
 
-PSD_allsubj = {}
+# The PSDs of all subjects are read from the cohort PSD file, see
+# processing/cohort_psds.py. Take only the first segment run of the task, for now.
+cube, index = cohort_psds.read_cohort_psds()
+segment = index['tasks'].index(task)
+freqs = index['freqs']
+keep = [index['subjects'].index(subject) for subject in subjects if subject in index['subjects']]
 
-for subject in subjects:
-    subject_psds = fname.psds(subject=subject, ses='01')
+# scale to dB
+psds = 20 * np.log10(cube[keep, segment])  # nsubj x n_chs x n_freq
+groups = np.array(index['groups'])[keep]
 
-    try:
-        f = h5py.File(subject_psds, 'r')
-    except:
-        print("Psds file corrupted or missing")
-        
-    psds_keys = list(f.keys())
-    psds_data = f[psds_keys[0]]
-    data_keys = list(psds_data)
-    data = dict()
-    
-    freqs = np.array(psds_data['key_freqs']) #extract freq info
-    
-    if 'P' in subject:
-        group='Patient' 
-    elif 'C' in subject:
-        group='Control'
-    
-    for i in data_keys:
-        if 'eo' in i or 'ec' in i or 'PASAT' in i:
-            dict_key = i.removeprefix('key_')
-            # Take only the first segment run of the task, for now.
-            if task in dict_key and dict_key.endswith('_1'): 
-                psds = np.array(psds_data[i])
-                # scale to dB
-                psds = 20 * np.log10(psds)
-                #define the task name 
-                task = dict_key.removesuffix('_2') 
-                
-                PSD_allsubj[subject] = {'task': task, 
-                                        'group': group,
-                                        'data': psds}            
-    f.close()
+PSD_allsubj = {index['subjects'][k]: {'task': task,
+                                      'group': index['groups'][k],
+                                      'data': data}
+               for k, data in zip(keep, psds)}
 
 #%%Create a df from dict
 PSD_df = pd.DataFrame.from_dict(PSD_allsubj, orient='index')
@@ -91,21 +69,11 @@ PSD_df = pd.DataFrame.from_dict(PSD_allsubj, orient='index')
 # Calculate ch-wise mean psds per group
 clinical_groups = PSD_df.groupby('group')
 
-group_ch_means = []
-names = [] 
-for name, group_df in clinical_groups:
-    group_data = group_df['data']
-    Arr = np.array([i for i in group_data]) #nsubj x n_chs x n_freq
-    mean_data = np.mean(Arr, axis=0) #get mean data over all subjects within group
-    group_ch_means.append(mean_data)
-    names.append(name)
-
-group_n_mean1 = zip(names, group_ch_means)
-group_n_mean = [(name, psd_data) for name, psd_data in group_n_mean1]
+# The mean over all the subjects of a group at once
+group_n_mean = list(cohort_psds.group_means(psds, groups).items())
 
-#read in one raw data file to get sensor location info
-raw = mne.io.read_raw_fif(fname.clean(subject=subject, task='ec', run=1,ses='01'),
-                   preload=True)
+#read in the sensor location info of the PSDs
+info = psds_io.read_info(index['psds_fnames'][0])
 
 #%% Plotting functions and utils
 def my_callback1(ax, ch_idx):
@@ -145,12 +113,12 @@ colors = prop_cycle.by_key()['color']
 i=1 #zero for controls, 1 for patients
 
 #loop through all channels and create an axis for them
-for ax, idx in iter_topography(raw.info,
+for ax, idx in iter_topography(info,
                                fig_facecolor='white',
                                axis_facecolor='white',
                                axis_spinecolor='white',
                                on_pick=my_callback1):
-    ax.plot(psds[idx], color='grey') #just to show some general output for the big figure
+    ax.plot(psds[-1][idx], color='grey') #just to show some general output for the big figure
     
 plt.gcf().suptitle(f'Power spectral densities, {task}')
 plt.show()
\ No newline at end of file
@@ -3,7 +3,7 @@
 """
 Created on Wed Mar 15 11:23:04 2023
 
-It runs the scripts:
+It runs the steps of:
     01_read_processed_data.py,
     02_plot_processed_data,
     03_fit_classifier_and_plot.py,
@@ -15,31 +15,152 @@ It will:
 - Fit classifiers, plot ROCs, and save the ROC plots and the metrics to a pickle object
 - Create an html report in the 'reports_dir'
 
+The steps are imported and run within this one process, so that the libraries
+and the list of subjects are loaded only once for all argument sets.
+
+With --grid, all the configurations in `grid` are evaluated instead of
+`arg_sets`. The bandpowers of each (task, frequency band type) are then read
+only once, and the normalized and not normalized data are derived from them in
+memory. The classifiers of the different configurations are fitted in parallel
+using --n_jobs worker processes. The figures, CSV files and reports are the
+same as when running each configuration on its own.
 """
 
-import subprocess
+import argparse
+import importlib
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.pyplot as plt
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(SRC_DIR)
+ANALYSIS_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(ANALYSIS_DIR)
+from profiling import enable_profiling, profiled
+from config_common import n_jobs
 
-# Define a list of tuples containing the different argument combinations to use
+# Use importlib to import the modules, as their names start with a number
+read_processed_data = importlib.import_module('01_read_processed_data')
+plot_processed_data = importlib.import_module('02_plot_processed_data')
+fit_classifier_and_plot = importlib.import_module('03_fit_classifier_and_plot')
+create_report = importlib.import_module('04_create_report')
+
+# Define a list of dictionaries containing the different argument combinations to use
 arg_sets = [
-#            ('--task', 'eo', '--freq_band_type', 'thin'),
-#            ('--task', 'ec', '--freq_band_type', 'thin'),
-#            ('--task', 'PASAT_1', '--freq_band_type', 'thin'),
-            ('--task', 'PASAT_2', '--freq_band_type', 'thin', '--not_normalized'),
+#            dict(task='eo', freq_band_type='thin', not_normalized=False),
+#            dict(task='ec', freq_band_type='thin', not_normalized=False),
+#            dict(task='PASAT_1', freq_band_type='thin', not_normalized=False),
+            dict(task='PASAT_2', freq_band_type='thin', not_normalized=True),
 ]
 
+# The configurations evaluated with --grid: all combinations of the tasks and
+# frequency band types, each with the (normalization, scaling) options below.
+# Scaling is not done for normalized data.
+grid = dict(
+    tasks=['eo', 'ec', 'PASAT_1', 'PASAT_2'],
+    freq_band_types=['thin', 'wide'],
+    options=[
+        dict(not_normalized=False, scaling=False),
+        dict(not_normalized=True, scaling=False),
+        dict(not_normalized=True, scaling=True),
+    ],
+)
+
+
+def run_analysis(subjects, task, freq_band_type, not_normalized, scaling=True):
+    """Run all the steps of the analysis for one set of arguments."""
+    stage = f'{task} {freq_band_type}' + (' not normalized' if not_normalized else '')
+    with profiled('read_processed_data', stage=stage):
+        dataframe, metadata = read_processed_data.run_read_processed_data(
+            task, freq_band_type, not_normalized, subjects)
+    with profiled('plot_processed_data', stage=stage):
+        metadata = plot_processed_data.run_plot_processed_data(dataframe, metadata)
+    with profiled('fit_classifier', stage=stage):
+        metadata = fit_classifier_and_plot.run_fit_classifier(dataframe, metadata, scaling=scaling)
+    with profiled('create_report', stage=stage):
+        create_report.create_report(metadata)
+    # Close the figures of this argument set before moving on to the next
+    plt.close('all')
+    return dataframe, metadata
+
+
+def fit_configuration(dataframe, metadata, scaling):
+    """Fit the classifiers and create the report for one configuration."""
+    stage = f'{metadata["task"]} {metadata["freq_band_type"]}' + \
+        ('' if metadata["normalization"] else ' not normalized') + (' scaled' if scaling else '')
+    with profiled('fit_classifier', stage=stage):
+        metadata = fit_classifier_and_plot.run_fit_classifier(dataframe, metadata, scaling=scaling)
+    with profiled('create_report', stage=stage):
+        create_report.create_report(metadata)
+    plt.close('all')
+    return metadata
+
+
+def run_grid(subjects, grid=grid, n_jobs=1):
+    """
+    Run the analysis for all the configurations of the grid.
+
+    Arguments
+    ---------
+    - subjects: list of str
+            The subjects to include
+    - grid: dict
+            The tasks, frequency band types and (normalization, scaling) options to combine
+    - n_jobs: int
+            Number of configurations whose classifiers are fitted in parallel
+
+    Returns
+    -------
+    - results: list of dict
+            The metadata of each configuration, including the classification metrics
+    """
+    jobs = []
+    for task in grid['tasks']:
+        for freq_band_type in grid['freq_band_types']:
+            # Read the bandpowers only once for all the options
+            stage = f'{task} {freq_band_type}'
+            with profiled('read_processed_data', stage=stage):
+                variants = read_processed_data.read_processed_data_variants(task, freq_band_type, subjects)
+
+            for not_normalized in {option['not_normalized'] for option in grid['options']}:
+                # The control plot is the same for the scaled and not scaled data
+                dataframe, metadata = variants[not_normalized]
+                with profiled('plot_processed_data', stage=stage):
+                    metadata = plot_processed_data.run_plot_processed_data(dataframe, metadata)
+                plt.close('all')
+                variants[not_normalized] = (dataframe, metadata)
+
+            for option in grid['options']:
+                dataframe, metadata = variants[option['not_normalized']]
+                jobs.append((dataframe, dict(metadata), option['scaling']))
+
+    if n_jobs == 1:
+        return [fit_configuration(*job) for job in jobs]
+
+    # Use fresh worker processes, as the parent has already used matplotlib
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as pool:
+        futures = [pool.submit(fit_configuration, *job) for job in jobs]
+        return [future.result() for future in futures]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--profile', help='Append the time and memory used by each step to this JSONL file, see profiling.py. Default: no profiling', default=None)
+    parser.add_argument('--grid', action='store_true', help='Run all the configurations of the grid instead of arg_sets. Default: False', default=False)
+    parser.add_argument('--n_jobs', type=int, help=f'With --grid, number of configurations fitted in parallel. Default: {n_jobs}', default=n_jobs)
+    args = parser.parse_args()
+    if args.profile is not None:
+        enable_profiling(args.profile)
+
+    subjects = read_processed_data.read_subjects()
+    if args.grid:
+        run_grid(subjects, n_jobs=args.n_jobs)
+    else:
+        for arg_set in arg_sets:
+            run_analysis(subjects, **arg_set)
 
-for arg_set in arg_sets:
-    # Call the first Python file with each set of arguments
-    proc1 = subprocess.run(['python3', '01_read_processed_data.py'] + list(arg_set), stdout=subprocess.PIPE)
-    print(proc1.stdout.decode('utf-8'))
-    # Call the second Python file without any arguments
-    proc2 = subprocess.run(['python3', '02_plot_processed_data.py'], stdout=subprocess.PIPE)
-    print(proc2.stdout.decode('utf-8'))
-    # Call the third script
-    proc3 = subprocess.run(['python3', '03_fit_classifier_and_plot.py', '--scaling'], stdout=subprocess.PIPE)
-    print(proc3.stdout.decode('utf-8'))
-    # Create report, no arguments
-    proc4 = subprocess.run(['python3', '04_create_report.py'], stdout=subprocess.PIPE)
-    print(proc4.stdout.decode('utf-8'))
-    
-print('Finished running for all tasks.')
+    print('Finished running for all tasks.')
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Split a budget of CPU cores between worker processes and BLAS threads.
+
+NumPy and SciPy do their linear algebra (e.g. the ICA fit, the PCA before it,
+the filters) with a BLAS library that starts its own pool of threads, one per
+core by default. When several subjects or recordings are processed in
+parallel, each worker starting a thread per core oversubscribes the machine,
+while a single worker limited to a few threads leaves cores unused. The total
+number of cores (``n_cores`` in config_common.py) is therefore split: with
+``n_workers`` processes running in parallel, each gets
+``n_cores // n_workers`` BLAS threads, see `split_budget`.
+
+The size of the thread pools is set in two ways: through the environment
+variables read by the BLAS and OpenMP libraries when they are loaded (which is
+also how worker processes inherit it), and with threadpoolctl for the
+libraries that are already loaded in the current process.
+
+    with blas_threads(n_threads):
+        with ProcessPoolExecutor(n_workers, initializer=set_blas_threads,
+                                 initargs=(n_threads,)) as pool:
+            ...
+
+`benchmark_threads.py` measures which split is the fastest on a machine.
+"""
+
+import os
+from contextlib import contextmanager
+
+# The environment variables that set the size of the thread pools of the BLAS
+# and OpenMP libraries NumPy and SciPy may use
+thread_env_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                   'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def get_core_budget(n_cores=None):
+    """Get the number of cores the processing may use.
+
+    Parameters
+    ----------
+    n_cores : int | None
+        The budget. With None, all the cores this process may run on.
+
+    Returns
+    -------
+    n_cores : int
+        The budget.
+    """
+    if n_cores is not None:
+        return max(1, int(n_cores))
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not on Linux
+        return os.cpu_count() or 1
+
+
+def split_budget(n_cores, n_workers):
+    """Split a budget of cores between worker processes and BLAS threads.
+
+    Parameters
+    ----------
+    n_cores : int
+        The number of cores.
+    n_workers : int
+        The number of processes that run in parallel.
+
+    Returns
+    -------
+    n_workers : int
+        The number of processes, at most one per core.
+    n_threads : int
+        The number of BLAS threads of each process.
+    """
+    n_workers = max(1, min(n_workers, n_cores))
+    return n_workers, max(1, n_cores // n_workers)
+
+
+def set_thread_env(n_threads):
+    """Set the thread pool size of the BLAS libraries loaded from now on.
+
+    Processes started afterwards inherit the setting.
+    """
+    for name in thread_env_vars:
+        os.environ[name] = str(n_threads)
+
+
+def set_blas_threads(n_threads):
+    """Set the number of BLAS threads of the current process.
+
+    Used as the initializer of worker processes.
+
+    Parameters
+    ----------
+    n_threads : int
+        The number of threads.
+
+    Returns
+    -------
+    limiter : instance of threadpool_limits | None
+        The limits set on the libraries already loaded, or None if
+        threadpoolctl is not installed.
+    """
+    set_thread_env(n_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return None
+    return threadpool_limits(limits=n_threads)
+
+
+@contextmanager
+def blas_threads(n_threads):
+    """Use a number of BLAS threads within a block.
+
+    The environment variables and the thread pools are restored at the end
+    of the block.
+
+    Parameters
+    ----------
+    n_threads : int
+        The number of threads.
+    """
+    previous = {name: os.environ.get(name) for name in thread_env_vars}
+    limiter = set_blas_threads(n_threads)
+    try:
+        yield
+    finally:
+        if limiter is not None:
+            limiter.restore_original_limits()
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
@@ -19,6 +19,17 @@ from socket import gethostname
 user = getuser()  # Username of the user running the scripts
 host = gethostname()  # Hostname of the machine running the scripts
 
+# Memory (in GB) that the subjects processed in parallel may use together. With
+# None, 80% of the physical memory of the machine is used. Set it in the block
+# of your machine below to override it.
+memory_budget = None
+
+# Number of CPU cores the processing may use. With None, all the cores of the
+# machine. The drivers split them between the subjects (or recordings) that are
+# processed in parallel and the BLAS threads of each, see blas_threads.py. Set
+# it in the block of your machine below to override it.
+n_cores = None
+
 # You want to add your machine to this list
 if host == 'nbe-077' and user == 'heikkiv7':
     # Verna's workstation in Aalto
@@ -88,8 +99,12 @@ elif 'vdiubuntu' in host and user == 'portae1' :
 else:
     raise ValueError(f'User or host not recognized. \nPlease enter the details of your system ({user}@{host}) in config_common.py')
 
-# For BLAS to use the right amount of cores
-os.environ['OMP_NUM_THREADS'] = str(n_jobs)
+# For BLAS to use the right amount of cores. A script run on its own uses the
+# whole budget. Worker processes inherit the number of threads their driver
+# gave them, which is not overridden here.
+if 'OMP_NUM_THREADS' not in os.environ:
+    from blas_threads import get_core_budget, set_thread_env
+    set_thread_env(get_core_budget(n_cores))
 
 # Configure the graphics backend
 import matplotlib
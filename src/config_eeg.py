@@ -28,6 +28,25 @@ folds = 10
 n_fft = 2048  # Higher number means more resolution at the lower frequencies
 #1024?4096?
 
+# The segments of each recording the PSDs are computed for are listed in the
+# table segments_file: the task (as in the PSD file, e.g. 'ec' or
+# 'PASAT_run1'), the name of the segment and its tmin and tmax in seconds. The
+# Welch windows of a segment overlap by psd_overlap (a fraction of n_fft). With
+# psd_reject_by_annotation, the windows that overlap a 'bad' annotation are
+# left out.
+segments_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'segments.csv')
+psd_overlap = 0.
+psd_reject_by_annotation = False
+
+# With psd_streaming, 03_psds.py does not read the whole cleaned recording
+# into memory, but reads it in blocks of psd_block_windows Welch windows
+psd_streaming = False
+psd_block_windows = 16
+
+# The compression of the PSDs in the PSD files ('gzip', 'lzf' or None), see
+# processing/psds_io.py
+psd_compression = None
+
 # Highpass filter above 1Hz. This is needed for the ICA to perform well
 # later on. Lowpass filter below 100Hz to get rid of the signal produced by
 # the cHPI coils. Notch filters at 50Hz and 100Hz to get rid of powerline.
@@ -36,6 +55,42 @@ freq_max = 43
 filt_freq_max = 90
 fnotch = [50, 100]
 
+# After the low-pass filter, the filtered data can be decimated to (at least)
+# this sampling frequency, so that the ICA and the PSDs are computed from
+# several times fewer samples. It must be above twice the edge of the stop band
+# of the low-pass filter (2 x 112.5 Hz for filt_freq_max = 90). None keeps the
+# acquisition rate. See processing/benchmark_decimation.py for the effect on
+# the bandpowers and the classification.
+target_sfreq = None
+
+# Fitting the ICA. By default, the ICA (FastICA) is fitted on all the samples
+# of the recording, with as many components as are needed to explain 99% of
+# the variance. For a faster fit, it can be fitted on every ica_fit_decim-th
+# sample only and/or on the (tmin, tmax) window ica_fit_window of the recording
+# (in seconds), with at most ica_max_components components, and with another
+# solver: ica_method 'picard' (needs the python-picard package) or 'infomax'
+# (with ica_fit_params = dict(extended=True) for extended infomax). The
+# components are always removed from the whole recording. See
+# processing/validate_fast_ica.py for the effect on the excluded components and
+# the bandpowers.
+ica_method = 'fastica'
+ica_fit_params = None
+ica_fit_decim = None
+ica_fit_window = None
+ica_max_components = None
+
+# Start the ICA of the later recordings of a subject (eo, PASAT) from the
+# solution of its first recording (ec), instead of from scratch. The recordings
+# share the head, the cap and the session, so their unmixing matrices are
+# similar and the solver needs fewer iterations. The iterations and the fit
+# time of each recording are appended to ica_convergence.csv.
+ica_warm_start = False
+
+# Format of the filtered and cleaned data passed from one step to the next:
+# 'fif' (the _filt.fif and _clean.fif files) or 'npy' (float32 arrays that the
+# next steps memory-map, see processing/intermediate.py)
+intermediate_format = 'fif'
+
 thin_bands = [(x, x+1) for x in range(1, 43)] # thin_bands = (1,2),...., (42,43)
 wide_bands =  [(1,3), (3,5.2), (5.2,7.6), (7.6,10.2), (10.2,13), (13,16), (16,19.2), 
                (19.2,22.6), (22.6,26.2), (26.2,30), (30,34), (34,38.2), (38.2,42.6)]
@@ -394,18 +449,33 @@ fname.add('tsss_log', '{raw_data_dir}/sub-{subject}/ses-{ses}/meg/sub-{subject}_
 
 # Files used during EOG and ECG artifact suppression
 fname.add('ica', '{processed_data_dir}/sub-{subject}/ses-{ses}/eeg/sub-{subject}_ses-{ses}_task-{task}_run-0{run}_ica.h5')
+fname.add('eog_ecg_events', '{processed_data_dir}/sub-{subject}/ses-{ses}/eeg/sub-{subject}_ses-{ses}_task-{task}_run-0{run}_eog-ecg-events.h5')
 
 # PSD files
 fname.add('psds', '{processed_data_dir}/sub-{subject}/ses-{ses}/eeg/sub-{subject}_psds.h5')
+# The PSDs of all subjects, see processing/cohort_psds.py
+fname.add('cohort_psds', '{processed_data_dir}/cohort_psds.npy')
 
 # Band power files
 fname.add('bandpower', '{processed_data_dir}/sub-{subject}/ses-{ses}/eeg/sub-{subject}_bandpower.csv')
 
+# Filter kernels and other things that are computed once and shared by all
+# subjects
+fname.add('cache_dir', '{processed_data_dir}/cache')
+fname.add('filter_kernel', '{cache_dir}/filters/fir_{key}.npy')
+fname.add('interpolation_matrix', '{cache_dir}/interpolation/interp_{key}.npy')
+
 # Filenames for MNE reports
 fname.add('reports_dir', f'{reports_dir}')
 fname.add('report', '{reports_dir}/sub-{subject}-report.h5')
 fname.add('report_html', '{reports_dir}/sub-{subject}-report.html')
 
+# Data of the QC figures that are rendered afterwards (--qc deferred), see
+# processing/qc.py
+fname.add('qc_dir', '{reports_dir}/qc')
+fname.add('qc_data', '{qc_dir}/sub-{subject}/{name}.h5')
+fname.add('qc_evoked', '{qc_dir}/sub-{subject}/{name}-ave.fif')
+
 # Filenames for figures
 fname.add('figures_dir', f'{figures_dir}')
 fname.add('figure_psds', '{figures_dir}/psds.pdf')
@@ -472,7 +542,54 @@ def task_from_fname(fname):
     else:
         return task
 
-def select_task_segments(task):
+# The tables read by read_segments
+_segments = dict()
+
+def read_segments(filename=None):
+    """Read the table of the segments the PSDs are computed for.
+
+    The table is read once, later calls return the same segments.
+
+    Parameters
+    ----------
+    filename : str | None
+        The table. Defaults to ``segments_file``.
+
+    Returns
+    -------
+    segments : dict
+        For each task, the list of its (name, tmin, tmax) segments, in order.
+    """
+    filename = segments_file if filename is None else filename
+    if filename not in _segments:
+        import csv
+        segments = dict()
+        with open(filename, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                segments.setdefault(row['task'], []).append(
+                    (row['segment'], float(row['tmin']), float(row['tmax'])))
+        _segments[filename] = segments
+    return _segments[filename]
+
+def get_segments(task):
+    """Get the (name, tmin, tmax) segments of a recording.
+
+    Parameters
+    ----------
+    task : str
+        The task of the recording, as returned by `task_from_fname`.
+
+    Returns
+    -------
+    segments : list of tuple
+        The segments, see `read_segments`.
+    """
+    segments = read_segments()
+    if task not in segments:
+        raise ValueError(f'No segments defined for task {task} in {segments_file}')
+    return segments[task]
+
+def select_task_segments(task, segments):
     """
     Define the task segments to be used for the analysis
     
@@ -481,27 +598,17 @@ def select_task_segments(task):
     ---------
     - task : str
         Each of the four tasks that have been measured for this experiment: Eyes Closed (ec), Eyes Open (eo), Paced Auditory Serial Addition Test 1 or 2 (PASAT_1 or PASAT_2)
+    - segments : dict
+        The index of the segments the PSDs were computed for, by segment name, as stored in the PSD files (see `read_index` in processing/psds_io.py)
     
     Returns
     -------
-    - chosen_tasks: The list of chosen task's segments 
+    - chosen_tasks: The list of chosen task's segments, in the order of the index
     """
-    # Segments present in each of the tasks
-    tasks = [['ec_1', 'ec_2', 'ec_3'], 
-             ['eo_1', 'eo_2', 'eo_3'], 
-             ['PASAT_run1_1', 'PASAT_run1_2'], 
-             ['PASAT_run2_1', 'PASAT_run2_2']]
-       
-    # Define which files to read for each subject
-    if task == 'ec':
-        chosen_tasks = tasks[0]
-    elif task == 'eo':
-        chosen_tasks = tasks[1]
-    elif task == 'PASAT_1':
-        chosen_tasks = tasks[2]
-    elif task == 'PASAT_2': 
-        chosen_tasks = tasks[3]
-    else:
-        raise("Incorrect task")
-       
+    # The PSD files name the PASAT runs PASAT_run1 and PASAT_run2
+    if task in ('PASAT_1', 'PASAT_2'):
+        task = task.replace('_', '_run')
+    chosen_tasks = [name for name, segment in segments.items() if segment['task'] == task]
+    if not chosen_tasks:
+        raise ValueError(f'No segments of task {task} in the PSD files')
     return chosen_tasks
@@ -10,21 +10,22 @@ Created on Fri Feb 24 12:26:23 2023
 """
 
 import numpy as np
-import h5py 
 import mne
 import argparse
 from pathlib import Path
 from fooof import FOOOF
 import datetime
 import time
-from config_eeg import fname, f_bands
+from config_eeg import fname, f_bands, select_task_segments
 
 import sys
+sys.path.append('../processing/')
+import psds_io
 sys.path.append('../analysis/')
 #from 01_read_processed_data import define_subtasks #THIS DOES NOT WORK due to number in the beginning
 
 
-def define_subtasks(task):
+def define_subtasks(task, subject_psds):
     """
     Define the subtasks to be used for the analysis
     
@@ -32,30 +33,14 @@ def define_subtasks(task):
     Input parameters
     ---------
     - task: chosen task (eyes open, eyes closed, Paced Auditory Serial Addition Test 1 or PASAT 2)
+    - subject_psds: the PSD file of the subject
     
     Returns
     -------
     - chosen_tasks: The list of chosen subtasks
     """
-    tasks = [['ec_1', 'ec_2', 'ec_3'], 
-             ['eo_1', 'eo_2', 'eo_3'], 
-             ['PASAT_run1_1', 'PASAT_run1_2'], 
-             ['PASAT_run2_1', 'PASAT_run2_2']]
-       
-    # Define which files to read for each subject
-    if task == 'ec':
-        chosen_tasks = tasks[0]
-    elif task == 'eo':
-        chosen_tasks = tasks[1]
-    elif task == 'PASAT_1':
-        chosen_tasks = tasks[2]
-    elif task == 'PASAT_2': 
-        chosen_tasks = tasks[3]
-    else:
-        raise("Incorrect task")
-    
-    
-    return chosen_tasks
+    # The segments of each task are taken from the index stored in the PSD file
+    return select_task_segments(task, psds_io.read_index(subject_psds))
 
 
 # Save time of beginning of the execution to measure running time
@@ -71,21 +56,9 @@ args = parser.parse_args()
 
 subject_psds = fname.psds(subject=args.subject, ses='01')
   
-f = h5py.File(subject_psds, 'r')
-psds_keys = list(f.keys())
-psds_data = f[psds_keys[0]]
-data_keys = list(psds_data)
-data = dict()
-
-# Add the data for each PSD to the dictionary 'data'
-for i in data_keys:
-    if 'eo' in i or 'ec' in i or 'PASAT' in i:
-        dict_key = i.removeprefix('key_')
-        data[dict_key]=np.array(psds_data[i])
-freqs = np.array(psds_data['key_freqs'])
-info_keys = list(psds_data['key_info'])
-
-f.close()
+# Read only the segments of the chosen task
+chosen_task = define_subtasks(task=args.task, subject_psds=subject_psds)
+data, freqs = psds_io.read_psds(subject_psds, segments=chosen_task)
 
   # Calculate the average bandpower for each PSD
 for data_obj in list(data.keys()):
@@ -111,7 +84,6 @@ for data_obj in list(data.keys()):
     fm.report(freqs, avg_bandpower, freq_range)
 
 
-chosen_task = define_subtasks(task=args.task) #TODO: different name perhaps?
 spectra = data[chosen_task[0]]
 global_avg = np.mean(spectra, axis=0)  #Global characteristics OR analysis on some/all chs?
 
@@ -3,6 +3,10 @@ Do-it script to execute the entire pipeline using the doit tool:
 http://pydoit.org
 
 All the filenames are defined in config.py
+
+Note that the processing scripts themselves skip the recordings whose output is
+up to date (see processing/fingerprint.py), so doit only needs to decide which
+subjects to hand to them.
 """
 import sys
 sys.path.append('..')
@@ -20,41 +24,49 @@ DOIT_CONFIG = dict(
     sort='definition',
 )
 
+exclude = ['emptyroom']
+
+
 def task_filt():
     """Step 01: Perform frequency filtering"""
     for subject in subjects:
         yield dict(
-            name=f'sub-{subject:02d}',
-            file_dep=get_all_fnames(subject, 'raw') + ['01_freqfilt.py'],
-            targets=get_all_fnames(subject, 'filt'),
-            actions=[f'python 01_freqfilt.py {subject}'],
+            name=f'sub-{subject}',
+            file_dep=get_all_fnames(subject, 'raw', exclude=exclude) + ['../processing/01_freqfilt.py', '../config_eeg.py'],
+            targets=get_all_fnames(subject, 'filt', exclude=exclude),
+            actions=[f'python ../processing/01_freqfilt.py {subject}'],
         )
 
 def task_ica():
     """Step 02: Remove blink (EOG) artifacts using ICA"""
     for subject in subjects:
         yield dict(
-            name=f'sub-{subject:02d}',
-            file_dep=(get_all_fnames(subject, 'raw', exclude=['emptyroom', 'eyesclosed']) +
-                      get_all_fnames(subject, 'filt', exclude=['emptyroom', 'eyesclosed']) +
-                      ['02_ica.py']),
-            targets=(get_all_fnames(subject, 'ica', exclude=['emptyroom', 'eyesclosed']) +
-                     get_all_fnames(subject, 'clean', exclude=['emptyroom', 'eyesclosed'])),
-            actions=[f'python 02_ica.py {subject}'],
+            name=f'sub-{subject}',
+            file_dep=(get_all_fnames(subject, 'filt', exclude=exclude) +
+                      ['../processing/02_ica.py']),
+            targets=(get_all_fnames(subject, 'ica', exclude=exclude) +
+                     get_all_fnames(subject, 'clean', exclude=exclude)),
+            actions=[f'python ../processing/02_ica.py {subject}'],
         )
 
 def task_psds():
     """Step 03: Compute the Power Spectral Density (PSD) for each recording."""
     for subject in subjects:
         yield dict(
-            name=f'sub-{subject:02d}',
-            file_dep=[
-                fname.clean(subject=subject, task='eyesopen', run=1, ses='01'),
-                fname.clean(subject=subject, task='eyesclosed', run=1, ses='01'),
-                fname.clean(subject=subject, task='pasat', run=1, ses='01'),
-                fname.clean(subject=subject, task='pasat', run=2, ses='01'),
-                '03_psds.py',
-            ],
+            name=f'sub-{subject}',
+            file_dep=(get_all_fnames(subject, 'clean', exclude=exclude) +
+                      ['../processing/03_psds.py']),
             targets=[fname.psds(subject=subject, ses='01')],
-            actions=[f'python 03_psds.py {subject}'],
+            actions=[f'python ../processing/03_psds.py {subject}'],
+        )
+
+def task_bandpower():
+    """Step 04: Compute the band power of each PSD."""
+    for subject in subjects:
+        yield dict(
+            name=f'sub-{subject}',
+            file_dep=[fname.psds(subject=subject, ses='01'),
+                      '../processing/04_bandpower.py'],
+            actions=[f'python ../processing/04_bandpower.py {subject} --freq_band_type thin',
+                     f'python ../processing/04_bandpower.py {subject} --freq_band_type wide'],
         )
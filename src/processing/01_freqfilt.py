@@ -7,12 +7,13 @@ Running:
 import subprocess
 subprocess.run('/net/tera2/home/heikkiv/work_s2022/mtbi-eeg/python/processing/eeg/runsome.sh', shell=True)
 
+The step can also be imported and run for a subject with `run_freqfilt`.
 """
 
 import argparse
 from collections import defaultdict
 from mne.io import read_raw_fif
-from mne import open_report, set_log_level
+from mne import set_log_level
 import datetime
 import time
 import os
@@ -21,140 +22,315 @@ import sys
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(parent_dir)
 
-# Save time of beginning of the execution to measure running time
-start_time = time.time()
+from config_eeg import get_all_fnames, ec_bads, eo_bads, pasat1_bads, pasat2_bads, freq_min, filt_freq_max, fnotch, target_sfreq
+from fingerprint import compute_fingerprint, file_stat, is_up_to_date, load_fingerprint, save_fingerprint
+from profiling import profiled, bytes_read
+import filtering
+import intermediate
+import interpolation
+import qc as qc_figures
+import reports
 
-from config_eeg import get_all_fnames, fname, ec_bads, eo_bads, pasat1_bads, pasat2_bads, freq_min, filt_freq_max, fnotch
 
-# Deal with command line arguments
-parser = argparse.ArgumentParser(description=__doc__)
-parser.add_argument('subject', help='The subject to process')
-args = parser.parse_args()
+def get_bads(subject, raw_fname):
+    """Get the manually annotated bad channels of a recording.
 
-# Along the way, we collect figures for quality control
-figures = defaultdict(list)
+    Parameters
+    ----------
+    subject : str
+        The subject the recording belongs to.
+    raw_fname : str | Path
+        The raw data file of the recording.
 
-# Not all subjects have files for all conditions. These functions grab the
-# files that do exist for the subject.
-exclude = ['emptyroom'] #these don't have eye blinks.
-all_fnames = zip(
-    get_all_fnames(args.subject, kind='raw', exclude=exclude),
-    get_all_fnames(args.subject, kind='filt', exclude=exclude),
-)
-
-# Date and time
-now = datetime.datetime.now()
-date_time = now.strftime('%A, %d. %B %Y %I:%M%p')
-
-corrupted_raw_files = []
-
-for raw_fname, filt_fname in all_fnames:
-    try:
-        raw = read_raw_fif(raw_fname, preload=True)
-    except NameError as e:
-        raise NameError(f'Subject {args.subject} does not exist') from e
-    except (IOError, ValueError) as error:
-        corrupted_raw_files.append(args.subject)
-        print(f'Error: {error}')
-        continue
-
-    
-    # Reduce logging level (technically, one could define it in the read_raw_fif function, but it seems to be buggy)
-    # More info about the bug can be found here: https://github.com/mne-tools/mne-python/issues/8872
-    set_log_level(verbose='Warning')
-
-    # Mark bad channels that were manually annotated earlier.
+    Returns
+    -------
+    bads : list of str
+        The bad channels.
+    task : str
+        The task of the recording: 'ec', 'eo', 'pasat1' or 'pasat2'.
+    """
     raw_str = str(raw_fname)
     if 'task-ec' in raw_str:
-        raw.info['bads'] = ec_bads[args.subject]
-        task = 'ec'
+        return ec_bads[subject], 'ec'
     elif 'task-eo' in raw_str:
-        raw.info['bads'] = eo_bads[args.subject]
-        task = 'eo'
+        return eo_bads[subject], 'eo'
     elif 'task-PASAT' in raw_str and 'run-01' in raw_str:
-        raw.info['bads'] = pasat1_bads[args.subject]
-        task = 'pasat1'
+        return pasat1_bads[subject], 'pasat1'
     elif 'task-PASAT' in raw_str and 'run-02' in raw_str:
-        raw.info['bads'] = pasat2_bads[args.subject]
-        task = 'pasat2'
-    
-    # Remove MEG channels. This is the EEG pipeline after all.
+        return pasat2_bads[subject], 'pasat2'
+    raise ValueError(f'Unknown task for file {raw_fname}')
+
+
+def read_recording(raw_fname):
+    """Read the EEG, EOG, ECG and stim channels of a raw recording.
+
+    The file is first opened without loading the data, so that only the
+    channels used by the EEG pipeline are loaded into memory instead of all
+    the (MEG) channels.
+
+    Parameters
+    ----------
+    raw_fname : str | Path
+        The raw data file of the recording.
+
+    Returns
+    -------
+    raw : instance of Raw
+        The raw data, loaded into memory.
+    """
+    start_bytes = bytes_read()
+    raw = read_raw_fif(raw_fname, preload=False)
     raw.pick_types(meg=False, eeg=True, eog=True, stim=True, ecg=True, exclude=[])
-    
+    raw.load_data()
+    if start_bytes is not None:
+        print(f'INFO: Read {(bytes_read() - start_bytes) / 1e6:.1f} MB for '
+              f'{len(raw.ch_names)} channels from {raw_fname}')
+    return raw
+
+
+def filter_recording(raw, bads, task, figures=None, date_time='', qc_data=None,
+                     target_sfreq=target_sfreq):
+    """Interpolate the bad channels of a recording and filter it.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The raw data, which is modified in-place.
+    bads : list of str
+        The bad channels, which are interpolated.
+    task : str
+        The task of the recording, used for the figure titles.
+    figures : dict of list | None
+        If given, quality control figures are appended to it.
+    date_time : str
+        Date and time to put in the figure titles.
+    qc_data : dict | None
+        If given, the data needed to make the quality control figures later
+        is put in it instead (see qc.py).
+    target_sfreq : float | None
+        If given, the filtered data is decimated to (at least) this sampling
+        frequency.
+
+    Returns
+    -------
+    filt : instance of Raw
+        The filtered (and decimated) data.
+    """
+    # Mark bad channels that were manually annotated earlier.
+    raw.info['bads'] = bads
+
+    # Remove MEG channels. This is the EEG pipeline after all. Usually they
+    # have been dropped already when reading the data, see `read_recording`.
+    with profiled('pick_types'):
+        raw.pick_types(meg=False, eeg=True, eog=True, stim=True, ecg=True, exclude=[])
+
     # Plot segment of raw data
-    figures['raw segment'].append(raw.plot(n_channels=30, title = date_time, show=False))
-    
-    # Interpolate bad channels
-    raw.interpolate_bads()
-    figures['interpolated segment'].append(raw.plot(n_channels=30, title = date_time + task, show=False))
-    
-    # Add a plot of the power spectrum to the list of figures to be placed in
-    # the HTML report.
-    raw_plot = raw.compute_psd(fmin=freq_min, fmax=filt_freq_max).plot(show=False)
-    figures['before filt'].append(raw_plot)
-
-    # Remove 50Hz power line noise (and the first harmonic: 100Hz)
-    filt = raw.notch_filter(fnotch, picks=['eeg', 'eog', 'ecg'])
-    
-    # Apply bandpass filter
-    filt = filt.filter(l_freq=freq_min, h_freq=filt_freq_max, picks=['eeg', 'eog', 'ecg'])
-
-    # Save the filtered data
-    filt_fname.parent.mkdir(parents=True, exist_ok=True)
-    filt.save(filt_fname, overwrite=True)
+    if figures is not None:
+        figures['raw segment'].append(raw.plot(n_channels=30, title = date_time, show=False))
+    if qc_data is not None:
+        qc_data['raw segment'] = qc_figures.raw_segment(raw, n_channels=30)
+
+    # Interpolate bad channels, reusing the interpolation matrix of the
+    # recordings with the same channel positions and bad channels (see
+    # interpolation.py)
+    with profiled('interpolate_bads'):
+        interpolation.interpolate_bads(raw)
+    if figures is not None:
+        figures['interpolated segment'].append(raw.plot(n_channels=30, title = date_time + task, show=False))
+
+        # Add a plot of the power spectrum to the list of figures to be placed in
+        # the HTML report.
+        with profiled('plot_psd'):
+            raw_plot = raw.compute_psd(fmin=freq_min, fmax=filt_freq_max).plot(show=False)
+        figures['before filt'].append(raw_plot)
+    if qc_data is not None:
+        qc_data['interpolated segment'] = qc_figures.raw_segment(raw, n_channels=30)
+        with profiled('qc_data'):
+            qc_data['before filt'] = qc_figures.psd_arrays(raw, freq_min, filt_freq_max)
+
+    # Remove 50Hz power line noise (and the first harmonic: 100Hz) and apply
+    # bandpass filter, in one pass over the data (see filtering.py)
+    with profiled('fir_filter'):
+        filt = filtering.filter_raw(raw, freq_min, filt_freq_max, fnotch, picks=['eeg', 'eog', 'ecg'])
+
+    # Everything above the low-pass filter is gone, so fewer samples suffice
+    # for the ICA and the PSDs
+    if target_sfreq is not None:
+        with profiled('decimate'):
+            filt = filtering.decimate_raw(filt, target_sfreq, filt_freq_max)
 
     # Add a plot of the power spectrum of the filtered data to the list of
     # figures to be placed in the HTML report.
-    filt_plot = filt.plot_psd(fmin=freq_min, fmax=filt_freq_max, show=False)
-    figures['after filt'].append(filt_plot)
-    
-    raw.close()
-
-# Write HTML report with the quality control figures
-section='Filtering'
-with open_report(fname.report(subject=args.subject)) as report:
-    report.add_figure(
-        figures['before filt'],
-        title='Before frequency filtering',
-        caption=('Eyes open', 'Eyes closed', 'PASAT run 1', 'PASAT run 2'),
-        replace=True,
-        section=section,
-        tags=('filt')
-    )
-    report.add_figure(
-        figures['after filt'],
-        title='After frequency filtering',
-        caption=('Eyes open', 'Eyes closed', 'PASAT run 1', 'PASAT run 2'),
-        replace=True,
-        section=section,
-        tags=('filt')
-    )
-    report.add_figure(
-        figures['raw segment'],
-        title='Before interpolation',
-        caption=('Eyes open', 'Eyes closed', 'PASAT run 1', 'PASAT run 2'),
-        replace=True,
-        section=section,
-        tags=('raw')
-    )
-    report.add_figure(
-        figures['interpolated segment'],
-        title='After interpolation',
-        caption=('Eyes open', 'Eyes closed', 'PASAT run 1', 'PASAT run 2'),
-        replace=True,
-        section=section,
-        tags=('raw')
+    if figures is not None:
+        with profiled('plot_psd'):
+            filt_plot = filt.plot_psd(fmin=freq_min, fmax=filt_freq_max, show=False)
+        figures['after filt'].append(filt_plot)
+    if qc_data is not None:
+        with profiled('qc_data'):
+            qc_data['after filt'] = qc_figures.psd_arrays(filt, freq_min, filt_freq_max)
+
+    return filt
+
+
+def add_figures_to_report(report, figures, tasks):
+    """Add the quality control figures of the filtering to a report.
+
+    Each recording gets its own entries, so that the figures of the recordings
+    that were up to date are kept in the report.
+
+    Parameters
+    ----------
+    report : instance of Report
+        The report to add the figures to.
+    figures : dict of list
+        The figures collected by `filter_recording`.
+    tasks : list of str
+        The tasks of the recordings the figures belong to.
+    """
+    section='Filtering'
+    for i, task in enumerate(tasks):
+        report.add_figure(
+            figures['before filt'][i],
+            title=f'{task}: Before frequency filtering',
+            replace=True,
+            section=section,
+            tags=(f'{task}', 'filt')
+        )
+        report.add_figure(
+            figures['after filt'][i],
+            title=f'{task}: After frequency filtering',
+            replace=True,
+            section=section,
+            tags=(f'{task}', 'filt')
+        )
+        report.add_figure(
+            figures['raw segment'][i],
+            title=f'{task}: Before interpolation',
+            replace=True,
+            section=section,
+            tags=(f'{task}', 'raw')
+        )
+        report.add_figure(
+            figures['interpolated segment'][i],
+            title=f'{task}: After interpolation',
+            replace=True,
+            section=section,
+            tags=(f'{task}', 'raw')
+        )
+
+
+def run_freqfilt(subject, force=False, qc='inline'):
+    """Filter all the recordings of a subject and save them.
+
+    Parameters
+    ----------
+    subject : str
+        The subject to process.
+    force : bool
+        Whether to process the recordings whose output is up to date.
+    qc : 'inline' | 'deferred' | 'off'
+        Whether to make the quality control figures now, to only save their
+        data for `qc.render_cohort`, or to skip them.
+
+    Returns
+    -------
+    processed_tasks : list of str
+        The tasks of the recordings that were (re)filtered.
+    """
+    # Along the way, we collect figures for quality control
+    figures = defaultdict(list)
+
+    # Not all subjects have files for all conditions. These functions grab the
+    # files that do exist for the subject.
+    exclude = ['emptyroom'] #these don't have eye blinks.
+    all_fnames = zip(
+        get_all_fnames(subject, kind='raw', exclude=exclude),
+        get_all_fnames(subject, kind='filt', exclude=exclude),
     )
-    report.save(fname.report_html(subject=args.subject),
-                overwrite=True, open_browser=False)
-
-with open('corrupted_subjects.txt', 'a') as file:
-    for bad_file in corrupted_raw_files:
-        file.write(bad_file+'\n')
-    file.close()
-
-# Calculate time that the script takes to run
-execution_time = (time.time() - start_time)
-print('\n###################################################\n')
-print(f'Execution time of 01_freqfilter.py is: {round(execution_time,2)} seconds\n')
-print('###################################################\n')
+
+    # Date and time
+    now = datetime.datetime.now()
+    date_time = now.strftime('%A, %d. %B %Y %I:%M%p')
+
+    corrupted_raw_files = []
+    # Recordings that were (re)filtered during this run
+    processed_tasks = []
+
+    for raw_fname, filt_fname in all_fnames:
+        bads, task = get_bads(subject, raw_fname)
+        # The file the filtered data is stored in (see intermediate.py)
+        filt_fname = intermediate.data_fname(filt_fname)
+
+        # Skip the recording if it has already been filtered using the same
+        # raw data, bad channels, parameters and code. The raw file is not
+        # hashed, as only its EEG channels are read.
+        fingerprint = compute_fingerprint(
+            params=dict(raw=file_stat(raw_fname), bads=sorted(bads), freq_min=freq_min,
+                        filt_freq_max=filt_freq_max, fnotch=fnotch,
+                        target_sfreq=target_sfreq),
+            code=[__file__, filtering.__file__, interpolation.__file__], previous=load_fingerprint(filt_fname))
+        if not force and is_up_to_date(filt_fname, fingerprint):
+            print(f'INFO: {filt_fname} is up to date, skipping it.')
+            continue
+
+        try:
+            with profiled('read_raw_fif', recording=task):
+                raw = read_recording(raw_fname)
+        except NameError as e:
+            raise NameError(f'Subject {subject} does not exist') from e
+        except (IOError, ValueError) as error:
+            corrupted_raw_files.append(subject)
+            print(f'Error: {error}')
+            continue
+
+        # Reduce logging level (technically, one could define it in the read_raw_fif function, but it seems to be buggy)
+        # More info about the bug can be found here: https://github.com/mne-tools/mne-python/issues/8872
+        set_log_level(verbose='Warning')
+
+        qc_data = dict(kind='filtering', task=task, date_time=date_time) if qc == 'deferred' else None
+        with profiled('filter_recording', recording=task):
+            filt = filter_recording(raw, bads, task, date_time=date_time,
+                                    figures=figures if qc == 'inline' else None,
+                                    qc_data=qc_data)
+        if qc_data is not None:
+            qc_figures.save_qc_data(subject, f'filtering_{task}', qc_data)
+
+        # Save the filtered data
+        with profiled('save', recording=task):
+            intermediate.save_raw(filt, filt_fname)
+        save_fingerprint(filt_fname, fingerprint)
+        processed_tasks.append(task)
+
+        raw.close()
+
+    # Write HTML report with the quality control figures
+    if processed_tasks and qc == 'inline':
+        add_figures_to_report(reports.get_report(subject), figures, processed_tasks)
+        reports.save_report(subject)
+
+    with open('corrupted_subjects.txt', 'a') as file:
+        for bad_file in corrupted_raw_files:
+            file.write(bad_file+'\n')
+        file.close()
+
+    return processed_tasks
+
+
+if __name__ == '__main__':
+    # Save time of beginning of the execution to measure running time
+    start_time = time.time()
+
+    # Deal with command line arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('subject', help='The subject to process')
+    parser.add_argument('--force', action='store_true', help='Process all recordings, also the ones whose output is up to date. Default: False', default=False)
+    parser.add_argument('--qc', choices=qc_figures.qc_modes, help='Make the quality control figures now, save their data to render them later with qc.py, or skip them. Default: inline', default='inline')
+    args = parser.parse_args()
+
+    run_freqfilt(args.subject, force=args.force, qc=args.qc)
+
+    # Calculate time that the script takes to run
+    execution_time = (time.time() - start_time)
+    print('\n###################################################\n')
+    print(f'Execution time of 01_freqfilter.py is: {round(execution_time,2)} seconds\n')
+    print('###################################################\n')
@@ -5,15 +5,16 @@ Remove EOG & ECG artifacts through independant component analysis (ICA).
 Running: 
 import subprocess
 subprocess.run('/net/tera2/home/aino/work/mtbi-eeg/python/processing/eeg/runall.sh', shell=True)
+
+The step can also be imported and run for a subject with `run_ica`.
 """
 
 import argparse
-from collections import defaultdict
+import csv
 
+from h5io import read_hdf5, write_hdf5
 from mne import Epochs, set_log_level
-from mne.io import read_raw_fif
-from mne.preprocessing import create_eog_epochs, create_ecg_epochs, ICA
-from mne import open_report
+from mne.preprocessing import find_eog_events, find_ecg_events, read_ica
 import datetime
 import time
 import os
@@ -21,120 +22,536 @@ import sys
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(parent_dir)
-from config_eeg import get_all_fnames, task_from_fname, fname, ecg_channel
+from config_eeg import get_all_fnames, task_from_fname, ecg_channel
+from config_common import n_cores
+from fingerprint import compute_fingerprint, is_up_to_date, load_fingerprint, save_fingerprint
+from profiling import profiled
+# The fitting lives in its own module, so that its fingerprint does not change
+# with the rest of this step
+from ica_fitting import (ica_fit_settings, fit_ica, compute_fit_fingerprint,
+                         load_fitted_ica, save_fitted_ica, fit_recordings)
+import intermediate
+import qc as qc_figures
+import reports
 
+# The tasks without eye blinks, for which no EOG events are looked for
+eog_skip_tasks = ['ec']
 
-# Save time of beginning of the execution to measure running time
-start_time = time.time()
+# How the EOG and ECG events are found and epoched, the same as
+# create_eog_epochs and create_ecg_epochs do
+artifact_event_params = dict(
+    eog=dict(event_id=998, l_freq=1, h_freq=10, tmin=-0.5, tmax=0.5),
+    ecg=dict(event_id=999, l_freq=8, h_freq=16, tmin=-0.5, tmax=0.5),
+)
 
-# Deal with command line arguments
-parser = argparse.ArgumentParser(description=__doc__)
-parser.add_argument('subject', help='The subject to process')
-args = parser.parse_args()
 
-# Along the way, we collect figures for quality control
-figures = defaultdict(list)
+def find_artifact_events(raw_filt, task):
+    """Find the onsets of the eye blinks (EOG) and heartbeats (ECG).
 
-# Not all subjects have files for all conditions. These functions grab the
-# files that do exist for the subject.
-exclude = ['emptyroom'] #these don't have eye blinks.
-bad_subjects = ['01P', '02P', '03P', '04P', '05P', '06P', '07P']#these ica need to be done manually
-all_fnames = zip(
-    get_all_fnames(args.subject, kind='filt', exclude=exclude),
-    get_all_fnames(args.subject, kind='ica', exclude=exclude),
-    get_all_fnames(args.subject, kind='clean', exclude=exclude),
-)
+    Parameters
+    ----------
+    raw_filt : instance of Raw
+        The filtered data.
+    task : str
+        The task of the recording. No EOG events are looked for in the tasks
+        in `eog_skip_tasks`.
 
-for filt_fname, ica_fname, clean_fname in all_fnames:
-    task = task_from_fname(filt_fname)
-    #TODO: crop first and last 2-5 s
-    raw_filt = read_raw_fif(filt_fname, preload=True)
-    
-    # Reduce logging level (technically, one could define it in the read_raw_fif function, but it seems to be buggy)
-    # More info about the bug can be found here: https://github.com/mne-tools/mne-python/issues/8872
-    set_log_level(verbose='Warning')
-
-    # Run a detection algorithm for the onsets of eye blinks (EOG) and heartbeat artefacts (ECG)
-    eog_events = create_eog_epochs(raw_filt)
-    #TODO: skip eog events for ec
+    Returns
+    -------
+    events : dict
+        The EOG and ECG events (under 'eog' and 'ecg'). None if they were not
+        looked for, or if there is no ECG channel.
+    """
+    events = dict(eog=None, ecg=None)
+    if task not in eog_skip_tasks:
+        params = artifact_event_params['eog']
+        with profiled('find_eog_events'):
+            events['eog'] = find_eog_events(raw_filt, event_id=params['event_id'],
+                                            l_freq=params['l_freq'], h_freq=params['h_freq'])
     if ecg_channel in raw_filt.info['ch_names']:
-                        ecg_events = create_ecg_epochs(raw_filt)
-                        ecg_exists = True
-    else:
-        ecg_exists = False
+        params = artifact_event_params['ecg']
+        with profiled('find_ecg_events'):
+            events['ecg'] = find_ecg_events(raw_filt, event_id=params['event_id'],
+                                            l_freq=params['l_freq'], h_freq=params['h_freq'])[0]
+    return events
+
+
+def compute_events_fingerprint(files, events_fname, task, params=None, code=None):
+    """Compute the fingerprint of what the EOG and ECG events depend on.
+
+    Parameters
+    ----------
+    files : list of str | list of Path
+        The data the events are found in.
+    events_fname : str | Path
+        The file the events are saved to.
+    task : str
+        The task of the recording.
+    params : dict | None
+        Parameters of the steps that made the data, if the data is not read
+        from a file of its own.
+    code : list of str | None
+        The source files of those steps.
+
+    Returns
+    -------
+    fingerprint : dict
+        The fingerprint, see `compute_fingerprint`.
+    """
+    params = dict(params or dict(), ecg_channel=ecg_channel, find_eog=task not in eog_skip_tasks,
+                  **artifact_event_params)
+    return compute_fingerprint(files=files, params=params, code=[__file__] + list(code or []),
+                               previous=load_fingerprint(events_fname))
+
+
+def get_artifact_events(raw_filt, task, events_fname, fingerprint, force=False):
+    """Read the EOG and ECG events of a recording, or find and save them.
+
+    The saved events are used if they were found in the same data with the
+    same parameters, see `compute_events_fingerprint`.
+
+    Parameters
+    ----------
+    raw_filt : instance of Raw
+        The filtered data.
+    task : str
+        The task of the recording.
+    events_fname : str | Path
+        The file the events are saved to.
+    fingerprint : dict
+        The fingerprint of the events.
+    force : bool
+        Whether to find the events again, also when the saved ones are up to
+        date.
+
+    Returns
+    -------
+    events : dict
+        The events, see `find_artifact_events`.
+    """
+    if not force and is_up_to_date(events_fname, fingerprint):
+        try:
+            return read_hdf5(events_fname)
+        except (IOError, ValueError):
+            # A broken file is replaced by finding the events again
+            pass
+    events = find_artifact_events(raw_filt, task)
+    os.makedirs(os.path.dirname(events_fname), exist_ok=True)
+    write_hdf5(events_fname, events, overwrite=True)
+    save_fingerprint(events_fname, fingerprint)
+    return events
+
+
+def create_artifact_epochs(raw_filt, events):
+    """Epoch the data around the EOG and ECG events.
+
+    Returns
+    -------
+    epochs : dict
+        The EOG and ECG epochs (under 'eog' and 'ecg'). None if there are no
+        events.
+    """
+    epochs = dict()
+    for kind, kind_events in events.items():
+        if kind_events is None or len(kind_events) == 0:
+            epochs[kind] = None
+            continue
+        params = artifact_event_params[kind]
+        epochs[kind] = Epochs(raw_filt, kind_events, event_id=params['event_id'],
+                              tmin=params['tmin'], tmax=params['tmax'], proj=False,
+                              baseline=None, preload=True)
+    return epochs
+
+
+def clean_recording(raw_filt, events, fit_settings=ica_fit_settings, init_ica=None, ica=None):
+    """Remove the EOG and ECG artifacts from a recording using ICA.
+
+    Parameters
+    ----------
+    raw_filt : instance of Raw
+        The filtered data. The artifact components are removed from it
+        in-place.
+    events : dict
+        The EOG and ECG events, see `find_artifact_events`.
+    fit_settings : dict
+        How to fit the ICA, see `fit_ica`.
+    init_ica : instance of ICA | None
+        With a warm start, the ICA of the first recording of the subject.
+    ica : instance of ICA | None
+        An ICA that was already fitted to this data (see `load_fitted_ica`).
+        If given, only the artifact components are looked for again.
+
+    Returns
+    -------
+    ica : instance of ICA
+        The fitted ICA, with the artifact components marked for exclusion.
+    raw_ica : instance of Raw
+        The cleaned data.
+    artifacts : dict
+        The EOG and ECG epochs (None if there are none), their averages and
+        the components (and their scores) that were found to capture the
+        artifacts, used for quality control, and the time the ICA fit took
+        (None if no fit was done).
+    """
+    # Epochs around the onsets of eye blinks (EOG) and heartbeat artefacts
+    # (ECG). The same epochs are used to find the artifact components and for
+    # the report.
+    with profiled('create_artifact_epochs'):
+        epochs = create_artifact_epochs(raw_filt, events)
+    eog_events, ecg_events = epochs['eog'], epochs['ecg']
     # Perform ICA decomposition
-    ica = ICA(n_components=0.99, random_state=0).fit(raw_filt)
+    fit_seconds = None
+    if ica is None:
+        with profiled('ica_fit'):
+            fit_start = time.perf_counter()
+            ica = fit_ica(raw_filt, **fit_settings, init_ica=init_ica)
+            fit_seconds = time.perf_counter() - fit_start
 
     # Find components that are likely capturing EOG artifacts
-    
-    bads_eog, scores_eog = ica.find_bads_eog(raw_filt)
-    print('Bads EOG:', bads_eog)
-    try:
-        bads_ecg, scores_ecg = ica.find_bads_ecg(raw_filt, method='correlation',threshold='auto')
-    except ValueError:
-        print('Not able to find ecg components')
-        bads_ecg = []
-        scores_ecg = []
+    with profiled('find_bads'):
+        bads_eog, scores_eog = [], []
+        if eog_events is not None:
+            bads_eog, scores_eog = ica.find_bads_eog(eog_events)
+        print('Bads EOG:', bads_eog)
+        bads_ecg, scores_ecg = [], []
+        if ecg_events is not None:
+            try:
+                bads_ecg, scores_ecg = ica.find_bads_ecg(ecg_events, method='correlation',threshold='auto')
+            except ValueError:
+                print('Not able to find ecg components')
     # Mark the EOG components for removal
     ica.exclude = bads_eog + bads_ecg
-    ica.save(ica_fname, overwrite=True) 
 
     # Remove the EOG artifact components from the signal.
-    raw_ica = ica.apply(raw_filt)
-    raw_ica.save(clean_fname, overwrite=True)
+    with profiled('ica_apply'):
+        raw_ica = ica.apply(raw_filt)
+
+    artifacts = dict(eog_events=eog_events, bads_eog=bads_eog, scores_eog=scores_eog,
+                     ecg_events=ecg_events, bads_ecg=bads_ecg, scores_ecg=scores_ecg,
+                     eog_evoked=None if eog_events is None else eog_events.average(),
+                     ecg_evoked=None if ecg_events is None else ecg_events.average(),
+                     fit_seconds=fit_seconds)
+    return ica, raw_ica, artifacts
+
+
+def log_convergence(subject, task, ica, fit_seconds, init_ica=None,
+                    filename='ica_convergence.csv'):
+    """Report the iterations and the time the ICA fit of a recording took.
+
+    For a warm-started fit, the time saved is estimated from the iterations
+    the (cold) fit of the first recording needed.
+
+    Parameters
+    ----------
+    subject : str
+        The subject.
+    task : str
+        The task of the recording.
+    ica : instance of ICA
+        The fitted ICA.
+    fit_seconds : float
+        The time the fit took.
+    init_ica : instance of ICA | None
+        The ICA the fit was started from, if any.
+    filename : str
+        The CSV file the report is appended to.
+    """
+    row = dict(subject=subject, task=task, method=ica.method, n_components=ica.n_components_,
+               warm_start=init_ica is not None, n_iter=ica.n_iter_,
+               fit_seconds=round(fit_seconds, 2), first_n_iter='', estimated_saved_seconds='')
+    message = f'INFO: ICA of {task}: {ica.n_iter_} iterations in {fit_seconds:.1f} s'
+    if init_ica is not None and getattr(init_ica, 'n_iter_', None):
+        saved = fit_seconds / ica.n_iter_ * (init_ica.n_iter_ - ica.n_iter_)
+        row.update(first_n_iter=init_ica.n_iter_, estimated_saved_seconds=round(saved, 2))
+        message += (f' (warm start; the first recording needed {init_ica.n_iter_} '
+                    f'iterations, about {saved:.1f} s saved)')
+    print(message)
+
+    new_file = not os.path.exists(filename)
+    with open(filename, 'a', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(row))
+        if new_file:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def save_ica_qc_data(subject, task, ica_fname, artifacts, date_time=''):
+    """Save what `add_ica_to_report` needs, to render the figures later.
+
+    The ICA itself is read back from its file.
+
+    Parameters
+    ----------
+    subject : str
+        The subject the recording belongs to.
+    task : str
+        The task of the recording.
+    ica_fname : str | Path
+        The file the fitted ICA was saved to.
+    artifacts : dict
+        The EOG and ECG information returned by `clean_recording`.
+    date_time : str
+        Date and time to put in the figure titles.
+    """
+    name = f'ica_{task}'
+    qc_data = dict(kind='ica', task=task, date_time=date_time, ica_fname=str(ica_fname),
+                   bads_eog=artifacts['bads_eog'], scores_eog=artifacts['scores_eog'],
+                   bads_ecg=artifacts['bads_ecg'], scores_ecg=artifacts['scores_ecg'],
+                   eog_evoked_fname=qc_figures.save_qc_evoked(
+                       subject, f'{name}_eog', artifacts['eog_evoked']),
+                   ecg_evoked_fname=qc_figures.save_qc_evoked(
+                       subject, f'{name}_ecg', artifacts['ecg_evoked']))
+    qc_figures.save_qc_data(subject, name, qc_data)
+
 
-    # Date and time
-    now = datetime.datetime.now()
-    date_time = now.strftime('%A, %d. %B %Y %I:%M%p')
+def add_ica_to_report(report, ica, raw, task, artifacts, date_time=''):
+    """Put a whole lot of quality control figures of the ICA in a report.
 
-    # Put a whole lot of quality control figures in the HTML report.
-    with open_report(fname.report(subject=args.subject)) as report:
-        if len(bads_eog)>0:
+    Parameters
+    ----------
+    report : instance of Report
+        The report to add the figures to.
+    ica : instance of ICA
+        The fitted ICA.
+    raw : instance of Raw | None
+        The data the ICA was applied to. If None, the figures that need the
+        data (e.g. the component properties) are left out.
+    task : str
+        The task of the recording.
+    artifacts : dict
+        The EOG and ECG information returned by `clean_recording`. Only the
+        averages of the epochs are used.
+    date_time : str
+        Date and time to put in the figure titles.
+    """
+    eog_evoked = artifacts['eog_evoked']
+    ecg_evoked = artifacts['ecg_evoked']
+    if len(artifacts['bads_eog'])>0:
+        report.add_ica(ica=ica, 
+                        title=f' {task}' + ' EOG', 
+                        inst=raw, 
+                        picks=artifacts['bads_eog'],
+                        eog_evoked=eog_evoked,
+                        eog_scores=artifacts['scores_eog'],
+                        tags=(f'{task}', 'EOG', 'ICA'),
+                        replace=True
+                        )
+    if ecg_evoked is not None:
+        if len(artifacts['bads_ecg'])>0:
             report.add_ica(ica=ica, 
-                            title=f' {task}' + ' EOG', 
-                            inst=raw_filt, 
-                            picks=bads_eog,
-                            eog_evoked=eog_events.average(),
-                            eog_scores=scores_eog,
-                            tags=(f'{task}', 'EOG', 'ICA'),
+                            title=f' {task}' + ' ECG', 
+                            inst=raw, 
+                            picks=artifacts['bads_ecg'],
+                            ecg_evoked=ecg_evoked,
+                            ecg_scores=artifacts['scores_ecg'],
+                            tags=(f'{task}', 'ECG', 'ICA'),
                             replace=True
                             )
-        if ecg_exists:
-            if len(bads_ecg)>0:
-                report.add_ica(ica=ica, 
-                                title=f' {task}' + ' ECG', 
-                                inst=raw_filt, 
-                                picks=bads_ecg,
-                                ecg_evoked=ecg_events.average(),
-                                ecg_scores=scores_ecg,
-                                tags=(f'{task}', 'ECG', 'ICA'),
-                                replace=True
-                                )
 
+    if eog_evoked is not None:
         report.add_figure(
-            ica.plot_overlay(eog_events.average(), title=date_time, show=False),
+            ica.plot_overlay(eog_evoked, title=date_time, show=False),
             f'{task}: EOG overlay', replace=True, tags=(f'{task}', 'ICA', 'EOG', 'overlay'))
-        
-        if ecg_exists:
-
-            
-            report.add_figure(
-                ica.plot_overlay(ecg_events.average(), title=date_time, show=False),
-                f'{task}: ECG overlay', replace=True, tags=(f'{task}', 'ICA', 'ECG', 'overlay'))
-            
-
-        report.save(fname.report_html(subject=args.subject),
-                    overwrite=True, open_browser=False)
-    
-    with open("ecg_missing.txt", "a") as file:
-        file_name = task_from_fname(filt_fname)
-        if not ecg_exists:
-            print(f'{args.subject}: no ECG found') 
-            file.write(str(args.subject)+file_name+'\n')
-        file.close()
-
-# Calculate time that the script takes to run
-execution_time = (time.time() - start_time)
-print('\n###################################################\n')
-print(f'Execution time of 02_ica.py is: {round(execution_time,2)} seconds\n')
-print('###################################################\n')
+
+    if ecg_evoked is not None:
+        report.add_figure(
+            ica.plot_overlay(ecg_evoked, title=date_time, show=False),
+            f'{task}: ECG overlay', replace=True, tags=(f'{task}', 'ICA', 'ECG', 'overlay'))
+
+
+def fit_subject_icas(subject, all_fnames, force=False, n_jobs=1, n_cores=None):
+    """Fit the ICAs of the recordings of a subject in parallel.
+
+    Only the ICAs that are not up to date are fitted. With a warm start, the
+    ICA of the first recording is fitted first, as the others start from it.
+
+    Parameters
+    ----------
+    subject : str
+        The subject.
+    all_fnames : list of tuple
+        The filtered data, ICA, EOG/ECG events and cleaned data files of each
+        recording, as in `run_ica`.
+    force : bool
+        Whether to also fit the ICAs that are up to date.
+    n_jobs : int
+        Maximum number of recordings fitted in parallel.
+    n_cores : int | None
+        The number of cores the workers may use together, see
+        blas_threads.py.
+
+    Returns
+    -------
+    fitted_tasks : list of str
+        The tasks of the recordings whose ICA was fitted.
+    """
+    warm_start = ica_fit_settings['warm_start']
+    first_ica_fname = all_fnames[0][1]
+    fitted_tasks = []
+    init_ica = None
+    for group in ([all_fnames[:1], all_fnames[1:]] if warm_start else [all_fnames]):
+        recordings, tasks = [], []
+        for filt_fname, ica_fname, _, _ in group:
+            task = task_from_fname(filt_fname)
+            filt_fname = intermediate.data_fname(filt_fname)
+            warm = warm_start and ica_fname != first_ica_fname and os.path.exists(first_ica_fname)
+            init_ica_fname = first_ica_fname if warm else None
+            fingerprint = compute_fit_fingerprint([filt_fname], ica_fname,
+                                                  init_ica_fname=init_ica_fname)
+            if force or not is_up_to_date(ica_fname, fingerprint, key='fit'):
+                recordings.append((filt_fname, ica_fname, fingerprint, init_ica_fname))
+                tasks.append(task)
+        with profiled('ica_fit_parallel'):
+            fits = fit_recordings(recordings, n_jobs=n_jobs, n_cores=n_cores)
+        for task, (ica, fit_seconds), recording in zip(tasks, fits, recordings):
+            if recording[3] is not None and init_ica is None:
+                init_ica = read_ica(recording[3])
+            log_convergence(subject, task, ica, fit_seconds, None if recording[3] is None else init_ica)
+        fitted_tasks += tasks
+    return fitted_tasks
+
+
+def run_ica(subject, force=False, qc='inline', n_jobs=1, n_cores=None):
+    """Remove the EOG and ECG artifacts from all the recordings of a subject.
+
+    Parameters
+    ----------
+    subject : str
+        The subject to process.
+    force : bool
+        Whether to process the recordings whose output is up to date.
+    qc : 'inline' | 'deferred' | 'off'
+        Whether to make the quality control figures now, to only save their
+        data for `qc.render_cohort`, or to skip them.
+    n_jobs : int
+        Maximum number of recordings whose ICA is fitted in parallel, see
+        `fit_subject_icas`. The components are classified and removed one
+        recording at a time.
+    n_cores : int | None
+        The number of cores the parallel fits may use together.
+
+    Returns
+    -------
+    processed_tasks : list of str
+        The tasks of the recordings that were (re)cleaned.
+    """
+    # Not all subjects have files for all conditions. These functions grab the
+    # files that do exist for the subject.
+    exclude = ['emptyroom'] #these don't have eye blinks.
+    all_fnames = list(zip(
+        get_all_fnames(subject, kind='filt', exclude=exclude),
+        get_all_fnames(subject, kind='ica', exclude=exclude),
+        get_all_fnames(subject, kind='eog_ecg_events', exclude=exclude),
+        get_all_fnames(subject, kind='clean', exclude=exclude),
+    ))
+    processed_tasks = []
+
+    # With a warm start, the ICA of the later recordings is started from the
+    # ICA of the first one
+    warm_start = ica_fit_settings['warm_start']
+    first_ica_fname = all_fnames[0][1] if all_fnames else None
+    init_ica = None
+
+    # The ICAs fitted in parallel beforehand are reused below
+    fitted_tasks = []
+    if n_jobs > 1 and all_fnames:
+        fitted_tasks = fit_subject_icas(subject, all_fnames, force, n_jobs, n_cores)
+
+    for i, (filt_fname, ica_fname, events_fname, clean_fname) in enumerate(all_fnames):
+        task = task_from_fname(filt_fname)
+        # The files the filtered and cleaned data are stored in (see
+        # intermediate.py)
+        filt_fname = intermediate.data_fname(filt_fname)
+        clean_fname = intermediate.data_fname(clean_fname)
+        warm = warm_start and i > 0 and os.path.exists(first_ica_fname)
+
+        # The ICA can be reused if it was fitted to the same filtered data
+        # (and initial ICA) with the same parameters and fitting code.
+        fit_fingerprint = compute_fit_fingerprint(
+            files=[filt_fname], ica_fname=ica_fname,
+            init_ica_fname=first_ica_fname if warm else None)
+        events_fingerprint = compute_events_fingerprint([filt_fname], events_fname, task)
+
+        # Skip the recording if it has already been cleaned using the same
+        # ICA fit, EOG and ECG events, parameters and code.
+        fingerprint = compute_fingerprint(
+            files=[filt_fname],
+            params=dict(fit=fit_fingerprint['hash'], events=events_fingerprint['hash']),
+            code=__file__, previous=load_fingerprint(clean_fname))
+        if not force and is_up_to_date(clean_fname, fingerprint):
+            print(f'INFO: {clean_fname} is up to date, skipping it.')
+            continue
+
+        #TODO: crop first and last 2-5 s
+        with profiled('read_raw_fif', recording=task):
+            raw_filt = intermediate.read_raw(filt_fname)
+
+        # Reduce logging level (technically, one could define it in the read_raw_fif function, but it seems to be buggy)
+        # More info about the bug can be found here: https://github.com/mne-tools/mne-python/issues/8872
+        set_log_level(verbose='Warning')
+
+        events = get_artifact_events(raw_filt, task, events_fname, events_fingerprint, force)
+        ica = None
+        if not force or task in fitted_tasks:
+            ica = load_fitted_ica(ica_fname, fit_fingerprint)
+        if ica is not None and task not in fitted_tasks:
+            print(f'INFO: Reusing the ICA fitted to {task} ({ica_fname}).')
+        elif warm and init_ica is None:
+            init_ica = read_ica(first_ica_fname)
+        with profiled('clean_recording', recording=task):
+            ica, raw_ica, artifacts = clean_recording(raw_filt, events, init_ica=init_ica if warm else None,
+                                                      ica=ica)
+        if artifacts['fit_seconds'] is not None:
+            log_convergence(subject, task, ica, artifacts['fit_seconds'], init_ica if warm else None)
+        if i == 0:
+            init_ica = ica
+        with profiled('save', recording=task):
+            save_fitted_ica(ica, ica_fname, fit_fingerprint)
+            intermediate.save_raw(raw_ica, clean_fname)
+        save_fingerprint(clean_fname, fingerprint)
+        processed_tasks.append(task)
+
+        # Date and time
+        now = datetime.datetime.now()
+        date_time = now.strftime('%A, %d. %B %Y %I:%M%p')
+
+        # Put a whole lot of quality control figures in the HTML report.
+        if qc == 'inline':
+            with profiled('report_ica', recording=task):
+                add_ica_to_report(reports.get_report(subject), ica, raw_filt, task, artifacts, date_time)
+        elif qc == 'deferred':
+            with profiled('qc_data', recording=task):
+                save_ica_qc_data(subject, task, ica_fname, artifacts, date_time)
+
+        with open("ecg_missing.txt", "a") as file:
+            if artifacts['ecg_events'] is None:
+                print(f'{subject}: no ECG found') 
+                file.write(str(subject)+task+'\n')
+            file.close()
+
+    # Write the report once, with the figures of all the recordings
+    reports.save_report(subject)
+
+    return processed_tasks
+
+
+if __name__ == '__main__':
+    # Save time of beginning of the execution to measure running time
+    start_time = time.time()
+
+    # Deal with command line arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('subject', help='The subject to process')
+    parser.add_argument('--force', action='store_true', help='Process all recordings, also the ones whose output is up to date. Default: False', default=False)
+    parser.add_argument('--qc', choices=qc_figures.qc_modes, help='Make the quality control figures now, save their data to render them later with qc.py, or skip them. Default: inline', default='inline')
+    parser.add_argument('--n_jobs', type=int, help='Number of recordings whose ICA is fitted in parallel. Default: 1', default=1)
+    parser.add_argument('--n_cores', type=int, help='Number of cores the parallel fits may use together, split between them as BLAS threads. Default: as defined in config_common.py, or all the cores', default=n_cores)
+    args = parser.parse_args()
+
+    run_ica(args.subject, force=args.force, qc=args.qc, n_jobs=args.n_jobs, n_cores=args.n_cores)
+
+    # Calculate time that the script takes to run
+    execution_time = (time.time() - start_time)
+    print('\n###################################################\n')
+    print(f'Execution time of 02_ica.py is: {round(execution_time,2)} seconds\n')
+    print('###################################################\n')
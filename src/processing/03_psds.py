@@ -5,15 +5,16 @@ Running:
 import subprocess
 subprocess.run('/net/tera2/home/aino/work/mtbi-eeg/python/processing/eeg/runall.sh', shell=True)
 
+The step can also be imported and run for a subject with `run_psds`.
 """
 
 import argparse
 
-from mne.io import read_raw_fif
+import numpy as np
 from mne.time_frequency import psd_array_welch
-from h5io import write_hdf5
 from mne.viz import iter_topography
-from mne import open_report, find_layout, pick_info, pick_types, set_log_level
+from mne import Annotations, find_layout, pick_info, pick_types, set_log_level
+from mne.io import BaseRaw
 import matplotlib.pyplot as plt
 import datetime
 import time
@@ -22,115 +23,445 @@ import sys
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(parent_dir)
-from config_eeg import fname, n_fft, get_all_fnames, task_from_fname, freq_max
-
-# Save time of beginning of the execution to measure running time
-start_time = time.time()
-
-# Deal with command line arguments
-parser = argparse.ArgumentParser(description=__doc__)
-parser.add_argument('subject', help='The subject to process')
-args = parser.parse_args()
-
-# Compute the PSD for each task
-psds = dict()
-
-# Not all subjects have files for all conditions. These functions grab the
-# files that do exist for the subject.
-exclude = ['emptyroom'] 
-bad_subjects = ['01P', '02P', '03P', '04P', '05P', '06P', '07P']#these ica need to be done manually
-all_fnames = zip(
-    get_all_fnames(args.subject, kind='psds', exclude=exclude),
-    get_all_fnames(args.subject, kind='clean', exclude=exclude),
-)
-
-for psds_fname, clean_fname in all_fnames:
-    task = task_from_fname(clean_fname)
-    run = 1
-    if '1' in task:
-        task_wo_run = task.removesuffix('_run1')
-    elif '2' in task:
-        task_wo_run = task.removesuffix('_run2')    
-        run = 2
-    else:
-        task_wo_run = task
-    
-    raw = read_raw_fif(fname.clean(subject=args.subject, task=task_wo_run, run=run,ses='01'),
-                       preload=True)
-    
-    # Reduce logging level (technically, one could define it in the read_raw_fif function, but it seems to be buggy)
-    # More info about the bug can be found here: https://github.com/mne-tools/mne-python/issues/8872
-    set_log_level(verbose='Warning')
-    
-    raw.info['bads']=[]
-    sfreq=raw.info['sfreq']
-    
-    if 'eo' in task or 'ec' in task:
-        clean_1 = raw.copy().crop(tmin=30, tmax=90)
-        clean_2 = raw.copy().crop(tmin=120, tmax=180)
-        clean_3 = raw.copy().crop(tmin=210, tmax=260)
-        psds[task+'_3'], freqs = psd_array_welch(clean_3.get_data(picks=['eeg']), sfreq=sfreq, 
-                                                 fmax=freq_max, n_fft=n_fft)
-
-    elif 'PASAT' in task:
-        clean_1 = raw.copy().crop(tmin=2, tmax=62)
-        clean_2 = raw.copy().crop(tmin=62, tmax=122)
-    
-    psds[task+'_1'], freqs = psd_array_welch(clean_1.get_data(picks=['eeg']), sfreq=sfreq,
-                                             fmax=freq_max, n_fft=n_fft)
-    psds[task+'_2'], freqs = psd_array_welch(clean_2.get_data(picks=['eeg']), sfreq=sfreq,
-                                             fmax=freq_max, n_fft=n_fft)
-    
-    
-    # Add some metadata to the file we are writing
-    psds['info'] = raw.info
-    psds['freqs'] = freqs
-    write_hdf5(fname.psds(subject=args.subject, ses='01'), psds, overwrite=True)
-
-# Add a PSD plot to the report.
-raw.pick_types(meg=False, eeg=True, eog=False, stim=False, ecg=False, exclude=[])
-info = pick_info(raw.info, sel=None)
-layout = find_layout(info, exclude=[])
-
-
-def on_pick(ax, ch_idx):
-    """Create a larger PSD plot for when one of the tiny PSD plots is
-       clicked."""
-    ax.plot(psds['freqs'], psds['ec_1'][ch_idx], color='C0',
-            label='eyes closed')
-    ax.plot(psds['freqs'], psds['eo_1'][ch_idx], color='C1',
-            label='eyes open')
-    ax.plot(psds['freqs'], psds['PASAT_run1_1'][ch_idx], color='C2',
-            label='pasat run 1')
-    ax.plot(psds['freqs'], psds['PASAT_run2_1'][ch_idx], color='C3',
-            label='pasat run 2')
-    ax.legend()
-    ax.set_xlabel('Frequency')
-    ax.set_ylabel('PSD')
-
-
-# Make the big topo figure
-fig = plt.figure(figsize=(14, 9))
-axes = iter_topography(info, layout, on_pick=on_pick, fig=fig,
-                       axis_facecolor='white', fig_facecolor='white',
-                       axis_spinecolor='white')
-for ax, ch_idx in axes:
-    handles = [
-        ax.plot(psds['freqs'], psds['ec_1'][ch_idx], color='C0'),
-        ax.plot(psds['freqs'], psds['eo_1'][ch_idx], color='C1'),
-        ax.plot(psds['freqs'], psds['PASAT_run1_1'][ch_idx], color='C2'),
-        ax.plot(psds['freqs'], psds['PASAT_run2_1'][ch_idx], color='C3'),
-    ]
-fig.legend(handles)
-
-
-with open_report(fname.report(subject=args.subject)) as report:
-    report.add_figure(fig, 'PSDs', replace=True)
-    report.save(fname.report_html(subject=args.subject),
-                overwrite=True, open_browser=False)
-
-# Calculate time that the script takes to run
-execution_time = (time.time() - start_time)
-print('\n###################################################\n')
-print(f'Execution time of 03_psds.py is: {round(execution_time,2)} seconds\n')
-print('###################################################\n')
+from config_eeg import (fname, n_fft, get_all_fnames, task_from_fname, freq_max, get_segments,
+                        psd_overlap, psd_reject_by_annotation, psd_streaming, psd_block_windows)
+from fingerprint import compute_fingerprint, is_up_to_date, load_fingerprint, save_fingerprint
+from profiling import profiled
+import intermediate
+import psds_io
+import qc as qc_figures
+import reports
+
+# The tasks in the PSD figure, and their labels
+plot_tasks = [('ec', 'eyes closed'), ('eo', 'eyes open'),
+              ('PASAT_run1', 'pasat run 1'), ('PASAT_run2', 'pasat run 2')]
+
+
+def segment_index(task):
+    """Describe the segments of a recording, to store them with the PSDs.
+
+    Returns
+    -------
+    index : dict
+        The task, tmin and tmax of each segment, by segment name.
+    """
+    return {name: dict(task=task, tmin=tmin, tmax=tmax)
+            for name, tmin, tmax in get_segments(task)}
+
+
+def task_segments(segments, task):
+    """Get the names of the segments of a recording.
+
+    Parameters
+    ----------
+    segments : dict
+        The index of the segments, see `segment_index` and
+        `psds_io.read_index`.
+    task : str
+        The task of the recording.
+
+    Returns
+    -------
+    names : list of str
+        The segments of the task.
+    """
+    return [name for name, segment in segments.items() if segment['task'] == task]
+
+
+def compute_psds(raw, task, n_fft=n_fft):
+    """Compute the PSDs of the segments of a recording.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The cleaned data.
+    task : str
+        The task of the recording, as returned by `task_from_fname`.
+    n_fft : int
+        The length of the Welch windows, in samples.
+
+    Returns
+    -------
+    psds : dict of ndarray
+        The PSD (channels x frequencies) of each segment. The keys are the
+        names of the segments in the segments table, e.g. ``PASAT_run1_2``.
+    freqs : ndarray
+        The frequencies of the PSDs.
+    """
+    raw.info['bads'] = []
+    annotations = raw.annotations
+    annotations = Annotations(annotations.onset - raw.first_time, annotations.duration,
+                              annotations.description)
+    return compute_psds_array(raw._data, raw.info, task, n_fft=n_fft, annotations=annotations)
+
+
+def _window_starts(start, stop, n_fft, step, bad_spans):
+    """Get the first samples of the Welch windows of a segment."""
+    starts = np.arange(start, stop - n_fft + 1, step)
+    for bad_start, bad_stop in bad_spans:
+        starts = starts[(starts + n_fft <= bad_start) | (starts >= bad_stop)]
+    return starts
+
+
+def segment_windows(n_times, sfreq, task, n_fft=n_fft, annotations=None):
+    """Get the Welch windows of the segments of a recording.
+
+    Parameters
+    ----------
+    n_times : int
+        The length of the recording, in samples.
+    sfreq : float
+        The sampling frequency.
+    task : str
+        The task of the recording. Its segments are taken from the segments
+        table, see `get_segments`.
+    n_fft : int
+        The length of the Welch windows, in samples.
+    annotations : instance of Annotations | None
+        The annotations, with their onsets relative to the first sample of
+        the recording. With ``psd_reject_by_annotation``, the windows
+        overlapping a 'bad' annotation are left out.
+
+    Returns
+    -------
+    windows : list of tuple
+        The name of each segment, and the first samples of its windows. The
+        windows overlap by ``psd_overlap``.
+    """
+    step = n_fft - int(round(psd_overlap * n_fft))
+    bad_spans = []
+    if psd_reject_by_annotation and annotations is not None:
+        bad_spans = [(int(round(onset * sfreq)), int(round((onset + duration) * sfreq)))
+                     for onset, duration, description in zip(
+                         annotations.onset, annotations.duration, annotations.description)
+                     if description.lower().startswith('bad')]
+
+    windows = []
+    for name, tmin, tmax in get_segments(task):
+        # The same samples as raw.crop(tmin, tmax), which includes tmax
+        start, stop = int(round(tmin * sfreq)), int(round(tmax * sfreq)) + 1
+        if stop > n_times:
+            raise ValueError(f'tmax ({tmax}) must be less than or equal to the '
+                             f'length of the {task} recording')
+        starts = _window_starts(start, stop, n_fft, step, bad_spans)
+        if len(starts) == 0:
+            raise ValueError(f'The segment {name} ({tmin}, {tmax}) of the {task} recording '
+                             f'has no Welch window of n_fft ({n_fft}) good samples')
+        windows.append((name, starts))
+    return windows
+
+
+def compute_psds_array(data, info, task, n_fft=n_fft, annotations=None):
+    """Compute the PSDs of the segments of a recording, given as an array.
+
+    Only the EEG channels of the segments are read from ``data``, so it can be
+    a memory-mapped array (see intermediate.py).
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_times)
+        The cleaned data.
+    info : instance of Info
+        The measurement info.
+    task : str
+        The task of the recording, as returned by `task_from_fname`.
+    n_fft : int
+        The length of the Welch windows, in samples.
+    annotations : instance of Annotations | None
+        The annotations, with their onsets relative to the first sample of
+        ``data``, see `segment_windows`.
+
+    Returns
+    -------
+    psds : dict of ndarray
+        The PSD (channels x frequencies) of each segment, by segment name.
+    freqs : ndarray
+        The frequencies of the PSDs.
+    """
+    psds = dict()
+    sfreq = info['sfreq']
+    # All EEG channels, also the ones that were marked as bad and interpolated
+    picks = pick_types(info, meg=False, eeg=True, exclude=[])
+    windows = segment_windows(data.shape[1], sfreq, task, n_fft=n_fft, annotations=annotations)
+
+    # Each Welch window is transformed on its own, so the windows of all the
+    # segments can be put side by side and transformed in a single call. The
+    # PSD of a segment is then the average over its own windows. Only the
+    # samples of the windows are copied, once.
+    segment_data = np.empty((len(picks), sum(len(starts) for _, starts in windows) * n_fft))
+    offset = 0
+    for _, starts in windows:
+        for start in starts:
+            segment_data[:, offset:offset + n_fft] = data[picks, start:start + n_fft]
+            offset += n_fft
+    window_psds, freqs = psd_array_welch(segment_data, sfreq=sfreq, fmax=freq_max,
+                                         n_fft=n_fft, average=None)
+    del segment_data
+
+    offset = 0
+    for name, starts in windows:
+        psds[name] = window_psds[..., offset:offset + len(starts)].mean(axis=-1)
+        offset += len(starts)
+    return psds, freqs
+
+
+def _blocks(starts, n_fft, block_size):
+    """Group the windows of a segment into blocks of at most ``block_size``
+    consecutive samples."""
+    first = 0
+    for i in range(1, len(starts) + 1):
+        if i == len(starts) or starts[i] + n_fft - starts[first] > block_size:
+            yield starts[first:i]
+            first = i
+
+
+def compute_psds_streaming(data, info, task, n_fft=n_fft, annotations=None,
+                           block_windows=psd_block_windows):
+    """Compute the PSDs of the segments of a recording, reading it in blocks.
+
+    The recording is read in blocks of at most ``block_windows`` Welch
+    windows. The periodograms of the windows of each block are added to the
+    sum of their segment, and the PSD of a segment is that sum divided by its
+    number of windows, as in `compute_psds_array`. The memory used is bounded
+    by the size of a block, not by the length of the recording.
+
+    Parameters
+    ----------
+    data : instance of Raw | ndarray, shape (n_channels, n_times)
+        The cleaned data: a Raw object that was read without preloading, or
+        a (memory-mapped) array, see `intermediate.open_data`.
+    info : instance of Info
+        The measurement info.
+    task : str
+        The task of the recording, as returned by `task_from_fname`.
+    n_fft : int
+        The length of the Welch windows, in samples.
+    annotations : instance of Annotations | None
+        The annotations, with their onsets relative to the first sample of
+        ``data``, see `segment_windows`.
+    block_windows : int
+        The number of Welch windows read at a time.
+
+    Returns
+    -------
+    psds : dict of ndarray
+        The PSD (channels x frequencies) of each segment, by segment name.
+    freqs : ndarray
+        The frequencies of the PSDs.
+    """
+    psds = dict()
+    sfreq = info['sfreq']
+    # All EEG channels, also the ones that were marked as bad and interpolated
+    picks = pick_types(info, meg=False, eeg=True, exclude=[])
+    n_times = data.n_times if isinstance(data, BaseRaw) else data.shape[1]
+    windows = segment_windows(n_times, sfreq, task, n_fft=n_fft, annotations=annotations)
+
+    for name, starts in windows:
+        psd_sum = 0.
+        for block_starts in _blocks(starts, n_fft, block_windows * n_fft):
+            start, stop = block_starts[0], block_starts[-1] + n_fft
+            if isinstance(data, BaseRaw):
+                block = data.get_data(picks, start=start, stop=stop)
+            else:
+                block = np.asarray(data[picks, start:stop], dtype=np.float64)
+            # The windows of the block, side by side
+            if len(block_starts) * n_fft != stop - start:
+                block = np.concatenate([block[:, window_start - start:window_start - start + n_fft]
+                                        for window_start in block_starts], axis=1)
+            window_psds, freqs = psd_array_welch(block, sfreq=sfreq, fmax=freq_max,
+                                                 n_fft=n_fft, average=None)
+            psd_sum = psd_sum + window_psds.sum(axis=-1)
+        psds[name] = psd_sum / len(starts)
+    return psds, freqs
+
+
+def plot_psds(psds, info):
+    """Make a topographic figure of the PSDs of the first segment of each task.
+
+    Parameters
+    ----------
+    psds : dict
+        The PSDs of all the tasks, as well as the 'freqs'.
+    info : instance of Info
+        The measurement info, used for the channel positions.
+
+    Returns
+    -------
+    fig : instance of Figure
+        The figure.
+    """
+    info = pick_info(info, sel=pick_types(info, meg=False, eeg=True, eog=False, stim=False, ecg=False, exclude=[]))
+    layout = find_layout(info, exclude=[])
+
+    # The first segment of each task
+    plotted = [(get_segments(task)[0][0], label) for task, label in plot_tasks]
+
+    def on_pick(ax, ch_idx):
+        """Create a larger PSD plot for when one of the tiny PSD plots is
+           clicked."""
+        for i, (name, label) in enumerate(plotted):
+            ax.plot(psds['freqs'], psds[name][ch_idx], color=f'C{i}', label=label)
+        ax.legend()
+        ax.set_xlabel('Frequency')
+        ax.set_ylabel('PSD')
+
+    # Make the big topo figure
+    fig = plt.figure(figsize=(14, 9))
+    axes = iter_topography(info, layout, on_pick=on_pick, fig=fig,
+                           axis_facecolor='white', fig_facecolor='white',
+                           axis_spinecolor='white')
+    for ax, ch_idx in axes:
+        handles = [ax.plot(psds['freqs'], psds[name][ch_idx], color=f'C{i}')
+                   for i, (name, _) in enumerate(plotted)]
+    fig.legend(handles)
+    return fig
+
+
+def save_psds_qc_data(subject, psds, info_fname):
+    """Save what `plot_psds` needs, to make the figure later.
+
+    Parameters
+    ----------
+    subject : str
+        The subject the PSDs belong to.
+    psds : dict
+        The PSDs of all the tasks, as well as the 'freqs'.
+    info_fname : str | Path
+        A recording of the subject, from which the measurement info is read.
+    """
+    # Only the first segment of each task is plotted
+    first_segments = [get_segments(task)[0][0] for task, _ in plot_tasks]
+    plotted = {key: value for key, value in psds.items()
+               if key == 'freqs' or key in first_segments}
+    qc_figures.save_qc_data(subject, 'psds', dict(kind='psds', psds=plotted,
+                                                  info_fname=str(info_fname)))
+
+
+def run_psds(subject, force=False, qc='inline', stream=psd_streaming):
+    """Compute the PSDs of all the recordings of a subject and save them.
+
+    Parameters
+    ----------
+    subject : str
+        The subject to process.
+    force : bool
+        Whether to process the recordings whose output is up to date.
+    qc : 'inline' | 'deferred' | 'off'
+        Whether to make the quality control figures now, to only save their
+        data for `qc.render_cohort`, or to skip them.
+    stream : bool
+        Whether to read the cleaned recordings in blocks instead of into
+        memory, see `compute_psds_streaming`.
+
+    Returns
+    -------
+    processed_tasks : list of str
+        The tasks of the recordings whose PSDs were (re)computed.
+    """
+    # Compute the PSD for each task
+    psds = dict()
+
+    # Not all subjects have files for all conditions. These functions grab the
+    # files that do exist for the subject.
+    exclude = ['emptyroom'] 
+    all_fnames = zip(
+        get_all_fnames(subject, kind='psds', exclude=exclude),
+        get_all_fnames(subject, kind='clean', exclude=exclude),
+    )
+
+    # The PSDs of all recordings are stored in the same file. The PSDs of the
+    # recordings that are up to date are taken from the existing file.
+    subject_psds = fname.psds(subject=subject, ses='01')
+    previous_segments = dict()
+    if not force and os.path.exists(subject_psds):
+        try:
+            previous_segments = psds_io.read_index(subject_psds)
+        except Exception:
+            print('Existing psds file could not be read, all recordings will be processed')
+    fingerprints = dict()
+    processed_tasks = []
+    segments = dict()
+
+    for psds_fname, clean_fname in all_fnames:
+        task = task_from_fname(clean_fname)
+
+        # Skip the recording if its PSDs have already been computed using the
+        # same cleaned data, parameters and code.
+        fingerprints[task] = compute_fingerprint(
+            files=[intermediate.data_fname(clean_fname)],
+            params=dict(n_fft=n_fft, freq_max=freq_max, segments=get_segments(task),
+                        psd_overlap=psd_overlap,
+                        psd_reject_by_annotation=psd_reject_by_annotation),
+            code=[__file__, psds_io.__file__], previous=load_fingerprint(subject_psds, key=task))
+        previous_task_segments = task_segments(previous_segments, task)
+        if (previous_task_segments and
+                is_up_to_date(subject_psds, fingerprints[task], key=task)):
+            print(f'INFO: PSDs of {task} are up to date, skipping it.')
+            with profiled('read_psds', recording=task):
+                psds.update(psds_io.read_psds(subject_psds, segments=previous_task_segments)[0])
+            segments.update({name: previous_segments[name] for name in previous_task_segments})
+            continue
+        processed_tasks.append(task)
+
+        with profiled('read_raw_fif', recording=task):
+            if stream:
+                data, info = intermediate.open_data(clean_fname)
+            else:
+                data, info = intermediate.read_data(clean_fname)
+            annotations = (intermediate.read_annotations(clean_fname)
+                           if psd_reject_by_annotation else None)
+
+        # Reduce logging level (technically, one could define it in the read_raw_fif function, but it seems to be buggy)
+        # More info about the bug can be found here: https://github.com/mne-tools/mne-python/issues/8872
+        set_log_level(verbose='Warning')
+
+        with profiled('welch', recording=task):
+            compute = compute_psds_streaming if stream else compute_psds_array
+            task_psds, freqs = compute(data, info, task, annotations=annotations)
+        psds.update(task_psds)
+        segments.update(segment_index(task))
+
+        psds['freqs'] = freqs
+
+    # The file is written once, also with the PSDs of the recordings that were
+    # up to date
+    if processed_tasks:
+        with profiled('write_psds'):
+            psds_io.write_psds(subject_psds, psds, freqs, info, segments)
+    for task in processed_tasks:
+        save_fingerprint(subject_psds, fingerprints[task], key=task)
+
+    # Add a PSD plot to the report, unless all recordings were up to date.
+    if not processed_tasks:
+        print('INFO: All PSDs are up to date.')
+    elif qc == 'deferred':
+        with profiled('qc_data'):
+            save_psds_qc_data(subject, psds, intermediate.info_fname(clean_fname))
+    elif qc == 'inline':
+        with profiled('plot_psds'):
+            fig = plot_psds(psds, info)
+        reports.get_report(subject).add_figure(fig, 'PSDs', replace=True)
+        reports.save_report(subject)
+
+    return processed_tasks
+
+
+if __name__ == '__main__':
+    # Save time of beginning of the execution to measure running time
+    start_time = time.time()
+
+    # Deal with command line arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('subject', help='The subject to process')
+    parser.add_argument('--force', action='store_true', help='Process all recordings, also the ones whose output is up to date. Default: False', default=False)
+    parser.add_argument('--qc', choices=qc_figures.qc_modes, help='Make the quality control figures now, save their data to render them later with qc.py, or skip them. Default: inline', default='inline')
+    parser.add_argument('--stream', action=argparse.BooleanOptionalAction, help='Read the cleaned recordings in blocks instead of into memory (--no-stream to read them into memory). Default: as defined in config_eeg.py', default=psd_streaming)
+    args = parser.parse_args()
+
+    run_psds(args.subject, force=args.force, qc=args.qc, stream=args.stream)
+
+    # Calculate time that the script takes to run
+    execution_time = (time.time() - start_time)
+    print('\n###################################################\n')
+    print(f'Execution time of 03_psds.py is: {round(execution_time,2)} seconds\n')
+    print('###################################################\n')
@@ -10,11 +10,12 @@ Calculates log band power (absolute) for each subject
 Running:
 import subprocess
 subprocess.run('/net/tera2/home/aino/work/mtbi-eeg/python/processing/eeg/runall.sh', shell=True)
+
+The step can also be imported and run for a subject with `run_bandpower`.
 """
 
 
 import argparse
-import h5py
 import numpy as np
 from pathlib import Path
 import time
@@ -24,82 +25,161 @@ import sys
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(parent_dir)
 from config_eeg import fname, thin_bands, wide_bands, processed_data_dir
+from fingerprint import compute_fingerprint, is_up_to_date, load_fingerprint, save_fingerprint
+from profiling import profiled
+import psds_io
 
-# Save time of beginning of the execution to measure running time
-start_time = time.time()
-
-# Deal with command line arguments
-parser = argparse.ArgumentParser(description=__doc__)
-parser.add_argument('subject', help='The subject to process')
-parser.add_argument('--freq_band_type', type=str, help="Define the frequency bands. 'thin' are 1hz bands from 1 to 40hz. 'wide' are conventional delta, theta, etc. Default is 'thin'.", default="thin")
+normalize_ch_power = False
 
-args = parser.parse_args()
 
-if args.freq_band_type == 'wide':
-    f_bands =  wide_bands  
-elif args.freq_band_type == 'thin':
-    f_bands = thin_bands
+def compute_bandpowers(data_arr, freqs, f_bands):
+    """Calculate the average power in each frequency band.
 
-normalize_ch_power = False
+    Parameters
+    ----------
+    data_arr : ndarray, shape (n_channels, n_freqs)
+        The PSD.
+    freqs : ndarray, shape (n_freqs,)
+        The frequencies of the PSD.
+    f_bands : list of tuple
+        The (fmin, fmax) of each frequency band.
 
-# A list for corruprted or missing psds files
-corrupted_psds_files = []
-
-subject_psds = fname.psds(subject=args.subject, ses='01')
-
-try:
-    f = h5py.File(subject_psds, 'r')
-except:
-    print("Psds file corrupted or missing")
-    corrupted_psds_files.append(args.subject)
-    
-psds_keys = list(f.keys())
-psds_data = f[psds_keys[0]]
-data_keys = list(psds_data)
-data = dict()
-
-# Add the data for each PSD to the dictionary 'data'
-for i in data_keys:
-    if 'eo' in i or 'ec' in i or 'PASAT' in i:
-        dict_key = i.removeprefix('key_')
-        data[dict_key] = np.array(psds_data[i])
-freqs = np.array(psds_data['key_freqs'])
-info_keys = list(psds_data['key_info'])
-
-f.close()
-
-# Create a directory to save the .csv files
-directory = f'{processed_data_dir}/sub-{args.subject}/ses-01/eeg/bandpowers'
-Path(directory).mkdir(parents=True, exist_ok=True)
-
-# Calculate the average bandpower for each PSD
-for data_obj in list(data.keys()):
+    Returns
+    -------
+    data_bandpower : list of ndarray
+        The bandpower of each channel, for each frequency band.
+    """
     data_bandpower = [] 
-    data_arr = data[data_obj]
-    
+
     if normalize_ch_power:
         ch_tot_powers = np.sum(data_arr, axis=1)
         data_arr = data_arr/ch_tot_powers[:, None]
-    
+
     for fmin, fmax in f_bands:           
         min_index = np.argmax(freqs > fmin) - 1
         max_index = np.argmax(freqs > fmax) - 1
 
         bandpower = np.mean(data_arr[:, min_index:max_index], axis=1)           
         data_bandpower.append(bandpower)
-    
-    # Save the calculated bandpowers
-    filename = f'{directory}/{args.freq_band_type}_{data_obj}.csv'
-    np.savetxt(filename, data_bandpower, delimiter=',')  
-
-with open('psds_corrupted_or_missing.txt', 'a') as file:
-    for bad_file in corrupted_psds_files:
-        file.write(bad_file + '\n')
-    file.close()
-
-    
-# Calculate time that the script takes to run
-execution_time = (time.time() - start_time)
-print('\n###################################################\n')
-print(f'Execution time of 04_bandpower.py for {args.freq_band_type} frequency bands is: {round(execution_time,2)} seconds\n')
-print('###################################################\n')
\ No newline at end of file
+    return data_bandpower
+
+
+def get_f_bands(freq_band_type):
+    """Get the frequency bands of the given type, 'thin' or 'wide'."""
+    if freq_band_type == 'wide':
+        return wide_bands
+    elif freq_band_type == 'thin':
+        return thin_bands
+    raise ValueError(f'Unknown freq_band_type: {freq_band_type}')
+
+
+def bandpower_dir(subject):
+    """Get the directory where the bandpower .csv files of a subject are saved."""
+    return f'{processed_data_dir}/sub-{subject}/ses-01/eeg/bandpowers'
+
+
+def save_bandpowers(subject, data, freqs, freq_band_type='thin'):
+    """Calculate the bandpowers of the PSDs of a subject and save them as .csv files.
+
+    Parameters
+    ----------
+    subject : str
+        The subject the PSDs belong to.
+    data : dict of ndarray
+        The PSD of each task segment (e.g. 'ec_1').
+    freqs : ndarray
+        The frequencies of the PSDs.
+    freq_band_type : 'thin' | 'wide'
+        The frequency bands to use.
+    """
+    f_bands = get_f_bands(freq_band_type)
+    directory = bandpower_dir(subject)
+    Path(directory).mkdir(parents=True, exist_ok=True)
+
+    # Calculate the average bandpower for each PSD
+    with profiled('bandpowers'):
+        for data_obj in list(data.keys()):
+            data_bandpower = compute_bandpowers(data[data_obj], freqs, f_bands)
+
+            # Save the calculated bandpowers
+            filename = f'{directory}/{freq_band_type}_{data_obj}.csv'
+            np.savetxt(filename, data_bandpower, delimiter=',')  
+
+
+def run_bandpower(subject, freq_band_type='thin', force=False):
+    """Calculate the bandpowers of all the PSDs of a subject and save them.
+
+    Parameters
+    ----------
+    subject : str
+        The subject to process.
+    freq_band_type : 'thin' | 'wide'
+        'thin' are 1hz bands from 1 to 43hz. 'wide' are conventional delta,
+        theta, etc.
+    force : bool
+        Whether to compute the bandpowers even if they are up to date.
+
+    Returns
+    -------
+    computed : bool
+        Whether the bandpowers were (re)computed.
+    """
+    f_bands = get_f_bands(freq_band_type)
+
+    # A list for corruprted or missing psds files
+    corrupted_psds_files = []
+
+    subject_psds = fname.psds(subject=subject, ses='01')
+
+    # The directory where the .csv files are saved
+    directory = bandpower_dir(subject)
+
+    # Skip the subject if the bandpowers have already been computed from the same
+    # PSDs, using the same frequency bands and code.
+    fingerprint = None
+    if os.path.exists(subject_psds):
+        fingerprint = compute_fingerprint(
+            files=[subject_psds],
+            params=dict(f_bands=f_bands, normalize_ch_power=normalize_ch_power),
+            code=__file__, previous=load_fingerprint(directory, key=freq_band_type))
+        if not force and is_up_to_date(directory, fingerprint, key=freq_band_type):
+            print(f'INFO: {freq_band_type} bandpowers of {subject} are up to date, skipping them.')
+            return False
+
+    try:
+        with profiled('read_psds'):
+            data, freqs = psds_io.read_psds(subject_psds)
+    except Exception:
+        print("Psds file corrupted or missing")
+        corrupted_psds_files.append(subject)
+        with open('psds_corrupted_or_missing.txt', 'a') as file:
+            for bad_file in corrupted_psds_files:
+                file.write(bad_file + '\n')
+            file.close()
+        return False
+
+    save_bandpowers(subject, data, freqs, freq_band_type)
+
+    if fingerprint is not None:
+        save_fingerprint(directory, fingerprint, key=freq_band_type)
+    return True
+
+
+if __name__ == '__main__':
+    # Save time of beginning of the execution to measure running time
+    start_time = time.time()
+
+    # Deal with command line arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('subject', help='The subject to process')
+    parser.add_argument('--freq_band_type', type=str, help="Define the frequency bands. 'thin' are 1hz bands from 1 to 40hz. 'wide' are conventional delta, theta, etc. Default is 'thin'.", default="thin")
+    parser.add_argument('--force', action='store_true', help='Compute the bandpowers even if they are up to date. Default: False', default=False)
+    args = parser.parse_args()
+
+    run_bandpower(args.subject, freq_band_type=args.freq_band_type, force=args.force)
+
+    # Calculate time that the script takes to run
+    execution_time = (time.time() - start_time)
+    print('\n###################################################\n')
+    print(f'Execution time of 04_bandpower.py for {args.freq_band_type} frequency bands is: {round(execution_time,2)} seconds\n')
+    print('###################################################\n')
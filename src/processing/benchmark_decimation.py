@@ -0,0 +1,269 @@
+"""
+Benchmark decimating the data after the low-pass filter (`target_sfreq` in
+config_eeg.py).
+
+Each recording of the subjects is read and filtered once. The filtered data is
+then cleaned with ICA, and its PSDs and bandpowers are computed, both at the
+acquisition rate ('full') and after decimating it to the target sampling
+frequency ('decimated'). With --scale_n_fft, the Welch windows of the
+decimated data have the same duration as those of the full data (the same
+frequency resolution); otherwise they have the same number of samples, as
+with `n_fft` in config_eeg.py.
+
+The PSDs and bandpowers are written to ``<output_dir>/<variant>`` in the same
+layout as in processed_data_dir, so that they can also be analysed with the scripts
+in src/analysis. The benchmark writes:
+
+- decimation_features.csv: for each frequency band type and task segment, the
+  correlation of the log bandpowers of the two variants and their median and
+  largest difference in dB.
+- decimation_auc.csv: for each task and frequency band type, the AUC of each
+  classifier (same 10-fold cross validation as 03_fit_classifier_and_plot.py)
+  for both variants.
+- decimation_timing.csv: the time the ICA and the PSDs took for each variant.
+
+Running:
+python benchmark_decimation.py --output_dir benchmark --target_sfreq 250 --n_jobs 4
+"""
+
+import argparse
+import csv
+import importlib
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from mne import set_log_level
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+sys.path.append(os.path.join(parent_dir, 'analysis'))
+from config_eeg import fname, get_all_fnames, task_from_fname, filt_freq_max, n_fft, target_sfreq
+import filtering
+import psds_io
+
+# Use importlib, as the module names start with a number
+freqfilt = importlib.import_module('01_freqfilt')
+ica_step = importlib.import_module('02_ica')
+psds_step = importlib.import_module('03_psds')
+bandpower = importlib.import_module('04_bandpower')
+
+variants = ['full', 'decimated']
+freq_band_types = ['thin', 'wide']
+tasks = ['eo', 'ec', 'PASAT_1', 'PASAT_2']
+
+
+def benchmark_subject(subject, output_dir, target_sfreq, scale_n_fft=False):
+    """Compute the bandpowers of a subject with and without decimation.
+
+    Parameters
+    ----------
+    subject : str
+        The subject.
+    output_dir : str
+        The PSDs and bandpowers of each variant are saved in
+        ``<output_dir>/<variant>``.
+    target_sfreq : float
+        The sampling frequency to decimate to.
+    scale_n_fft : bool
+        Whether to shorten the Welch windows of the decimated data, so that
+        they have the same duration as those of the full data.
+
+    Returns
+    -------
+    timings : list of dict
+        The time the ICA and the PSDs took, for each recording and variant.
+    """
+    set_log_level(verbose='Warning')
+    timings = []
+    segments = {variant: dict() for variant in variants}
+    index = {variant: dict() for variant in variants}
+    infos = dict()
+    exclude = ['emptyroom']
+    for raw_fname in get_all_fnames(subject, kind='raw', exclude=exclude):
+        bads, filt_task = freqfilt.get_bads(subject, raw_fname)
+        task = task_from_fname(raw_fname)
+        raw = freqfilt.read_recording(raw_fname)
+        filt = freqfilt.filter_recording(raw, bads, filt_task, target_sfreq=None)
+        factor = filtering.decimation_factor(filt.info['sfreq'], target_sfreq, filt_freq_max)
+
+        for variant in variants:
+            if variant == 'full':
+                data, variant_n_fft = filt.copy(), n_fft
+            else:
+                data = filtering.decimate_raw(filt, target_sfreq, filt_freq_max)
+                variant_n_fft = n_fft // factor if scale_n_fft else n_fft
+            start = time.perf_counter()
+            # The events are found in each variant, as their sample indices
+            # depend on the sampling frequency
+            events = ica_step.find_artifact_events(data, task)
+            _, raw_ica, _ = ica_step.clean_recording(data, events)
+            ica_s = time.perf_counter() - start
+            start = time.perf_counter()
+            task_psds, freqs = psds_step.compute_psds(raw_ica, task, n_fft=variant_n_fft)
+            welch_s = time.perf_counter() - start
+            segments[variant].update(task_psds)
+            index[variant].update(psds_step.segment_index(task))
+            infos[variant] = raw_ica.info
+            timings.append(dict(subject=subject, task=task, variant=variant,
+                                sfreq=raw_ica.info['sfreq'], n_fft=variant_n_fft,
+                                ica_s=round(ica_s, 2), welch_s=round(welch_s, 2)))
+            segments[variant]['freqs'] = freqs
+
+    for variant in variants:
+        freqs = segments[variant].pop('freqs')
+        # The PSD file holds the index of the segments read by the analysis
+        psds_io.write_psds(fname.psds(subject=subject, ses='01',
+                                      processed_data_dir=os.path.join(output_dir, variant)),
+                           segments[variant], freqs, infos[variant], index[variant])
+        directory = os.path.join(output_dir, variant, f'sub-{subject}', 'ses-01', 'eeg', 'bandpowers')
+        os.makedirs(directory, exist_ok=True)
+        for freq_band_type in freq_band_types:
+            f_bands = bandpower.get_f_bands(freq_band_type)
+            for segment, psd in segments[variant].items():
+                np.savetxt(os.path.join(directory, f'{freq_band_type}_{segment}.csv'),
+                           bandpower.compute_bandpowers(psd, freqs, f_bands), delimiter=',')
+    return timings
+
+
+def compare_features(subjects, output_dir):
+    """Compare the bandpowers of the two variants.
+
+    Returns
+    -------
+    rows : list of dict
+        For each frequency band type and segment, the correlation of the log
+        bandpowers and their median and maximal absolute difference in dB.
+    """
+    rows = []
+    for freq_band_type in freq_band_types:
+        by_segment = dict()
+        for subject in subjects:
+            directory = os.path.join('sub-' + subject, 'ses-01', 'eeg', 'bandpowers')
+            full_dir = os.path.join(output_dir, 'full', directory)
+            if not os.path.isdir(full_dir):
+                continue
+            for filename in sorted(os.listdir(full_dir)):
+                if not filename.startswith(freq_band_type + '_'):
+                    continue
+                segment = filename[len(freq_band_type) + 1:-len('.csv')]
+                full = np.loadtxt(os.path.join(full_dir, filename), delimiter=',')
+                decimated = np.loadtxt(os.path.join(output_dir, 'decimated', directory, filename), delimiter=',')
+                by_segment.setdefault(segment, []).append((np.log10(full), np.log10(decimated)))
+        for segment, pairs in sorted(by_segment.items()):
+            full = np.concatenate([pair[0].ravel() for pair in pairs])
+            decimated = np.concatenate([pair[1].ravel() for pair in pairs])
+            difference_db = 10 * np.abs(decimated - full)
+            rows.append(dict(freq_band_type=freq_band_type, segment=segment, n_subjects=len(pairs),
+                             correlation=round(float(np.corrcoef(full, decimated)[0, 1]), 6),
+                             median_difference_db=round(float(np.median(difference_db)), 4),
+                             max_difference_db=round(float(difference_db.max()), 4)))
+    return rows
+
+
+def compare_aucs(subjects, output_dir):
+    """Fit the classifiers to the bandpowers of both variants.
+
+    Returns
+    -------
+    rows : list of dict
+        For each task, frequency band type and classifier, the AUC of the mean
+        ROC curve of the cross validation for both variants.
+    """
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import auc
+    read_processed_data = importlib.import_module('01_read_processed_data')
+    fit_classifier_and_plot = importlib.import_module('03_fit_classifier_and_plot')
+
+    rows = []
+    for task in tasks:
+        for freq_band_type in freq_band_types:
+            aucs = dict()
+            for variant in variants:
+                dataframe, metadata = read_processed_data.read_processed_data_variants(
+                    task, freq_band_type, subjects, os.path.join(output_dir, variant))[False]
+                classifiers = fit_classifier_and_plot.create_classifiers()
+                metadata = fit_classifier_and_plot.add_arguments_to_metadata(metadata)
+                X, y, data_split = fit_classifier_and_plot.initialize_cv(dataframe, metadata)
+                _, metadata = fit_classifier_and_plot.fit_and_plot(X, y, classifiers, data_split, metadata)
+                plt.close('all')
+                mean_fpr = np.linspace(0, 1, 100)
+                for name, tpr in zip(metadata['metrics']['Classifiers'], metadata['metrics']['TPR']):
+                    aucs.setdefault(name, dict())[variant] = round(auc(mean_fpr, tpr), 3)
+            for name, variant_aucs in aucs.items():
+                rows.append(dict(task=task, freq_band_type=freq_band_type, classifier=name,
+                                 auc_full=variant_aucs['full'], auc_decimated=variant_aucs['decimated']))
+    return rows
+
+
+def write_csv(rows, filename):
+    """Write a list of dicts as a .csv file."""
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f'INFO: Wrote {filename}')
+
+
+def run_benchmark(subjects, output_dir, target_sfreq, scale_n_fft=False, n_jobs=1):
+    """Run the benchmark for a list of subjects and write the results."""
+    os.makedirs(output_dir, exist_ok=True)
+    args = (output_dir, target_sfreq, scale_n_fft)
+    timings = []
+    if n_jobs == 1:
+        for subject in subjects:
+            timings += benchmark_subject(subject, *args)
+    else:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as pool:
+            futures = [pool.submit(benchmark_subject, subject, *args) for subject in subjects]
+            for future in futures:
+                timings += future.result()
+
+    write_csv(timings, os.path.join(output_dir, 'decimation_timing.csv'))
+    for variant in variants:
+        ica_s = sum(row['ica_s'] for row in timings if row['variant'] == variant)
+        welch_s = sum(row['welch_s'] for row in timings if row['variant'] == variant)
+        print(f'{variant:>10}: ICA {ica_s:.1f} s, Welch {welch_s:.1f} s')
+
+    features = compare_features(subjects, output_dir)
+    write_csv(features, os.path.join(output_dir, 'decimation_features.csv'))
+    for row in features:
+        print(f'{row["freq_band_type"]:>5} {row["segment"]:<15} r={row["correlation"]:.4f} '
+              f'median |diff|={row["median_difference_db"]:.3f} dB')
+
+    aucs = compare_aucs(subjects, output_dir)
+    write_csv(aucs, os.path.join(output_dir, 'decimation_auc.csv'))
+    for row in aucs:
+        print(f'{row["task"]:>8} {row["freq_band_type"]:>5} {row["classifier"]:<30} '
+              f'AUC {row["auc_full"]:.3f} -> {row["auc_decimated"]:.3f}')
+
+
+if __name__ == '__main__':
+    # Save time of beginning of the execution to measure running time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('subjects', nargs='*', help='The subjects to include. Default: the subjects in subjects.txt')
+    parser.add_argument('--output_dir', help='Where to write the bandpowers and the results. Default: decimation_benchmark', default='decimation_benchmark')
+    parser.add_argument('--target_sfreq', type=float, help='The sampling frequency to decimate to. Default: as in config_eeg.py, or 250', default=target_sfreq or 250.)
+    parser.add_argument('--scale_n_fft', action='store_true', help='Keep the duration of the Welch windows the same for the decimated data. Default: False', default=False)
+    parser.add_argument('--n_jobs', type=int, help='Number of subjects processed in parallel. Default: 1', default=1)
+    args = parser.parse_args()
+
+    subjects = args.subjects
+    if not subjects:
+        with open('subjects.txt', 'r') as subjects_file:
+            subjects = [line.rstrip() for line in subjects_file.readlines()
+                        if re.match(r'^\d{2}[PC]', line)]
+    run_benchmark(subjects, args.output_dir, args.target_sfreq,
+                  scale_n_fft=args.scale_n_fft, n_jobs=args.n_jobs)
+
+    execution_time = (time.time() - start_time)
+    print('\n###################################################\n')
+    print(f'Execution time of benchmark_decimation.py is: {round(execution_time,2)} seconds\n')
+    print('###################################################\n')
@@ -0,0 +1,120 @@
+"""
+Benchmark splitting the cores of the machine between parallel workers and
+BLAS threads (see blas_threads.py).
+
+The ICA of the filtered recordings of the subjects is fitted with each split
+of the core budget: from one worker using all the cores as BLAS threads, to
+one single-threaded worker per core. The fit is the part of the processing
+that depends most on BLAS. The fitted ICAs are not saved. The benchmark writes
+thread_benchmark.csv with, for each split, the number of workers and of BLAS
+threads per worker, the wall time of fitting all the recordings and the number
+of recordings fitted per minute, and prints the fastest split. Use its number
+of workers as `n_jobs` (and the budget as `n_cores`) in config_common.py.
+
+The filtered data must exist, i.e. 01_freqfilt.py must have been run for the
+subjects.
+
+Running:
+python benchmark_threads.py 10C 11P --n_cores 16
+"""
+
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from mne import set_log_level
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+from config_common import n_cores
+from config_eeg import get_all_fnames
+from blas_threads import get_core_budget, set_blas_threads, split_budget
+from benchmark_decimation import write_csv
+import ica_fitting
+import intermediate
+
+
+def candidate_splits(n_cores, n_recordings):
+    """Get the (n_workers, n_threads) splits of a core budget to benchmark.
+
+    The numbers of workers are the powers of two up to the budget, and the
+    budget itself, but no more than the number of recordings.
+    """
+    n_workers = {1, min(n_cores, n_recordings)}
+    n = 2
+    while n < min(n_cores, n_recordings):
+        n_workers.add(n)
+        n *= 2
+    return [split_budget(n_cores, n) for n in sorted(n_workers)]
+
+
+def _fit(filt_fname):
+    """Fit the ICA of a recording, without saving it."""
+    set_log_level(verbose='Warning')
+    raw = intermediate.read_raw(filt_fname)
+    ica_fitting.fit_ica(raw, **dict(ica_fitting.ica_fit_settings, warm_start=False))
+
+
+def time_split(filt_fnames, n_workers, n_threads):
+    """Fit the ICA of all the recordings with a split, and time it.
+
+    Each split runs in fresh worker processes, so that the BLAS libraries are
+    loaded with the number of threads of the split.
+    """
+    context = multiprocessing.get_context('spawn')
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context,
+                             initializer=set_blas_threads, initargs=(n_threads,)) as pool:
+        list(pool.map(_fit, filt_fnames))
+    return time.perf_counter() - start
+
+
+def run_benchmark(subjects, n_cores=None, filename='thread_benchmark.csv'):
+    """Benchmark all the splits of the core budget and write the results."""
+    n_cores = get_core_budget(n_cores)
+    filt_fnames = [intermediate.data_fname(filt_fname) for subject in subjects
+                   for filt_fname in get_all_fnames(subject, kind='filt', exclude=['emptyroom'])]
+    filt_fnames = [filt_fname for filt_fname in filt_fnames if os.path.exists(filt_fname)]
+    if not filt_fnames:
+        raise ValueError('No filtered recordings found, run 01_freqfilt.py first.')
+    print(f'INFO: Fitting the ICA of {len(filt_fnames)} recordings on {n_cores} cores')
+
+    rows = []
+    for n_workers, n_threads in candidate_splits(n_cores, len(filt_fnames)):
+        wall_s = time_split(filt_fnames, n_workers, n_threads)
+        rows.append(dict(n_workers=n_workers, n_threads=n_threads, wall_s=round(wall_s, 2),
+                         recordings_per_minute=round(60 * len(filt_fnames) / wall_s, 2)))
+        print(f'{n_workers:>3} worker(s) x {n_threads:>3} thread(s): {wall_s:.1f} s')
+    write_csv(rows, filename)
+
+    best = min(rows, key=lambda row: row['wall_s'])
+    print(f'Fastest: {best["n_workers"]} worker(s) with {best["n_threads"]} BLAS thread(s) each, '
+          f'i.e. n_jobs = {best["n_workers"]} and n_cores = {n_cores} in config_common.py')
+    return rows
+
+
+if __name__ == '__main__':
+    # Save time of beginning of the execution to measure running time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('subjects', nargs='*', help='The subjects whose recordings are fitted. Default: the first two subjects in subjects.txt')
+    parser.add_argument('--n_cores', type=int, help='The number of cores to split. Default: as defined in config_common.py, or all the cores', default=n_cores)
+    parser.add_argument('--output', help='The CSV file to write the results to. Default: thread_benchmark.csv', default='thread_benchmark.csv')
+    args = parser.parse_args()
+
+    subjects = args.subjects
+    if not subjects:
+        with open('subjects.txt', 'r') as subjects_file:
+            subjects = [line.rstrip() for line in subjects_file.readlines()
+                        if re.match(r'^\d{2}[PC]', line)][:2]
+    run_benchmark(subjects, n_cores=args.n_cores, filename=args.output)
+
+    execution_time = (time.time() - start_time)
+    print('\n###################################################\n')
+    print(f'Execution time of benchmark_threads.py is: {round(execution_time,2)} seconds\n')
+    print('###################################################\n')
@@ -0,0 +1,254 @@
+"""
+Gather the PSDs of all the subjects into a single cohort PSD file.
+
+The group-level analyses (e.g. the group means in analysis/03_psd_topoplots.py)
+would otherwise open the PSD file of every subject one by one. This step
+copies the PSDs of the subjects into one float32 array of shape (subjects x
+segments x channels x frequencies), saved as a .npy file (``fname.cohort_psds``),
+with a .json sidecar holding the labels of the axes:
+
+    subjects, groups    the subject and its group ('Patient' or 'Control')
+    segments, tasks     the segment, as in the index of the PSD files, and
+                        its task
+    ch_names, freqs     the channels and frequencies of the PSDs
+
+The segments a subject does not have, and the channels it does not have, are
+NaN. `read_cohort_psds` memory-maps the array, so that a statistic over the
+cohort is a single reduction over the subject axis, e.g. `group_means`.
+
+The array is written before its sidecar, and the sidecar records the size and
+modification time of the array ('cube'). If the step is interrupted between
+the two, `read_cohort_psds` raises instead of labelling the new array with the
+old sidecar, and the next run reads the PSD files of all the subjects again.
+
+The cohort file is updated incrementally: the subjects whose PSD file has not
+changed since they were added (see fingerprint.py) are copied from the
+existing cohort file, and only the PSD files of the new or changed subjects
+are read. The PSD files must exist, i.e. 03_psds.py (or fused.py) must have
+been run for the subjects.
+
+Running:
+python cohort_psds.py
+python cohort_psds.py 10C 11P --force
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+from config_eeg import fname, all_subjects
+from fingerprint import compute_fingerprint, file_stat, is_up_to_date, load_fingerprint, save_fingerprint
+from profiling import profiled
+import psds_io
+
+
+def _sidecar(cohort_fname):
+    """Get the name of the .json sidecar holding the labels of the axes."""
+    return Path(cohort_fname).with_suffix('.json')
+
+
+def _cube_stat(cohort_fname):
+    """Identify the array of the cohort PSD file by its size and modification
+    time, not its path, so the file can be moved."""
+    stat = file_stat(cohort_fname)
+    return dict(size=stat['size'], mtime_ns=stat['mtime_ns'])
+
+
+def subject_group(subject):
+    """Get the group of a subject, from its name (e.g. 10C or 11P)."""
+    return 'Patient' if 'P' in subject else 'Control'
+
+
+def read_cohort_psds(cohort_fname=None, mmap_mode='r'):
+    """Read the cohort PSD file.
+
+    Parameters
+    ----------
+    cohort_fname : str | Path | None
+        The cohort PSD file. Defaults to ``fname.cohort_psds``.
+    mmap_mode : 'r' | 'r+' | 'c' | None
+        How the array is memory-mapped, see `numpy.load`. None to read it
+        into memory.
+
+    Returns
+    -------
+    cube : ndarray, shape (n_subjects, n_segments, n_channels, n_freqs)
+        The PSDs.
+    index : dict
+        The labels of the axes: 'subjects', 'groups', 'segments', 'tasks',
+        'ch_names' (lists) and 'freqs' (ndarray), and the PSD file of each
+        subject ('psds_fnames').
+
+    Raises
+    ------
+    ValueError
+        If the sidecar does not belong to the array, e.g. when cohort_psds.py
+        was interrupted while writing them.
+    """
+    cohort_fname = fname.cohort_psds if cohort_fname is None else cohort_fname
+    with open(_sidecar(cohort_fname), 'r') as f:
+        index = json.load(f)
+    index['freqs'] = np.array(index['freqs'])
+    cube = np.load(cohort_fname, mmap_mode=mmap_mode)
+    if (index.get('cube') != _cube_stat(cohort_fname) or
+            cube.shape[:2] != (len(index['subjects']), len(index['segments']))):
+        raise ValueError(f'The sidecar of {cohort_fname} does not match the PSDs in it, '
+                         f'run cohort_psds.py again.')
+    return cube, index
+
+
+def group_means(cube, groups):
+    """Average the PSDs over the subjects of each group.
+
+    Parameters
+    ----------
+    cube : ndarray, shape (n_subjects, ...)
+        The PSDs, e.g. the cohort PSDs or a selection of them (some subjects,
+        one segment, in dB, ...), with the subjects on the first axis.
+    groups : list of str
+        The group of each subject, e.g. ``index['groups']``.
+
+    Returns
+    -------
+    means : dict of ndarray
+        The mean PSDs (the other axes of ``cube``), by group. The missing
+        segments and channels of the subjects are left out, and are NaN where
+        no subject of the group has them.
+    """
+    groups = np.asarray(groups)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # Mean of empty slice
+        return {group: np.nanmean(cube[groups == group], axis=0)
+                for group in sorted(set(groups))}
+
+
+def build_cohort_psds(psds_fnames, cohort_fname=None, force=False):
+    """Gather the PSDs of the subjects into the cohort PSD file.
+
+    Parameters
+    ----------
+    psds_fnames : dict
+        The PSD file of each subject to add or update, by subject.
+    cohort_fname : str | Path | None
+        The cohort PSD file. Defaults to ``fname.cohort_psds``.
+    force : bool
+        Whether to read the PSD files of all the subjects again, also the
+        ones that are up to date in the cohort file.
+
+    Returns
+    -------
+    read_subjects : list of str
+        The subjects whose PSD file was read.
+    """
+    cohort_fname = fname.cohort_psds if cohort_fname is None else cohort_fname
+
+    # The subjects already in the cohort file are kept, as long as their PSD
+    # file exists
+    previous_cube, previous = None, None
+    if not force and os.path.exists(cohort_fname):
+        try:
+            previous_cube, previous = read_cohort_psds(cohort_fname)
+        except Exception as error:
+            print(f'Existing cohort PSD file could not be read ({error}), all subjects will be read')
+    if previous is not None:
+        psds_fnames = {**dict(zip(previous['subjects'], previous['psds_fnames'])), **psds_fnames}
+    psds_fnames = {subject: psds_fname for subject, psds_fname in sorted(psds_fnames.items())
+                   if os.path.exists(psds_fname)}
+    if not psds_fnames:
+        raise ValueError('No PSD files found, run 03_psds.py first.')
+    subjects = list(psds_fnames)
+
+    # The segments are those in the index stored in the PSD files, in the
+    # order they first appear
+    segments = dict()
+    for psds_fname in psds_fnames.values():
+        for name, segment in psds_io.read_index(psds_fname).items():
+            segments.setdefault(name, segment['task'])
+    segments = [(task, name) for name, task in segments.items()]
+
+    # The channels and frequencies are those of the existing cohort file, or
+    # of the first subject
+    if previous is not None and previous['segments'] == [name for _, name in segments]:
+        ch_names, freqs = previous['ch_names'], np.asarray(previous['freqs'])
+    else:
+        previous_cube, previous = None, None
+        ch_names = psds_io.read_info(psds_fnames[subjects[0]])['ch_names']
+        freqs = np.asarray(psds_io.read_freqs(psds_fnames[subjects[0]]))
+
+    fingerprints = dict()
+    read_subjects = []
+    tmp = Path(str(cohort_fname) + '.tmp.npy')
+    tmp.parent.mkdir(parents=True, exist_ok=True)
+    cube = np.lib.format.open_memmap(
+        tmp, mode='w+', dtype=np.float32,
+        shape=(len(subjects), len(segments), len(ch_names), len(freqs)))
+    cube[:] = np.nan
+    for i, (subject, psds_fname) in enumerate(psds_fnames.items()):
+        fingerprints[subject] = compute_fingerprint(
+            files=[psds_fname], code=[__file__, psds_io.__file__],
+            previous=load_fingerprint(cohort_fname, key=subject))
+        if (previous is not None and subject in previous['subjects'] and
+                is_up_to_date(cohort_fname, fingerprints[subject], key=subject)):
+            cube[i] = previous_cube[previous['subjects'].index(subject)]
+            continue
+
+        with profiled('read_psds', subject=subject):
+            psds, subject_freqs = psds_io.read_psds(psds_fname)
+            subject_ch_names = psds_io.read_info(psds_fname)['ch_names']
+        if subject_freqs.shape != freqs.shape or not np.allclose(subject_freqs, freqs):
+            raise ValueError(f'The frequencies of the PSDs of {subject} differ from those '
+                             f'of the other subjects, run 03_psds.py again for all subjects.')
+        rows = [ch_names.index(ch_name) for ch_name in subject_ch_names if ch_name in ch_names]
+        picks = [j for j, ch_name in enumerate(subject_ch_names) if ch_name in ch_names]
+        for j, (_, name) in enumerate(segments):
+            if name in psds:
+                cube[i, j, rows] = psds[name][picks]
+        read_subjects.append(subject)
+    cube.flush()
+    del cube, previous_cube
+
+    index = dict(subjects=subjects, groups=[subject_group(subject) for subject in subjects],
+                 segments=[name for _, name in segments], tasks=[task for task, _ in segments],
+                 ch_names=list(ch_names), freqs=[float(freq) for freq in freqs],
+                 psds_fnames=[str(psds_fname) for psds_fname in psds_fnames.values()])
+    # The sidecar is written last, with the size and modification time of the
+    # array it labels
+    os.replace(tmp, cohort_fname)
+    index['cube'] = _cube_stat(cohort_fname)
+    sidecar = _sidecar(cohort_fname)
+    with open(str(sidecar) + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(str(sidecar) + '.tmp', sidecar)
+    for subject in read_subjects:
+        save_fingerprint(cohort_fname, fingerprints[subject], key=subject)
+    return read_subjects
+
+
+if __name__ == '__main__':
+    # Save time of beginning of the execution to measure running time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('subjects', nargs='*', help='The subjects to add or update. Default: all subjects in the raw data folder that have a PSD file')
+    parser.add_argument('--force', action='store_true', help='Read the PSD files of all subjects, also the ones that are up to date. Default: False', default=False)
+    args = parser.parse_args()
+
+    subjects = args.subjects or sorted(subject for subject in all_subjects
+                                       if re.match(r'^\d{2}[PC]', subject))
+    read_subjects = build_cohort_psds({subject: fname.psds(subject=subject, ses='01') for subject in subjects},
+                                      force=args.force)
+    print(f'INFO: Read the PSDs of {len(read_subjects)} subject(s) into {fname.cohort_psds}')
+
+    execution_time = (time.time() - start_time)
+    print('\n###################################################\n')
+    print(f'Execution time of cohort_psds.py is: {round(execution_time,2)} seconds\n')
+    print('###################################################\n')
@@ -0,0 +1,340 @@
+"""
+Filter the raw data with one combined FIR kernel.
+
+Removing the powerline noise with `raw.notch_filter` and then applying
+`raw.filter` designs two FIR kernels for every recording and makes two passes
+over the data. Here, the two kernels are designed with the same settings as
+those functions use (zero-phase, firwin design with a Hamming window, automatic
+filter lengths and transition bandwidths) and convolved into one kernel, which
+is applied in a single FFT-based pass over all the picked channels.
+
+The kernel only depends on the sampling frequency and the filter settings in
+config_eeg.py, so it is the same for (nearly) all the recordings of the
+cohort. It is kept in memory, and saved in ``fname.cache_dir`` so that it is
+also reused by the next runs and by the other worker processes.
+
+Filtering is linear, so the result is the same as that of `raw.notch_filter`
+followed by `raw.filter`, up to the precision of the FFT. The exception is the
+beginning and end of the recording: the data is padded (by reflecting it, like
+MNE does) only once, instead of once before each filter. Within `edge_samples`
+samples of the ends, the result therefore differs slightly. Elsewhere, the
+difference is below ``filter_tolerance`` times the standard deviation of the
+data. Use `compare_with_mne` to check this for a recording.
+
+After the low-pass filter, the data contains nothing above the stop band of
+the filter, so it can be decimated to a lower sampling frequency by simply
+keeping every n-th sample (`decimate_raw`), without the extra anti-aliasing
+filter of `raw.resample`.
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+from scipy.signal import oaconvolve
+import mne
+from mne import pick_types
+from mne.filter import create_filter
+from mne.io import RawArray
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+from config_eeg import fname
+
+# Maximal difference from filtering with raw.notch_filter and raw.filter
+# outside the edges of the recording, relative to the standard deviation of
+# the data
+filter_tolerance = 1e-6
+
+# Same defaults as raw.notch_filter
+notch_trans_bandwidth = 1.0
+
+# Number of channels filtered at the same time, to limit the working memory
+channel_chunk = 8
+
+# The kernels that have been used by this process, by key
+_kernels = dict()
+
+
+def design_kernel(sfreq, l_freq, h_freq, notch_freqs=None):
+    """Design the combined notch and band-pass filter.
+
+    Parameters
+    ----------
+    sfreq : float
+        The sampling frequency.
+    l_freq : float
+        The high-pass frequency.
+    h_freq : float
+        The low-pass frequency.
+    notch_freqs : list of float | None
+        The frequencies to remove with notch filters.
+
+    Returns
+    -------
+    kernel : ndarray
+        The zero-phase FIR kernel, with an odd number of taps.
+    """
+    kernel = create_filter(None, sfreq, l_freq, h_freq, fir_design='firwin',
+                           verbose=False)
+    if notch_freqs is not None and len(notch_freqs) > 0:
+        # The band-stop filter that raw.notch_filter uses, with the default
+        # notch widths of freq / 200
+        notch_freqs = np.asarray(notch_freqs, dtype=float)
+        notch_widths = notch_freqs / 200.
+        tb_2 = notch_trans_bandwidth / 2.
+        lows = notch_freqs - notch_widths / 2. - tb_2
+        highs = notch_freqs + notch_widths / 2. + tb_2
+        notch = create_filter(None, sfreq, highs, lows, l_trans_bandwidth=tb_2,
+                              h_trans_bandwidth=tb_2, fir_design='firwin',
+                              verbose=False)
+        kernel = np.convolve(notch, kernel)
+    assert len(kernel) % 2 == 1
+    return kernel
+
+
+def _kernel_key(sfreq, l_freq, h_freq, notch_freqs):
+    """Get a short string identifying a kernel."""
+    params = dict(sfreq=float(sfreq), l_freq=l_freq, h_freq=h_freq,
+                  notch_freqs=None if notch_freqs is None else list(notch_freqs),
+                  mne=mne.__version__)
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def get_kernel(sfreq, l_freq, h_freq, notch_freqs=None, cache=True):
+    """Get the combined filter kernel, from the cache if possible.
+
+    Parameters
+    ----------
+    sfreq : float
+        The sampling frequency.
+    l_freq : float
+        The high-pass frequency.
+    h_freq : float
+        The low-pass frequency.
+    notch_freqs : list of float | None
+        The frequencies to remove with notch filters.
+    cache : bool
+        Whether to save the kernel to, and look for it in, ``fname.cache_dir``.
+
+    Returns
+    -------
+    kernel : ndarray
+        The zero-phase FIR kernel.
+    """
+    key = _kernel_key(sfreq, l_freq, h_freq, notch_freqs)
+    if key in _kernels:
+        return _kernels[key]
+
+    kernel_fname = fname.filter_kernel(key=key)
+    if cache and os.path.exists(kernel_fname):
+        try:
+            kernel = np.load(kernel_fname)
+        except (IOError, ValueError):
+            # A broken file is replaced below
+            kernel = None
+        if kernel is not None:
+            _kernels[key] = kernel
+            return kernel
+
+    kernel = design_kernel(sfreq, l_freq, h_freq, notch_freqs)
+    if cache:
+        # Write to a temporary file first, as other workers may be reading it
+        kernel_fname.parent.mkdir(parents=True, exist_ok=True)
+        tmp = kernel_fname.with_name(f'{kernel_fname.name}.{os.getpid()}.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, kernel)
+        os.replace(tmp, kernel_fname)
+    _kernels[key] = kernel
+    return kernel
+
+
+def edge_samples(kernel):
+    """Number of samples at each end in which the result differs from MNE."""
+    return len(kernel)
+
+
+def _pad(data, n_pad):
+    """Pad the data like MNE's 'reflect_limited' padding."""
+    n_times = data.shape[-1]
+    n_reflect = min(n_pad, n_times - 1)
+    left = 2 * data[:, :1] - data[:, n_reflect:0:-1]
+    right = 2 * data[:, -1:] - data[:, -2:-n_reflect - 2:-1]
+    zeros = np.zeros((data.shape[0], n_pad - n_reflect))
+    return np.concatenate([zeros, left, data, right, zeros], axis=-1)
+
+
+def apply_kernel(data, kernel):
+    """Filter data with a zero-phase kernel, in a single pass.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_times)
+        The data to filter.
+    kernel : ndarray
+        The zero-phase FIR kernel, with an odd number of taps.
+
+    Returns
+    -------
+    filtered : ndarray, shape (n_channels, n_times)
+        The filtered data.
+    """
+    n_pad = len(kernel) // 2
+    filtered = np.empty_like(data)
+    for start in range(0, len(data), channel_chunk):
+        padded = _pad(data[start:start + channel_chunk], n_pad)
+        filtered[start:start + channel_chunk] = oaconvolve(
+            padded, kernel[np.newaxis], mode='valid', axes=-1)
+    return filtered
+
+
+def filter_raw(raw, l_freq, h_freq, notch_freqs=None, picks=None, cache=True):
+    """Apply the notch and band-pass filters to raw data, in-place.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The data, which must be loaded into memory.
+    l_freq : float
+        The high-pass frequency.
+    h_freq : float
+        The low-pass frequency.
+    notch_freqs : list of float | None
+        The frequencies to remove with notch filters.
+    picks : str | list | None
+        The channels to filter, as for `raw.filter`.
+    cache : bool
+        Whether to use the kernels cached on disk.
+
+    Returns
+    -------
+    raw : instance of Raw
+        The filtered data.
+    """
+    kernel = get_kernel(raw.info['sfreq'], l_freq, h_freq, notch_freqs, cache=cache)
+    raw.apply_function(apply_kernel, picks=picks, channel_wise=False, kernel=kernel)
+    with raw.info._unlock():
+        raw.info['highpass'] = float(l_freq)
+        raw.info['lowpass'] = float(h_freq)
+    return raw
+
+
+def compare_with_mne(raw, l_freq, h_freq, notch_freqs=None, picks=None):
+    """Compare the combined filter with raw.notch_filter and raw.filter.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The data, which must be loaded into memory. It is not modified.
+    l_freq : float
+        The high-pass frequency.
+    h_freq : float
+        The low-pass frequency.
+    notch_freqs : list of float | None
+        The frequencies to remove with notch filters.
+    picks : str | list | None
+        The channels to filter.
+
+    Returns
+    -------
+    interior : float
+        The largest difference outside the edges, relative to the standard
+        deviation of the data filtered by MNE. Should be below
+        `filter_tolerance`.
+    edges : float
+        The same, within the edges.
+    """
+    expected = raw.copy()
+    if notch_freqs is not None and len(notch_freqs) > 0:
+        expected.notch_filter(notch_freqs, picks=picks, verbose=False)
+    expected.filter(l_freq, h_freq, picks=picks, verbose=False)
+    result = filter_raw(raw.copy(), l_freq, h_freq, notch_freqs, picks=picks, cache=False)
+
+    expected = expected.get_data(picks=picks)
+    difference = np.abs(result.get_data(picks=picks) - expected)
+    scale = np.std(expected, axis=-1, keepdims=True)
+    n_edge = edge_samples(design_kernel(raw.info['sfreq'], l_freq, h_freq, notch_freqs))
+    interior = (difference[:, n_edge:-n_edge] / scale).max()
+    edges = (np.concatenate([difference[:, :n_edge], difference[:, -n_edge:]], axis=-1) / scale).max()
+    return interior, edges
+
+
+def stop_frequency(sfreq, h_freq):
+    """Get the frequency above which the low-pass filter removes everything.
+
+    This is the edge of the stop band of the filter designed by `create_filter`
+    with the automatic transition bandwidth.
+    """
+    h_trans_bandwidth = min(max(0.25 * h_freq, 2.), sfreq / 2. - h_freq)
+    return h_freq + h_trans_bandwidth
+
+
+def decimation_factor(sfreq, target_sfreq, h_freq):
+    """Get by how much low-passed data can be decimated.
+
+    Parameters
+    ----------
+    sfreq : float
+        The sampling frequency of the data.
+    target_sfreq : float
+        The lowest sampling frequency wanted. The data is decimated by an
+        integer factor, so the new sampling frequency is at least this.
+    h_freq : float
+        The low-pass frequency the data was filtered with.
+
+    Returns
+    -------
+    factor : int
+        The decimation factor, 1 if the data should be kept as it is.
+    """
+    factor = max(int(sfreq // target_sfreq), 1)
+    if factor > 1 and stop_frequency(sfreq, h_freq) > sfreq / factor / 2.:
+        raise ValueError(f'Decimating to {sfreq / factor} Hz would alias the frequencies '
+                         f'passed by the {h_freq} Hz low-pass filter. Use a target sfreq of '
+                         f'at least {2 * stop_frequency(sfreq, h_freq)} Hz.')
+    return factor
+
+
+def decimate_raw(raw, target_sfreq, h_freq):
+    """Decimate low-passed raw data by keeping every n-th sample.
+
+    The stim channels are decimated by taking the maximum over the dropped
+    samples, so that short trigger pulses are not lost.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The data, low-pass filtered at ``h_freq`` and loaded into memory.
+    target_sfreq : float | None
+        The lowest sampling frequency wanted, see `decimation_factor`. If None,
+        the data is returned as it is.
+    h_freq : float
+        The low-pass frequency the data was filtered with.
+
+    Returns
+    -------
+    raw : instance of Raw
+        The decimated data. A new object, unless no decimation was needed.
+    """
+    if target_sfreq is None:
+        return raw
+    factor = decimation_factor(raw.info['sfreq'], target_sfreq, h_freq)
+    if factor == 1:
+        return raw
+
+    data = raw._data[:, ::factor].copy()
+    stim = pick_types(raw.info, meg=False, stim=True)
+    if len(stim) > 0:
+        n_blocks = data.shape[1]
+        padded = np.zeros((len(stim), n_blocks * factor))
+        padded[:, :raw.n_times] = raw._data[stim]
+        data[stim] = padded.reshape(len(stim), n_blocks, factor).max(axis=-1)
+
+    info = raw.info.copy()
+    with info._unlock():
+        info['sfreq'] = raw.info['sfreq'] / factor
+    decimated = RawArray(data, info, first_samp=raw.first_samp // factor, verbose=False)
+    decimated.set_annotations(raw.annotations)
+    return decimated
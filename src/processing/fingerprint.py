@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fingerprints of the inputs of the processing steps.
+
+Used to skip the (subject, recording, step) combinations whose output is up to
+date. A fingerprint is a hash of everything an output depends on: the input
+file(s), the parameters taken from config_eeg.py (e.g. the bad channels of that
+recording, or the filter settings) and the code of the step itself. It is
+stored next to the output in a small JSON sidecar file, named
+``<output>.fingerprint.json``. When a step is run again, it computes the
+fingerprint of its current inputs and skips the output if it matches the one
+that was stored when the output was created.
+
+Hashing the content of large files is expensive, so the hash of each input
+file is stored together with its size and modification time. As long as those
+do not change, the stored hash is reused instead of reading the file again.
+The raw recordings are not hashed at all: they also hold the MEG channels,
+while the EEG pipeline reads only the EEG channels of them. They are
+identified by their path, size and modification time instead, see
+`file_stat`, which go into the parameters of the fingerprint.
+
+One sidecar can hold several fingerprints, one for each ``key``. This is used
+when the output of a step combines several recordings, like the PSD file of a
+subject.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+
+def hash_file(path, chunk_size=2**22):
+    """Compute the SHA-1 hash of the content of a file.
+
+    Parameters
+    ----------
+    path : str | Path
+        The file to hash.
+    chunk_size : int
+        Number of bytes to read at a time.
+
+    Returns
+    -------
+    sha1 : str
+        The hex digest of the hash.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_stat(path):
+    """Identify a file by its path, size and modification time.
+
+    Unlike `hash_file`, the file is not read.
+
+    Parameters
+    ----------
+    path : str | Path
+        The file.
+
+    Returns
+    -------
+    stat : dict
+        The path, size and modification time (in ns) of the file.
+    """
+    stat = os.stat(path)
+    return dict(path=str(path), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+def code_version(path):
+    """Get the version of the code of a step, as the hash of its source file.
+
+    Parameters
+    ----------
+    path : str | Path
+        The source file of the step, typically ``__file__``.
+
+    Returns
+    -------
+    version : str
+        The hex digest of the hash of the source file.
+    """
+    return hash_file(path)
+
+
+def compute_fingerprint(files=None, params=None, code=None, previous=None):
+    """Compute the fingerprint of the inputs of a step.
+
+    Parameters
+    ----------
+    files : list of str | list of Path | None
+        The input files of the step.
+    params : dict | None
+        The parameters of the step. Must be serializable to JSON (values that
+        are not are converted to strings).
+    code : str | Path | list of str | None
+        The source file(s) of the step.
+    previous : dict | None
+        A fingerprint that was computed earlier for the same output. The file
+        hashes in it are reused for the files whose size and modification time
+        have not changed.
+
+    Returns
+    -------
+    fingerprint : dict
+        The fingerprint. The key ``'hash'`` summarizes all the inputs.
+    """
+    if files is None:
+        files = []
+    if params is None:
+        params = dict()
+    previous_files = dict() if previous is None else previous.get('files', dict())
+
+    file_info = dict()
+    for path in files:
+        stat = os.stat(path)
+        info = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        known = previous_files.get(str(path), dict())
+        if known.get('size') == info['size'] and known.get('mtime_ns') == info['mtime_ns']:
+            info['sha1'] = known['sha1']
+        else:
+            info['sha1'] = hash_file(path)
+        file_info[str(path)] = info
+
+    fingerprint = dict(
+        files=file_info,
+        params=json.loads(json.dumps(params, sort_keys=True, default=str)),
+        code=None if code is None else _code_versions(code),
+    )
+    # The file names are not part of the hash, only their content.
+    summary = dict(files=sorted(info['sha1'] for info in file_info.values()),
+                   params=fingerprint['params'], code=fingerprint['code'])
+    fingerprint['hash'] = hashlib.sha1(
+        json.dumps(summary, sort_keys=True).encode()).hexdigest()
+    return fingerprint
+
+
+def _code_versions(code):
+    """Get the version of one or more source files."""
+    if isinstance(code, (list, tuple)):
+        return [code_version(path) for path in code]
+    return code_version(code)
+
+
+def _sidecar(output):
+    """Get the name of the sidecar file holding the fingerprints of an output."""
+    return Path(str(output) + '.fingerprint.json')
+
+
+def load_fingerprint(output, key=''):
+    """Load the fingerprint that was stored for an output.
+
+    Parameters
+    ----------
+    output : str | Path
+        The output file.
+    key : str
+        Which of the fingerprints stored for the output to load.
+
+    Returns
+    -------
+    fingerprint : dict | None
+        The stored fingerprint, or None if there is none.
+    """
+    sidecar = _sidecar(output)
+    if not sidecar.exists():
+        return None
+    try:
+        with open(sidecar, 'r') as f:
+            fingerprints = json.load(f)
+    except (IOError, ValueError):
+        # A corrupted sidecar is treated as a missing one
+        return None
+    return fingerprints.get(key)
+
+
+def save_fingerprint(output, fingerprint, key=''):
+    """Store the fingerprint of the inputs that were used to create an output.
+
+    Should be called after the output has been successfully written.
+
+    Parameters
+    ----------
+    output : str | Path
+        The output file.
+    fingerprint : dict
+        The fingerprint, as computed by `compute_fingerprint`.
+    key : str
+        Under which key to store the fingerprint. Fingerprints stored for
+        other keys are kept.
+    """
+    sidecar = _sidecar(output)
+    fingerprints = dict()
+    if sidecar.exists():
+        try:
+            with open(sidecar, 'r') as f:
+                fingerprints = json.load(f)
+        except (IOError, ValueError):
+            pass
+    fingerprints[key] = fingerprint
+    sidecar.parent.mkdir(parents=True, exist_ok=True)
+    tmp = sidecar.with_name(sidecar.name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(fingerprints, f, indent=1, sort_keys=True)
+    os.replace(tmp, sidecar)
+
+
+def is_up_to_date(output, fingerprint, key=''):
+    """Check whether an output was created from the given inputs.
+
+    Parameters
+    ----------
+    output : str | Path
+        The output file.
+    fingerprint : dict
+        The fingerprint of the current inputs.
+    key : str
+        Which of the fingerprints stored for the output to compare against.
+
+    Returns
+    -------
+    up_to_date : bool
+        True if the output exists and its stored fingerprint matches.
+    """
+    if not os.path.exists(output):
+        return False
+    stored = load_fingerprint(output, key)
+    return stored is not None and stored.get('hash') == fingerprint['hash']
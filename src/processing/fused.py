@@ -0,0 +1,261 @@
+"""
+Run the whole processing chain (filtering, ICA, PSDs and bandpowers) for a
+subject, keeping each recording in memory from one step to the next.
+
+The separate steps each write their output to disk, after which the next step
+reads the full recording back in. Here, each recording is read only once: it
+is filtered, cleaned and its PSDs are computed in memory. Only the final
+outputs are written: the ICA solution, the PSD file, the bandpower .csv files
+and the report. Writing the filtered and cleaned data (the _filt.fif and
+_clean.fif files) is optional, for quality control or archiving.
+
+Running:
+python fused.py <subject> [--save_intermediate] [--force]
+
+The chain can also be imported and run for a subject with `run_fused`.
+"""
+
+import argparse
+from collections import defaultdict
+from mne import set_log_level
+from mne.preprocessing import read_ica
+import importlib
+import datetime
+import time
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+from config_eeg import (get_all_fnames, task_from_fname, fname, freq_min, filt_freq_max, fnotch, n_fft,
+                        freq_max, target_sfreq, get_segments, psd_overlap, psd_reject_by_annotation)
+from fingerprint import compute_fingerprint, file_stat, is_up_to_date, load_fingerprint, save_fingerprint
+from profiling import profiled
+import filtering
+import ica_fitting
+import intermediate
+import interpolation
+import psds_io
+import qc as qc_figures
+import reports
+
+# Use importlib, as the module names start with a number
+freqfilt = importlib.import_module('01_freqfilt')
+ica_step = importlib.import_module('02_ica')
+psds_step = importlib.import_module('03_psds')
+bandpower = importlib.import_module('04_bandpower')
+
+# The bandpowers are computed for each of these
+freq_band_types = ['thin', 'wide']
+
+
+def run_fused(subject, save_intermediate=False, force=False, qc='inline'):
+    """Process all the recordings of a subject without intermediate files.
+
+    Parameters
+    ----------
+    subject : str
+        The subject to process.
+    save_intermediate : bool
+        Whether to also save the filtered and cleaned data.
+    force : bool
+        Whether to process the recordings whose output is up to date.
+    qc : 'inline' | 'deferred' | 'off'
+        Whether to make the quality control figures now, to only save their
+        data for `qc.render_cohort`, or to skip them.
+
+    Returns
+    -------
+    processed_tasks : list of str
+        The tasks of the recordings that were (re)processed.
+    """
+    exclude = ['emptyroom'] #these don't have eye blinks.
+    all_fnames = list(zip(
+        get_all_fnames(subject, kind='raw', exclude=exclude),
+        get_all_fnames(subject, kind='filt', exclude=exclude),
+        get_all_fnames(subject, kind='ica', exclude=exclude),
+        get_all_fnames(subject, kind='eog_ecg_events', exclude=exclude),
+        get_all_fnames(subject, kind='clean', exclude=exclude),
+    ))
+
+    # The PSDs of all recordings are stored in the same file. The PSDs of the
+    # recordings that are up to date are taken from the existing file.
+    subject_psds = fname.psds(subject=subject, ses='01')
+    previous_segments = dict()
+    if not force and os.path.exists(subject_psds):
+        try:
+            previous_segments = psds_io.read_index(subject_psds)
+        except Exception:
+            print('Existing psds file could not be read, all recordings will be processed')
+
+    # Date and time
+    now = datetime.datetime.now()
+    date_time = now.strftime('%A, %d. %B %Y %I:%M%p')
+
+    psds = dict()
+    fingerprints = dict()
+    processed_tasks = []
+    segments = dict()
+    corrupted_raw_files = []
+    # Along the way, we collect figures for quality control
+    figures = defaultdict(list)
+    filt_tasks = []
+    # With a warm start, the ICA of the later recordings is started from the
+    # ICA of the first one
+    warm_start = ica_step.ica_fit_settings['warm_start']
+    first_ica_fname = all_fnames[0][2] if all_fnames else None
+    init_ica = None
+
+    for i, (raw_fname, filt_fname, ica_fname, events_fname, clean_fname) in enumerate(all_fnames):
+        bads, filt_task = freqfilt.get_bads(subject, raw_fname)
+        task = task_from_fname(raw_fname)
+        warm = warm_start and i > 0 and os.path.exists(first_ica_fname)
+
+        # The ICA is fitted to the filtered data, which is not kept, so the
+        # fit depends on the raw data, the bad channels and the filtering. The
+        # raw file is not hashed, as only its EEG channels are read.
+        filt_params = dict(raw=file_stat(raw_fname), bads=sorted(bads), freq_min=freq_min,
+                           filt_freq_max=filt_freq_max, fnotch=fnotch, target_sfreq=target_sfreq)
+        filt_code = [freqfilt.__file__, filtering.__file__, interpolation.__file__]
+        fit_fingerprint = ica_fitting.compute_fit_fingerprint(
+            files=[], ica_fname=ica_fname, params=filt_params, code=filt_code,
+            init_ica_fname=first_ica_fname if warm else None)
+        events_fingerprint = ica_step.compute_events_fingerprint(
+            [], events_fname, task, params=filt_params, code=filt_code)
+
+        # Skip the recording if its PSDs have already been computed using the
+        # same raw data, bad channels, ICA fit, EOG and ECG events, parameters
+        # and code of all the steps.
+        fingerprints[task] = compute_fingerprint(
+            params=dict(**filt_params, n_fft=n_fft, freq_max=freq_max,
+                        segments=get_segments(task), psd_overlap=psd_overlap,
+                        psd_reject_by_annotation=psd_reject_by_annotation,
+                        fit=fit_fingerprint['hash'], events=events_fingerprint['hash']),
+            code=[__file__, freqfilt.__file__, filtering.__file__, interpolation.__file__,
+                  ica_step.__file__, psds_step.__file__, psds_io.__file__],
+            previous=load_fingerprint(subject_psds, key=task))
+        previous_task_segments = psds_step.task_segments(previous_segments, task)
+        if (not force and previous_task_segments and
+                is_up_to_date(subject_psds, fingerprints[task], key=task)):
+            print(f'INFO: PSDs of {task} are up to date, skipping it.')
+            with profiled('read_psds', recording=task):
+                psds.update(psds_io.read_psds(subject_psds, segments=previous_task_segments)[0])
+            segments.update({name: previous_segments[name] for name in previous_task_segments})
+            continue
+
+        try:
+            with profiled('read_raw_fif', recording=task):
+                raw = freqfilt.read_recording(raw_fname)
+        except (IOError, ValueError) as error:
+            corrupted_raw_files.append(subject)
+            print(f'Error: {error}')
+            continue
+
+        # Reduce logging level (technically, one could define it in the read_raw_fif function, but it seems to be buggy)
+        # More info about the bug can be found here: https://github.com/mne-tools/mne-python/issues/8872
+        set_log_level(verbose='Warning')
+
+        # Filtering
+        qc_data = dict(kind='filtering', task=filt_task, date_time=date_time) if qc == 'deferred' else None
+        with profiled('filter_recording', recording=task):
+            filt = freqfilt.filter_recording(raw, bads, filt_task, date_time=date_time,
+                                             figures=figures if qc == 'inline' else None,
+                                             qc_data=qc_data)
+        if qc_data is not None:
+            qc_figures.save_qc_data(subject, f'filtering_{filt_task}', qc_data)
+        filt_tasks.append(filt_task)
+        if save_intermediate:
+            with profiled('save', recording=task):
+                intermediate.save_raw(filt, filt_fname)
+
+        # ICA, which modifies the data in-place. The saved EOG and ECG events
+        # and ICA that were found in the same data are reused.
+        events = ica_step.get_artifact_events(filt, task, events_fname, events_fingerprint, force)
+        ica = None if force else ica_fitting.load_fitted_ica(ica_fname, fit_fingerprint)
+        if ica is not None:
+            print(f'INFO: Reusing the ICA fitted to {task} ({ica_fname}).')
+        elif warm and init_ica is None:
+            init_ica = read_ica(first_ica_fname)
+        with profiled('clean_recording', recording=task):
+            ica, raw_ica, artifacts = ica_step.clean_recording(filt, events, init_ica=init_ica if warm else None,
+                                                               ica=ica)
+        if artifacts['fit_seconds'] is not None:
+            ica_step.log_convergence(subject, task, ica, artifacts['fit_seconds'], init_ica if warm else None)
+        if i == 0:
+            init_ica = ica
+        ica_fname.parent.mkdir(parents=True, exist_ok=True)
+        with profiled('save', recording=task):
+            ica_fitting.save_fitted_ica(ica, ica_fname, fit_fingerprint)
+            if save_intermediate:
+                intermediate.save_raw(raw_ica, clean_fname)
+        if qc == 'inline':
+            with profiled('report_ica', recording=task):
+                ica_step.add_ica_to_report(reports.get_report(subject), ica, raw_ica, task, artifacts, date_time)
+        elif qc == 'deferred':
+            with profiled('qc_data', recording=task):
+                ica_step.save_ica_qc_data(subject, task, ica_fname, artifacts, date_time)
+        if artifacts['ecg_events'] is None:
+            print(f'{subject}: no ECG found')
+            with open("ecg_missing.txt", "a") as file:
+                file.write(str(subject)+task+'\n')
+
+        # PSDs
+        with profiled('welch', recording=task):
+            task_psds, freqs = psds_step.compute_psds(raw_ica, task)
+        psds.update(task_psds)
+        segments.update(psds_step.segment_index(task))
+        psds['info'] = raw_ica.info
+        psds['freqs'] = freqs
+        processed_tasks.append(task)
+
+    if processed_tasks:
+        with profiled('write_psds'):
+            psds_io.write_psds(subject_psds, psds, psds['freqs'], psds['info'], segments)
+        for task in processed_tasks:
+            save_fingerprint(subject_psds, fingerprints[task], key=task)
+
+        # The bandpowers are computed from the PSDs still in memory
+        segment_psds = {name: psds[name] for name in segments}
+        for freq_band_type in freq_band_types:
+            bandpower.save_bandpowers(subject, segment_psds, psds['freqs'], freq_band_type)
+
+        # Write HTML report with the quality control figures
+        if qc == 'deferred':
+            # The raw file has the same channel positions as the cleaned one
+            with profiled('qc_data'):
+                psds_step.save_psds_qc_data(subject, psds, raw_fname)
+        elif qc == 'inline':
+            report = reports.get_report(subject)
+            freqfilt.add_figures_to_report(report, figures, filt_tasks)
+            with profiled('plot_psds'):
+                report.add_figure(psds_step.plot_psds(psds, psds['info']), 'PSDs', replace=True)
+            reports.save_report(subject)
+    else:
+        print('INFO: All recordings are up to date.')
+
+    with open('corrupted_subjects.txt', 'a') as file:
+        for bad_file in corrupted_raw_files:
+            file.write(bad_file+'\n')
+
+    return processed_tasks
+
+
+if __name__ == '__main__':
+    # Save time of beginning of the execution to measure running time
+    start_time = time.time()
+
+    # Deal with command line arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('subject', help='The subject to process')
+    parser.add_argument('--save_intermediate', action='store_true', help='Also save the filtered and cleaned data. Default: False', default=False)
+    parser.add_argument('--force', action='store_true', help='Process all recordings, also the ones whose output is up to date. Default: False', default=False)
+    parser.add_argument('--qc', choices=qc_figures.qc_modes, help='Make the quality control figures now, save their data to render them later with qc.py, or skip them. Default: inline', default='inline')
+    args = parser.parse_args()
+
+    run_fused(args.subject, save_intermediate=args.save_intermediate, force=args.force, qc=args.qc)
+
+    # Calculate time that the script takes to run
+    execution_time = (time.time() - start_time)
+    print('\n###################################################\n')
+    print(f'Execution time of fused.py is: {round(execution_time,2)} seconds\n')
+    print('###################################################\n')
@@ -0,0 +1,327 @@
+"""
+Fit the ICA of a recording, and keep the fitted ICA for the next runs.
+
+By default, the ICA is fitted on all the samples of the recording with
+FastICA. The settings in config_eeg.py can make the fit faster (fitting on
+fewer samples, fewer components, another solver) or start it from the ICA of
+the first recording of the subject (a warm start, see `warm_start_init`).
+
+Fitting is by far the slowest part of 02_ica.py, while the classification of
+the EOG and ECG components and the removal of the components are cheap. The
+fitted ICA is saved (the _ica.h5 file) together with a fingerprint of what
+the fit depends on: the data, the parameters of the fit and the code of this
+module. A rerun reuses the saved ICA if the fingerprint matches, e.g. after
+changing only the thresholds of the classification or the report, see
+`load_fitted_ica`.
+
+The ICAs of several recordings can be fitted in parallel worker processes with
+`fit_recordings`, which splits the cores between the workers and their BLAS
+threads (see blas_threads.py).
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import mne
+from mne import pick_types
+from mne.preprocessing import ICA, read_ica
+# The PCA `ICA.fit` uses to whiten the data
+from mne.utils.numerics import _PCA
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+from config_eeg import ica_method, ica_fit_params, ica_fit_decim, ica_fit_window, ica_max_components, ica_warm_start
+from fingerprint import compute_fingerprint, is_up_to_date, load_fingerprint, save_fingerprint
+from blas_threads import blas_threads, get_core_budget, set_blas_threads, split_budget
+import intermediate
+
+# Parameters of the ICA decomposition
+ica_params = dict(n_components=0.99, random_state=0)
+
+# How the ICA is fitted, see config_eeg.py
+ica_fit_settings = dict(method=ica_method, fit_params=ica_fit_params, decim=ica_fit_decim,
+                        window=ica_fit_window, max_components=ica_max_components,
+                        warm_start=ica_warm_start)
+
+# Fitting on all the samples, with the default solver and number of components
+full_fit_settings = dict(method='fastica', fit_params=None, decim=None,
+                         window=None, max_components=None, warm_start=False)
+
+# The parameter of each solver that sets the initial unmixing matrix
+_init_params = {'fastica': 'w_init', 'picard': 'w_init', 'infomax': 'weights'}
+
+
+def _fit_data(raw, decim=None, window=None):
+    """Get the data `ICA.fit` fits the ICA on: the good EEG channels."""
+    picks = pick_types(raw.info, meg=False, eeg=True, exclude='bads')
+    tmin, tmax = window if window is not None else (None, None)
+    start = 0 if tmin is None else raw.time_as_index(tmin)[0]
+    stop = None if tmax is None else raw.time_as_index(tmax)[0]
+    data = raw.get_data(picks=picks, start=start, stop=stop, reject_by_annotation='omit')
+    return data if decim is None else data[:, ::decim], [raw.ch_names[pick] for pick in picks]
+
+
+def _fit_pca(raw, decim=None, window=None):
+    """Compute the whitening PCA of the data, the same way as `ICA.fit`.
+
+    Returns
+    -------
+    pca : instance of _PCA
+        The fitted PCA.
+    pre_whitener : float
+        The scale the data was divided by before the PCA.
+    ch_names : list of str
+        The channels.
+    """
+    data, ch_names = _fit_data(raw, decim, window)
+    # All the channels are EEG channels, which ICA scales by their common
+    # standard deviation
+    pre_whitener = np.std(data)
+    pca = _PCA(n_components=None, whiten=True)
+    pca.fit_transform((data / pre_whitener).T)
+    return pca, pre_whitener, ch_names
+
+
+def _n_components(pca, variance, max_components=None):
+    """Get the number of components that explain some of the variance."""
+    explained = np.cumsum(pca.explained_variance_) / np.sum(pca.explained_variance_)
+    n_components = min(int((explained <= variance).sum()) + 1, len(explained))
+    return n_components if max_components is None else min(n_components, max_components)
+
+
+def n_components_for_variance(raw, variance, decim=None, window=None):
+    """Get the number of components that explain some of the variance.
+
+    This is the number the ICA selects when fitted with ``n_components`` set
+    to ``variance``.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The data.
+    variance : float
+        The fraction of the variance to explain.
+    decim : int | None
+        Only use every n-th sample.
+    window : tuple | None
+        Only use the samples between tmin and tmax, in seconds.
+
+    Returns
+    -------
+    n_components : int
+        The number of components.
+    """
+    return _n_components(_fit_pca(raw, decim, window)[0], variance)
+
+
+def warm_start_init(init_ica, raw, max_components=None, decim=None, window=None):
+    """Get the initial unmixing matrix of an ICA from the ICA of another recording.
+
+    The unmixing matrix of ``init_ica`` (in channel space) is expressed in the
+    whitened PCA space in which the ICA of ``raw`` is fitted. This needs the
+    PCA of ``raw``, so the number of components is determined here.
+
+    Parameters
+    ----------
+    init_ica : instance of ICA
+        The ICA fitted to another recording with the same channels.
+    raw : instance of Raw
+        The data the ICA is fitted to.
+    max_components : int | None
+        The maximal number of components.
+    decim : int | None
+        The ICA is fitted on every n-th sample only.
+    window : tuple | None
+        The ICA is fitted on the samples between tmin and tmax only.
+
+    Returns
+    -------
+    n_components : int | float
+        The number of components to fit. If the channels of the two recordings
+        differ, ``ica_params['n_components']``.
+    w_init : ndarray, shape (n_components, n_components) | None
+        The initial unmixing matrix, or None if the channels differ.
+    """
+    pca, pre_whitener, ch_names = _fit_pca(raw, decim, window)
+    if ch_names != init_ica.ch_names:
+        print('WARNING: The channels differ from those of the first recording, '
+              'the ICA is fitted from scratch')
+        return ica_params['n_components'], None
+    n_components = _n_components(pca, ica_params['n_components'], max_components)
+
+    # The unmixing of the first recording, applied to this recording's
+    # pre-whitened channels and then expressed in its whitened PCA space
+    unmixing = init_ica.unmixing_matrix_ @ init_ica.pca_components_[:init_ica.n_components_]
+    unmixing = unmixing * (pre_whitener / init_ica.pre_whitener_.ravel())
+    w_init = (unmixing @ pca.components_[:n_components].T) * np.sqrt(pca.explained_variance_[:n_components])
+
+    # Keep the strongest components, or add random ones
+    norms = np.linalg.norm(w_init, axis=1)
+    if len(w_init) > n_components:
+        w_init = w_init[np.sort(np.argsort(norms)[::-1][:n_components])]
+    elif len(w_init) < n_components:
+        rng = np.random.default_rng(ica_params['random_state'])
+        w_init = np.vstack([w_init, rng.standard_normal((n_components - len(w_init), n_components))])
+    # Unit rows, symmetrically decorrelated, as the solvers expect
+    w_init /= np.linalg.norm(w_init, axis=1, keepdims=True)
+    eigenvalues, eigenvectors = np.linalg.eigh(w_init @ w_init.T)
+    w_init = (eigenvectors / np.sqrt(eigenvalues)) @ eigenvectors.T @ w_init
+    return n_components, w_init
+
+
+def fit_ica(raw, method='fastica', fit_params=None, decim=None, window=None,
+            max_components=None, warm_start=False, init_ica=None):
+    """Fit the ICA, possibly in a faster way than on the whole recording.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The filtered data.
+    method : 'fastica' | 'picard' | 'infomax'
+        The ICA solver.
+    fit_params : dict | None
+        Extra parameters for the solver, e.g. ``dict(extended=True)``.
+    decim : int | None
+        Fit on every n-th sample only.
+    window : tuple | None
+        Fit on the samples between tmin and tmax (in seconds) only.
+    max_components : int | None
+        The maximal number of components. Fewer are used if they explain the
+        variance in `ica_params`.
+    warm_start : bool
+        Whether to start the solver from the solution of ``init_ica``.
+    init_ica : instance of ICA | None
+        The ICA of another recording of the subject (the first one). If None,
+        the ICA is fitted from scratch.
+
+    Returns
+    -------
+    ica : instance of ICA
+        The fitted ICA.
+    """
+    n_components = ica_params['n_components']
+    fit_params = dict(fit_params or dict())
+    if warm_start and init_ica is not None:
+        n_components, w_init = warm_start_init(init_ica, raw, max_components, decim, window)
+        if w_init is not None:
+            fit_params[_init_params[method]] = w_init
+    elif max_components is not None and n_components_for_variance(
+            raw, n_components, decim, window) > max_components:
+        n_components = max_components
+    ica = ICA(n_components=n_components, random_state=ica_params['random_state'],
+              method=method, fit_params=fit_params)
+    tmin, tmax = window if window is not None else (None, None)
+    return ica.fit(raw, start=tmin, stop=tmax, decim=decim)
+
+
+def compute_fit_fingerprint(files, ica_fname, params=None, code=None, init_ica_fname=None):
+    """Compute the fingerprint of what the ICA fit of a recording depends on.
+
+    Parameters
+    ----------
+    files : list of str | list of Path
+        The data the ICA is fitted on.
+    ica_fname : str | Path
+        The file the fitted ICA is saved to.
+    params : dict | None
+        Parameters of the steps that made the data, if the data is not read
+        from a file of its own.
+    code : list of str | None
+        The source files of those steps.
+    init_ica_fname : str | Path | None
+        With a warm start, the file of the ICA the fit starts from.
+
+    Returns
+    -------
+    fingerprint : dict
+        The fingerprint, see `compute_fingerprint`.
+    """
+    params = dict(params or dict(), **ica_params, **ica_fit_settings, mne=mne.__version__)
+    if init_ica_fname is not None:
+        # The fit of the first recording, rather than its file, which is
+        # saved again whenever its components are classified
+        init_fingerprint = load_fingerprint(init_ica_fname, key='fit')
+        params['init_ica'] = None if init_fingerprint is None else init_fingerprint['hash']
+    return compute_fingerprint(files=files, params=params, code=[__file__] + list(code or []),
+                               previous=load_fingerprint(ica_fname, key='fit'))
+
+
+def load_fitted_ica(ica_fname, fingerprint):
+    """Read a saved ICA, if it was fitted to the same inputs.
+
+    Parameters
+    ----------
+    ica_fname : str | Path
+        The file of the ICA.
+    fingerprint : dict
+        The fingerprint of the fit, see `compute_fit_fingerprint`.
+
+    Returns
+    -------
+    ica : instance of ICA | None
+        The saved ICA, or None if it has to be fitted again.
+    """
+    if not is_up_to_date(ica_fname, fingerprint, key='fit'):
+        return None
+    try:
+        return read_ica(ica_fname, verbose='error')
+    except (IOError, ValueError):
+        # A broken file is replaced by a new fit
+        return None
+
+
+def save_fitted_ica(ica, ica_fname, fingerprint):
+    """Save an ICA together with the fingerprint of its fit."""
+    ica.save(ica_fname, overwrite=True, verbose='error')
+    save_fingerprint(ica_fname, fingerprint, key='fit')
+
+
+def _fit_recording(filt_fname, ica_fname, fingerprint, init_ica_fname=None):
+    """Fit the ICA of a recording and save it, in a worker process."""
+    raw = intermediate.read_raw(filt_fname)
+    init_ica = None if init_ica_fname is None else read_ica(init_ica_fname, verbose='error')
+    start = time.perf_counter()
+    ica = fit_ica(raw, **ica_fit_settings, init_ica=init_ica)
+    fit_seconds = time.perf_counter() - start
+    save_fitted_ica(ica, ica_fname, fingerprint)
+    return ica, fit_seconds
+
+
+def fit_recordings(recordings, n_jobs=1, n_cores=None):
+    """Fit and save the ICA of several recordings in parallel.
+
+    Parameters
+    ----------
+    recordings : list of tuple
+        For each recording, the file of the filtered data, the file to save
+        the ICA to, the fingerprint of the fit (see `compute_fit_fingerprint`)
+        and, with a warm start, the file of the ICA to start from (or None).
+    n_jobs : int
+        Maximum number of recordings fitted in parallel.
+    n_cores : int | None
+        The number of cores the workers may use together, see
+        `get_core_budget`.
+
+    Returns
+    -------
+    fits : list of tuple
+        For each recording, the fitted ICA and the time the fit took.
+    """
+    if not recordings:
+        return []
+    n_jobs, n_threads = split_budget(get_core_budget(n_cores), min(n_jobs, len(recordings)))
+    if n_jobs == 1:
+        with blas_threads(n_threads):
+            return [_fit_recording(*recording) for recording in recordings]
+
+    # Use fresh worker processes instead of forking, as the parent might
+    # already have initialized BLAS thread pools
+    context = multiprocessing.get_context('spawn')
+    with blas_threads(n_threads), \
+            ProcessPoolExecutor(max_workers=n_jobs, mp_context=context,
+                                initializer=set_blas_threads, initargs=(n_threads,)) as pool:
+        return list(pool.map(_fit_recording, *zip(*recordings)))
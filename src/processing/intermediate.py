@@ -0,0 +1,231 @@
+"""
+Store the filtered and cleaned data (the intermediate files) between steps.
+
+With ``intermediate_format = 'fif'`` in config_eeg.py, the data is saved as
+the usual _filt.fif and _clean.fif files, which the next step reads into
+memory with ``preload=True``. Every worker process then holds its own copy of
+the recording.
+
+With ``intermediate_format = 'npy'``, the data is saved as a plain float32
+array (_filt.npy, _clean.npy) with two small sidecars: the measurement info
+(-info.fif) and the first sample and annotations (.json). The next step opens
+the array with numpy memory-mapping. Reading it does not copy it: the pages
+come from the OS page cache, which is shared by all the worker processes and
+reused by the next step if it runs soon enough. The PSD step only reads the
+segments it needs from the mapped array. The ICA step still needs a private
+float64 copy, as the ICA is fitted on and applied to the data in memory.
+
+The functions here take the .fif file names returned by `get_all_fnames` and
+derive the names of the .npy files from them.
+"""
+
+import json
+from datetime import datetime, timezone
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+from mne import Annotations
+from mne.io import RawArray, read_info, read_raw_fif, write_info
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+from config_eeg import intermediate_format
+
+intermediate_formats = ['fif', 'npy']
+
+
+def data_fname(fif_fname, fmt=intermediate_format):
+    """Get the file the data is stored in.
+
+    Parameters
+    ----------
+    fif_fname : str | Path
+        The name of the .fif file, e.g. as returned by `get_all_fnames`.
+    fmt : 'fif' | 'npy'
+        The format of the intermediate files.
+
+    Returns
+    -------
+    data_fname : Path
+        The .fif file, or the .npy file with the same name.
+    """
+    fif_fname = Path(fif_fname)
+    if fmt == 'fif':
+        return fif_fname
+    elif fmt == 'npy':
+        return fif_fname.with_suffix('.npy')
+    raise ValueError(f'Unknown intermediate format: {fmt}')
+
+
+def _sidecars(npy_fname):
+    """Get the names of the info and the .json sidecars of a .npy file."""
+    return (npy_fname.with_name(npy_fname.stem + '-info.fif'),
+            npy_fname.with_suffix('.json'))
+
+
+def info_fname(fif_fname, fmt=intermediate_format):
+    """Get a file from which the measurement info can be read with `read_info`."""
+    fname = data_fname(fif_fname, fmt)
+    return fname if fmt == 'fif' else _sidecars(fname)[0]
+
+
+def save_raw(raw, fif_fname, fmt=intermediate_format):
+    """Save the data of a step.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The data, loaded into memory.
+    fif_fname : str | Path
+        The name of the .fif file, see `data_fname`.
+    fmt : 'fif' | 'npy'
+        The format of the intermediate files.
+
+    Returns
+    -------
+    data_fname : Path
+        The file the data was saved to.
+    """
+    fname = data_fname(fif_fname, fmt)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    if fmt == 'fif':
+        raw.save(fname, overwrite=True)
+        return fname
+
+    info_sidecar, json_fname = _sidecars(fname)
+    # The sidecars first, so that the .npy file (on which the fingerprints
+    # are based) is only complete once everything has been written
+    write_info(info_sidecar, raw.info, overwrite=True)
+    annotations = raw.annotations
+    # Without a measurement date, the onsets are relative to the first sample
+    # when the annotations are set again
+    onset = annotations.onset - (raw.first_time if annotations.orig_time is None else 0.)
+    with open(json_fname, 'w') as f:
+        json.dump(dict(first_samp=int(raw.first_samp),
+                       annotations=dict(onset=onset.tolist(),
+                                        duration=annotations.duration.tolist(),
+                                        description=annotations.description.tolist(),
+                                        orig_time=(None if annotations.orig_time is None
+                                                   else annotations.orig_time.timestamp()))),
+                  f)
+    tmp = fname.with_name(f'{fname.name}.{os.getpid()}.tmp')
+    with open(tmp, 'wb') as f:
+        np.save(f, raw._data.astype(np.float32))
+    os.replace(tmp, fname)
+    return fname
+
+
+def read_data(fif_fname, fmt=intermediate_format):
+    """Open the data of a step without copying it, if possible.
+
+    Parameters
+    ----------
+    fif_fname : str | Path
+        The name of the .fif file, see `data_fname`.
+    fmt : 'fif' | 'npy'
+        The format of the intermediate files.
+
+    Returns
+    -------
+    data : ndarray, shape (n_channels, n_times)
+        The data. For 'npy', a read-only memory-mapped float32 array.
+    info : instance of Info
+        The measurement info.
+    """
+    if fmt == 'fif':
+        raw = read_raw_fif(fif_fname, preload=True)
+        return raw._data, raw.info
+    return (np.load(data_fname(fif_fname, fmt), mmap_mode='r'),
+            read_info(info_fname(fif_fname, fmt), verbose=False))
+
+
+def open_data(fif_fname, fmt=intermediate_format):
+    """Open the data of a step without reading it, to read it in blocks.
+
+    Parameters
+    ----------
+    fif_fname : str | Path
+        The name of the .fif file, see `data_fname`.
+    fmt : 'fif' | 'npy'
+        The format of the intermediate files.
+
+    Returns
+    -------
+    data : instance of Raw | ndarray, shape (n_channels, n_times)
+        For 'fif', the Raw object, which reads the data from the file when
+        it is asked for (e.g. with ``raw.get_data(start=..., stop=...)``).
+        For 'npy', the read-only memory-mapped float32 array.
+    info : instance of Info
+        The measurement info.
+    """
+    if fmt == 'fif':
+        raw = read_raw_fif(fif_fname, preload=False)
+        return raw, raw.info
+    return read_data(fif_fname, fmt)
+
+
+def read_raw(fif_fname, fmt=intermediate_format):
+    """Read the data of a step into memory, as a Raw object.
+
+    Parameters
+    ----------
+    fif_fname : str | Path
+        The name of the .fif file, see `data_fname`.
+    fmt : 'fif' | 'npy'
+        The format of the intermediate files.
+
+    Returns
+    -------
+    raw : instance of Raw
+        The data, loaded into memory (float64) so that it can be modified.
+    """
+    if fmt == 'fif':
+        return read_raw_fif(fif_fname, preload=True)
+    fname = data_fname(fif_fname, fmt)
+    data, info = read_data(fif_fname, fmt)
+    _, json_fname = _sidecars(fname)
+    with open(json_fname) as f:
+        sidecar = json.load(f)
+    # RawArray converts the mapped float32 data to a float64 array of its own
+    raw = RawArray(data, info, first_samp=sidecar['first_samp'], verbose=False)
+    annotations = sidecar['annotations']
+    orig_time = annotations['orig_time']
+    if orig_time is not None:
+        orig_time = datetime.fromtimestamp(orig_time, timezone.utc)
+    raw.set_annotations(Annotations(annotations['onset'], annotations['duration'],
+                                    annotations['description'], orig_time=orig_time))
+    return raw
+
+
+def read_annotations(fif_fname, fmt=intermediate_format):
+    """Read the annotations of the data of a step, without reading the data.
+
+    Parameters
+    ----------
+    fif_fname : str | Path
+        The name of the .fif file, see `data_fname`.
+    fmt : 'fif' | 'npy'
+        The format of the intermediate files.
+
+    Returns
+    -------
+    annotations : instance of Annotations
+        The annotations, with their onsets relative to the first sample of
+        the data.
+    """
+    if fmt == 'fif':
+        raw = read_raw_fif(fif_fname, preload=False, verbose='error')
+        annotations = raw.annotations
+        return Annotations(annotations.onset - raw.first_time, annotations.duration,
+                           annotations.description)
+    _, json_fname = _sidecars(data_fname(fif_fname, fmt))
+    with open(json_fname) as f:
+        sidecar = json.load(f)
+    annotations = sidecar['annotations']
+    onset = np.asarray(annotations['onset'], dtype=float)
+    if annotations['orig_time'] is not None:
+        sfreq = read_info(info_fname(fif_fname, fmt), verbose=False)['sfreq']
+        onset -= sidecar['first_samp'] / sfreq
+    return Annotations(onset, annotations['duration'], annotations['description'])
@@ -0,0 +1,129 @@
+"""
+Interpolate the bad EEG channels with cached interpolation matrices.
+
+`raw.interpolate_bads` computes a spherical-spline interpolation matrix from
+the channel positions and the bad channels every time it is called. The matrix
+only depends on those, so it is the same for all the recordings of a subject
+that share the same bad channels (e.g. ``['EEG017']`` in all the tasks of 17P)
+and for every rerun of the pipeline. Here, the matrices are computed the same
+way as MNE does, kept in memory, and saved in ``fname.cache_dir`` so that the
+next runs and the other worker processes reuse them. Applying a matrix is a
+single matrix multiplication.
+
+The channel positions are digitized for each measurement session, so a matrix
+is normally shared by the recordings of one subject only. The key of the cache
+is a hash of the positions, the origin of the spherical fit and the bad
+channels, so a new digitization or a changed list of bad channels always gets
+its own matrix.
+"""
+
+import hashlib
+import os
+import sys
+
+import numpy as np
+import mne
+from mne import pick_types
+# The functions `raw.interpolate_bads` uses to fit the sphere and to compute
+# the spherical-spline interpolation matrix
+from mne.bem import _check_origin
+from mne.channels.interpolation import _make_interpolation_matrix
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+from config_eeg import fname
+
+# The matrices that have been used by this process, by key
+_matrices = dict()
+
+
+def _matrix_key(pos, origin, bads_idx):
+    """Get a short string identifying an interpolation matrix."""
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(pos, dtype=np.float64).tobytes())
+    sha.update(np.ascontiguousarray(origin, dtype=np.float64).tobytes())
+    sha.update(np.flatnonzero(bads_idx).astype(np.int64).tobytes())
+    sha.update(mne.__version__.encode())
+    return sha.hexdigest()[:16]
+
+
+def get_matrix(pos, origin, bads_idx, cache=True):
+    """Get the interpolation matrix, from the cache if possible.
+
+    Parameters
+    ----------
+    pos : ndarray, shape (n_channels, 3)
+        The positions of the EEG channels.
+    origin : ndarray, shape (3,)
+        The origin of the sphere fitted to the head.
+    bads_idx : ndarray of bool, shape (n_channels,)
+        Which of the channels are bad.
+    cache : bool
+        Whether to save the matrix to, and look for it in, ``fname.cache_dir``.
+
+    Returns
+    -------
+    interpolation : ndarray, shape (n_bads, n_goods)
+        The matrix that maps the good channels to the bad ones.
+    """
+    key = _matrix_key(pos, origin, bads_idx)
+    if key in _matrices:
+        return _matrices[key]
+
+    matrix_fname = fname.interpolation_matrix(key=key)
+    if cache and os.path.exists(matrix_fname):
+        try:
+            interpolation = np.load(matrix_fname)
+        except (IOError, ValueError):
+            # A broken file is replaced below
+            interpolation = None
+        if interpolation is not None:
+            _matrices[key] = interpolation
+            return interpolation
+
+    interpolation = _make_interpolation_matrix(pos[~bads_idx] - origin,
+                                               pos[bads_idx] - origin)
+    if cache:
+        # Write to a temporary file first, as other workers may be reading it
+        matrix_fname.parent.mkdir(parents=True, exist_ok=True)
+        tmp = matrix_fname.with_name(f'{matrix_fname.name}.{os.getpid()}.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, interpolation)
+        os.replace(tmp, matrix_fname)
+    _matrices[key] = interpolation
+    return interpolation
+
+
+def interpolate_bads(raw, cache=True):
+    """Interpolate the bad EEG channels of raw data, in-place.
+
+    Gives the same result as ``raw.interpolate_bads()`` and, like it, resets
+    the list of bad channels. If some of the bad channels are not EEG
+    channels, `raw.interpolate_bads` is used instead.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The data, which must be loaded into memory.
+    cache : bool
+        Whether to use the matrices cached on disk.
+
+    Returns
+    -------
+    raw : instance of Raw
+        The data, with the bad channels interpolated.
+    """
+    picks = pick_types(raw.info, meg=False, eeg=True, exclude=[])
+    eeg_names = [raw.ch_names[pick] for pick in picks]
+    if not raw.info['bads']:
+        return raw
+    if any(bad not in eeg_names for bad in raw.info['bads']):
+        return raw.interpolate_bads()
+
+    bads_idx = np.array([name in raw.info['bads'] for name in eeg_names])
+    pos = np.array([raw.info['chs'][pick]['loc'][:3] for pick in picks])
+    origin = _check_origin('auto', raw.info)
+    interpolation = get_matrix(pos, origin, bads_idx, cache=cache)
+    raw._data[picks[bads_idx]] = interpolation @ raw._data[picks[~bads_idx]]
+    raw.info['bads'] = []
+    return raw
@@ -0,0 +1,248 @@
+"""
+Check the raw recordings of the cohort before processing them.
+
+A corrupted or incomplete raw file is otherwise only noticed by the step that
+reads it, after the steps before it have already spent their time on the
+subject, and a recording that is too short only fails in the PSD step. The
+pre-flight scan opens every expected recording of every subject (only the
+header and the last data buffer are read) and checks:
+
+- that the recordings of all the tasks and runs in `expected_runs` exist,
+- that the header can be read and the file is not truncated: MNE warns about
+  an incomplete tag, the file is smaller than the data in the header, or the
+  last data buffer cannot be read,
+- that the recording is long enough for the PSD segments of its task,
+- that it has the `channels` EEG channels of config_eeg.py.
+
+The subjects are checked in parallel and the result is written to a manifest,
+one row per recording, with one of the statuses:
+
+- 'ok'
+- 'missing': the recording does not exist (flagged)
+- 'incomplete': fewer EEG channels than expected (flagged)
+- 'unreadable': the header cannot be read (blocking)
+- 'truncated': the data ends before the header says it does (blocking)
+- 'short': too short for the PSD segments (blocking)
+
+`run_files.py --preflight` runs the scan first, or uses an earlier manifest
+with ``--manifest``, and skips the subjects with a blocking recording. The
+flagged ones are processed, but listed with a warning.
+
+To check all subjects in the raw data folder:
+python preflight.py --n_jobs 16
+"""
+
+import argparse
+import csv
+import multiprocessing
+import os
+import re
+import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+from mne import pick_types
+from mne.io import read_raw_fif
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+from config_eeg import fname, all_subjects, channels, read_segments
+
+# The runs of each task that every subject should have
+expected_runs = {'ec': [1], 'eo': [1], 'PASAT': [1, 2]}
+
+# The statuses for which the subject is not processed
+blocking_statuses = ['unreadable', 'truncated', 'short']
+
+manifest_fields = ['subject', 'task', 'run', 'status', 'n_eeg', 'sfreq',
+                   'duration', 'size_mb', 'message']
+
+# Size of a sample in the raw files, by `raw.orig_format`
+_sample_bytes = {'short': 2, 'int': 4, 'single': 4, 'double': 8}
+
+
+def required_duration(task):
+    """Get the length (in seconds) a recording needs for its PSD segments."""
+    # The PASAT runs have their own segments, e.g. PASAT_run1
+    return max(tmax for segment_task, segments in read_segments().items()
+               if segment_task == task or segment_task.startswith(task + '_run')
+               for _, _, tmax in segments)
+
+
+def check_recording(raw_fname, task, n_eeg=channels):
+    """Check one raw recording.
+
+    Parameters
+    ----------
+    raw_fname : str | Path
+        The raw data file.
+    task : str
+        The task of the recording, one of the keys of `expected_runs`.
+    n_eeg : int
+        The number of EEG channels the recording should have.
+
+    Returns
+    -------
+    row : dict
+        The status of the recording, the properties that were checked and, if
+        something is wrong, a message saying what. See `manifest_fields`.
+    """
+    row = dict(status='ok', n_eeg='', sfreq='', duration='', size_mb='', message='')
+    if not os.path.exists(raw_fname):
+        return dict(row, status='missing', message=f'{raw_fname} does not exist')
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        try:
+            # Only the header is read
+            raw = read_raw_fif(raw_fname, preload=False, verbose='warning')
+        except Exception as e:
+            return dict(row, status='unreadable', message=f'{type(e).__name__}: {e}')
+    size = sum(os.path.getsize(filename) for filename in raw.filenames)
+    n_times = raw.n_times
+    sfreq = raw.info['sfreq']
+    picks = pick_types(raw.info, meg=False, eeg=True, exclude=[])
+    row.update(n_eeg=len(picks), sfreq=sfreq, duration=round(n_times / sfreq, 3),
+               size_mb=round(size / 1e6, 1))
+
+    # MNE stops reading at an incomplete tag and only warns about it
+    tag_warnings = [str(w.message) for w in caught
+                    if 'truncated' in str(w.message) or 'Invalid tag' in str(w.message)]
+    if tag_warnings:
+        return dict(row, status='truncated', message=tag_warnings[0])
+    data_bytes = len(raw.ch_names) * n_times * _sample_bytes.get(raw.orig_format, 4)
+    if size < data_bytes:
+        return dict(row, status='truncated',
+                    message=f'{size} bytes on disk, {data_bytes} bytes of data in the header')
+    try:
+        # Reads only the last buffer of the file
+        raw.get_data(picks=picks[:1], start=n_times - 1)
+    except Exception as e:
+        return dict(row, status='truncated', message=f'{type(e).__name__}: {e}')
+
+    if n_times / sfreq < required_duration(task):
+        return dict(row, status='short',
+                    message=f'{n_times / sfreq:.1f} s, {required_duration(task)} s needed')
+    if len(picks) < n_eeg:
+        return dict(row, status='incomplete', message=f'{len(picks)} EEG channels, {n_eeg} expected')
+    return row
+
+
+def check_subject(subject, ses='01'):
+    """Check all the expected recordings of a subject.
+
+    Parameters
+    ----------
+    subject : str
+        The subject.
+    ses : str
+        The measurement session.
+
+    Returns
+    -------
+    rows : list of dict
+        One row of the manifest per recording, see `check_recording`.
+    """
+    rows = []
+    for task, runs in expected_runs.items():
+        for run in runs:
+            raw_fname = fname.raw(subject=subject, ses=ses, task=task, run=run)
+            rows.append(dict(subject=subject, task=task, run=run,
+                             **check_recording(raw_fname, task)))
+    return rows
+
+
+def run_preflight(subjects, n_jobs=1):
+    """Check the recordings of several subjects in parallel.
+
+    Parameters
+    ----------
+    subjects : list of str
+        The subjects.
+    n_jobs : int
+        Number of subjects checked in parallel.
+
+    Returns
+    -------
+    manifest : list of dict
+        The rows of the manifest of all subjects, in order.
+    """
+    manifest = []
+    if n_jobs == 1:
+        for subject in subjects:
+            manifest += check_subject(subject)
+        return manifest
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as pool:
+        for future in [pool.submit(check_subject, subject) for subject in subjects]:
+            manifest += future.result()
+    return manifest
+
+
+def write_manifest(manifest, filename='preflight_manifest.csv'):
+    """Write the manifest to a CSV file and print a summary of the problems."""
+    with open(filename, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=manifest_fields)
+        writer.writeheader()
+        writer.writerows(manifest)
+
+    subjects = {row['subject'] for row in manifest}
+    problems = [row for row in manifest if row['status'] != 'ok']
+    print('\n###################################################')
+    print(f'Checked {len(manifest)} recordings of {len(subjects)} subjects, '
+          f'{len(problems)} with problems')
+    for row in problems:
+        print(f'{row["subject"]} {row["task"]} run {row["run"]}: {row["status"]} ({row["message"]})')
+    print(f'Manifest written to {filename}')
+    print('###################################################\n')
+
+
+def read_manifest(filename='preflight_manifest.csv'):
+    """Read a manifest written by `write_manifest`."""
+    with open(filename, newline='') as file:
+        return list(csv.DictReader(file))
+
+
+def blocked_subjects(manifest):
+    """Get the subjects that have a recording with a blocking status.
+
+    Returns
+    -------
+    blocked : dict
+        For each blocked subject, the reason, e.g. 'ec run 1: truncated'.
+    """
+    blocked = dict()
+    for row in manifest:
+        if row['status'] in blocking_statuses:
+            reason = f'{row["task"]} run {row["run"]}: {row["status"]}'
+            if row['subject'] in blocked:
+                reason = f'{blocked[row["subject"]]}; {reason}'
+            blocked[row['subject']] = reason
+    return blocked
+
+
+def flagged_recordings(manifest):
+    """Get the recordings that are missing or incomplete, but not blocking."""
+    return [row for row in manifest
+            if row['status'] != 'ok' and row['status'] not in blocking_statuses]
+
+
+if __name__ == '__main__':
+    # Save time of beginning of the execution to measure running time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('subjects', nargs='*', help='The subjects to check. Default: all subjects in the raw data folder')
+    parser.add_argument('--n_jobs', type=int, help='Number of subjects checked in parallel. Default: 1', default=1)
+    parser.add_argument('--manifest', help='The file to write the manifest to. Default: preflight_manifest.csv', default='preflight_manifest.csv')
+    args = parser.parse_args()
+
+    subjects = args.subjects or sorted(subject for subject in all_subjects
+                                       if re.match(r'^\d{2}[PC]', subject))
+    write_manifest(run_preflight(subjects, n_jobs=args.n_jobs), args.manifest)
+
+    execution_time = (time.time() - start_time)
+    print('\n###################################################\n')
+    print(f'Execution time of preflight.py is: {round(execution_time,2)} seconds\n')
+    print('###################################################\n')
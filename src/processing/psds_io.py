@@ -0,0 +1,179 @@
+"""
+Write and read the PSD files (one per subject, see ``fname.psds``).
+
+The PSDs of all the recordings of a subject are stored in one HDF5 file:
+
+    /freqs                  the frequencies (float64), shared by all the PSDs
+    /info                   the EEG channels of the PSDs: their names and
+                            positions, and the sampling frequency
+    /psds/<task>/<segment>  the PSD of a segment (EEG channels x frequencies),
+                            as float32, with its tmin and tmax as attributes
+
+Each PSD is chunked by channel and optionally compressed
+(``psd_compression`` in config_eeg.py), so `read_psds` only reads the tasks,
+segments and channels that are asked for, instead of the whole file.
+
+The file is written by `write_psds` in one go, into a temporary file that then
+replaces the previous one, so a reader never sees a half-written file.
+"""
+
+import os
+import sys
+
+import h5py
+import numpy as np
+from mne import create_info, pick_info, pick_types
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+from config_eeg import psd_compression
+
+
+def write_psds(fname, psds, freqs, info, segments, compression=psd_compression):
+    """Write the PSDs of a subject.
+
+    Parameters
+    ----------
+    fname : str | Path
+        The PSD file.
+    psds : dict of ndarray
+        The PSD (EEG channels x frequencies) of each segment, by segment name.
+    freqs : ndarray
+        The frequencies of the PSDs.
+    info : instance of Info
+        The measurement info of a recording. Only its EEG channels are kept,
+        they are the rows of the PSDs.
+    segments : dict
+        The task, tmin and tmax of each segment, by segment name, see
+        `segment_index` in 03_psds.py. The segments are written in this
+        order.
+    compression : str | None
+        The compression of the PSDs, e.g. 'gzip' or 'lzf'. None to not
+        compress them.
+    """
+    info = pick_info(info, pick_types(info, meg=False, eeg=True, exclude=[]))
+    tmp = str(fname) + '.tmp'
+    os.makedirs(os.path.dirname(os.path.abspath(tmp)), exist_ok=True)
+    with h5py.File(tmp, 'w') as f:
+        f.create_dataset('freqs', data=np.asarray(freqs, dtype=np.float64))
+
+        info_group = f.create_group('info')
+        info_group.attrs['sfreq'] = info['sfreq']
+        info_group.create_dataset('ch_names', data=np.array(info['ch_names'], dtype='S'))
+        info_group.create_dataset('ch_pos', data=np.array([ch['loc'][:3] for ch in info['chs']]))
+
+        psds_group = f.create_group('psds', track_order=True)
+        for name, segment in segments.items():
+            task = segment['task']
+            if task not in psds_group:
+                psds_group.create_group(task, track_order=True)
+            psd = np.asarray(psds[name], dtype=np.float32)
+            dataset = psds_group[task].create_dataset(
+                name, data=psd, chunks=(1, psd.shape[1]), compression=compression,
+                shuffle=compression is not None)
+            for key in ('tmin', 'tmax'):
+                if key in segment:
+                    dataset.attrs[key] = segment[key]
+    os.replace(tmp, fname)
+
+
+def read_index(fname):
+    """Read which segments are in a PSD file.
+
+    Parameters
+    ----------
+    fname : str | Path
+        The PSD file.
+
+    Returns
+    -------
+    segments : dict
+        The task, tmin and tmax of each segment, by segment name, in the
+        order they were written.
+    """
+    segments = dict()
+    with h5py.File(fname, 'r') as f:
+        for task, task_group in f['psds'].items():
+            for name, dataset in task_group.items():
+                segments[name] = dict(task=task, **{key: float(value)
+                                                    for key, value in dataset.attrs.items()})
+    return segments
+
+
+def read_freqs(fname):
+    """Read the frequencies of the PSDs in a PSD file."""
+    with h5py.File(fname, 'r') as f:
+        return f['freqs'][()]
+
+
+def read_info(fname):
+    """Read the EEG channels of the PSDs in a PSD file.
+
+    Returns
+    -------
+    info : instance of Info
+        The measurement info of the EEG channels, with their positions.
+    """
+    with h5py.File(fname, 'r') as f:
+        ch_names = [ch_name.decode() for ch_name in f['info/ch_names'][()]]
+        ch_pos = f['info/ch_pos'][()]
+        sfreq = float(f['info'].attrs['sfreq'])
+    info = create_info(ch_names, sfreq, 'eeg')
+    with info._unlock():
+        for ch, pos in zip(info['chs'], ch_pos):
+            ch['loc'][:3] = pos
+    return info
+
+
+def read_psds(fname, tasks=None, segments=None, picks=None):
+    """Read PSDs from a PSD file.
+
+    Only the requested PSDs, and rows of them, are read from the file.
+
+    Parameters
+    ----------
+    fname : str | Path
+        The PSD file.
+    tasks : list of str | None
+        The tasks whose segments are read. None for all the tasks.
+    segments : list of str | None
+        The segments that are read, by name. None for all the segments of
+        ``tasks``.
+    picks : list of str | list of int | None
+        The channels, by name or index. None for all the channels.
+
+    Returns
+    -------
+    psds : dict of ndarray
+        The PSD (channels x frequencies) of each segment, by segment name.
+    freqs : ndarray
+        The frequencies of the PSDs.
+    """
+    psds = dict()
+    with h5py.File(fname, 'r') as f:
+        freqs = f['freqs'][()]
+        rows = _pick_rows(f, picks)
+        for task, task_group in f['psds'].items():
+            if tasks is not None and task not in tasks:
+                continue
+            for name, dataset in task_group.items():
+                if segments is not None and name not in segments:
+                    continue
+                psds[name] = dataset[()] if rows is None else dataset[rows[0]][rows[1]]
+    if segments is not None:
+        missing = [name for name in segments if name not in psds]
+        if missing:
+            raise ValueError(f'Segments {missing} are not in {fname}')
+    return psds, freqs
+
+
+def _pick_rows(f, picks):
+    """Get the rows to read (in increasing order, as h5py needs them), and
+    their order in the result."""
+    if picks is None:
+        return None
+    ch_names = [ch_name.decode() for ch_name in f['info/ch_names'][()]]
+    picks = np.array([ch_names.index(pick) if isinstance(pick, str) else pick
+                      for pick in picks], dtype=int)
+    rows, order = np.unique(picks, return_inverse=True)
+    return rows, order
@@ -0,0 +1,253 @@
+"""
+Quality control (QC) figures of the processing steps.
+
+The processing steps put a number of QC figures in the report of each subject:
+segments of the raw data and power spectra before and after filtering, the
+ICA components and overlays, and a topographic plot of the PSDs. Making these
+figures takes a large part of the running time. There are three QC modes:
+
+- 'inline': the figures are made and put in the report by the steps
+  themselves (the default).
+- 'deferred': the steps only save the small arrays that the figures need
+  (e.g. a 10 s segment of the data, or the power spectra) in
+  ``fname.qc_dir``. The figures and reports are made afterwards by
+  `render_cohort`, using a separate pool of workers.
+- 'off': no QC figures are made.
+
+To render the deferred QC figures of all subjects in subjects.txt:
+python qc.py --n_jobs 4
+
+The data of a figure is removed once the figure has been added to the report.
+"""
+
+import argparse
+import glob
+import importlib
+import multiprocessing
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from h5io import read_hdf5, write_hdf5
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+from config_eeg import fname
+
+qc_modes = ['off', 'deferred', 'inline']
+
+
+def raw_segment(raw, n_channels=30, duration=10.):
+    """Get the data shown by `raw.plot`: the start of the first channels.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The data.
+    n_channels : int
+        Number of channels.
+    duration : float
+        Length of the segment, in seconds.
+
+    Returns
+    -------
+    segment : dict
+        The data (as float32) and what is needed to plot it.
+    """
+    picks = np.arange(min(n_channels, len(raw.ch_names)))
+    stop = min(int(round(duration * raw.info['sfreq'])), raw.n_times)
+    return dict(data=raw.get_data(picks=picks, stop=stop).astype(np.float32),
+                ch_names=[raw.ch_names[pick] for pick in picks],
+                ch_types=[raw.get_channel_types()[pick] for pick in picks],
+                bads=[bad for bad in raw.info['bads'] if bad in raw.ch_names[:len(picks)]],
+                sfreq=raw.info['sfreq'])
+
+
+def psd_arrays(raw, fmin, fmax):
+    """Get the power spectra of the EEG channels, as shown by `spectrum.plot`.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The data.
+    fmin : float
+        The lowest frequency.
+    fmax : float
+        The highest frequency.
+
+    Returns
+    -------
+    psd : dict
+        The power spectra and their frequencies.
+    """
+    spectrum = raw.compute_psd(fmin=fmin, fmax=fmax, picks='eeg', exclude=[])
+    return dict(psd=spectrum.get_data(), freqs=spectrum.freqs)
+
+
+def save_qc_data(subject, name, data):
+    """Save the data of deferred QC figures.
+
+    Parameters
+    ----------
+    subject : str
+        The subject the figures belong to.
+    name : str
+        Unique name of the figures, e.g. 'filtering_ec'.
+    data : dict
+        The data. The key 'kind' determines how it is rendered.
+    """
+    qc_fname = fname.qc_data(subject=subject, name=name)
+    qc_fname.parent.mkdir(parents=True, exist_ok=True)
+    write_hdf5(qc_fname, data, overwrite=True)
+
+
+def save_qc_evoked(subject, name, evoked):
+    """Save an evoked response needed by deferred QC figures.
+
+    Returns
+    -------
+    evoked_fname : str | None
+        The file name to put in the QC data, or None if there is no evoked
+        response.
+    """
+    if evoked is None:
+        return None
+    evoked_fname = fname.qc_evoked(subject=subject, name=name)
+    evoked_fname.parent.mkdir(parents=True, exist_ok=True)
+    evoked.save(evoked_fname, overwrite=True)
+    return str(evoked_fname)
+
+
+def plot_raw_segment(segment, title=''):
+    """Plot a segment saved by `raw_segment`."""
+    from mne import create_info
+    from mne.io import RawArray
+    info = create_info(segment['ch_names'], segment['sfreq'], segment['ch_types'])
+    info['bads'] = list(segment['bads'])
+    raw = RawArray(segment['data'].astype(np.float64), info, verbose=False)
+    return raw.plot(n_channels=len(segment['ch_names']), title=title, show=False)
+
+
+def plot_psd_arrays(psd, title=''):
+    """Plot the power spectra saved by `psd_arrays`, in dB like MNE does."""
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(8, 4))
+    psd_db = 10 * np.log10(psd['psd'] * 1e12)  # V²/Hz to dB(µV²/Hz)
+    ax.plot(psd['freqs'], psd_db.T, color='k', linewidth=0.5, alpha=0.3)
+    ax.plot(psd['freqs'], psd_db.mean(axis=0), color='tab:blue', linewidth=1.5)
+    ax.set(xlabel='Frequency (Hz)', ylabel='µV²/Hz (dB)', title=title,
+           xlim=(psd['freqs'][0], psd['freqs'][-1]))
+    return fig
+
+
+def render_item(report, data):
+    """Make the figures of one deferred QC item and add them to a report."""
+    # Use importlib, as the module names start with a number
+    if data['kind'] == 'filtering':
+        freqfilt = importlib.import_module('01_freqfilt')
+        date_time = data.get('date_time', '')
+        figures = {
+            'raw segment': [plot_raw_segment(data['raw segment'], date_time)],
+            'interpolated segment': [plot_raw_segment(data['interpolated segment'],
+                                                      date_time + data['task'])],
+            'before filt': [plot_psd_arrays(data['before filt'])],
+            'after filt': [plot_psd_arrays(data['after filt'])],
+        }
+        freqfilt.add_figures_to_report(report, figures, [data['task']])
+    elif data['kind'] == 'ica':
+        from mne import read_evokeds
+        from mne.preprocessing import read_ica
+        ica_step = importlib.import_module('02_ica')
+        ica = read_ica(data['ica_fname'])
+        artifacts = dict(data)
+        for kind in ('eog', 'ecg'):
+            evoked_fname = data.get(f'{kind}_evoked_fname')
+            artifacts[f'{kind}_evoked'] = (None if evoked_fname is None
+                                           else read_evokeds(evoked_fname)[0])
+        ica_step.add_ica_to_report(report, ica, None, data['task'], artifacts,
+                                   data.get('date_time', ''))
+    elif data['kind'] == 'psds':
+        from mne.io import read_info
+        psds_step = importlib.import_module('03_psds')
+        info = read_info(data['info_fname'], verbose=False)
+        report.add_figure(psds_step.plot_psds(data['psds'], info), 'PSDs', replace=True)
+    else:
+        raise ValueError(f'Unknown kind of QC data: {data["kind"]}')
+
+
+def render_subject(subject):
+    """Add the deferred QC figures of a subject to its report.
+
+    Parameters
+    ----------
+    subject : str
+        The subject.
+
+    Returns
+    -------
+    n_items : int
+        Number of QC items that were rendered.
+    """
+    import matplotlib.pyplot as plt
+    from mne import open_report
+
+    qc_fnames = sorted(glob.glob(str(fname.qc_data(subject=subject, name='*'))))
+    if not qc_fnames:
+        return 0
+    rendered = []
+    with open_report(fname.report(subject=subject)) as report:
+        for qc_fname in qc_fnames:
+            data = read_hdf5(qc_fname)
+            render_item(report, data)
+            plt.close('all')
+            rendered.append(qc_fname)
+            rendered += [data[key] for key in ('eog_evoked_fname', 'ecg_evoked_fname')
+                         if data.get(key) is not None]
+        report.save(fname.report_html(subject=subject), overwrite=True,
+                    open_browser=False)
+    # The report has been saved, the data is no longer needed
+    for rendered_fname in rendered:
+        if os.path.exists(rendered_fname):
+            os.remove(rendered_fname)
+    return len(qc_fnames)
+
+
+def render_cohort(subjects, n_jobs=1):
+    """Render the deferred QC figures of several subjects in parallel.
+
+    Parameters
+    ----------
+    subjects : list of str
+        The subjects.
+    n_jobs : int
+        Number of subjects rendered in parallel.
+    """
+    if n_jobs == 1:
+        for subject in subjects:
+            render_subject(subject)
+        return
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as pool:
+        for subject, future in [(subject, pool.submit(render_subject, subject))
+                                for subject in subjects]:
+            try:
+                n_items = future.result()
+                print(f'INFO: Rendered {n_items} QC items of subject {subject}')
+            except Exception as e:
+                print(f'ERROR: Rendering the QC figures of subject {subject} failed: {e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('subjects', nargs='*', help='The subjects to render. Default: the subjects in subjects.txt')
+    parser.add_argument('--n_jobs', type=int, help='Number of subjects rendered in parallel. Default: 1', default=1)
+    args = parser.parse_args()
+
+    subjects = args.subjects
+    if not subjects:
+        with open('subjects.txt', 'r') as subjects_file:
+            subjects = [line.rstrip() for line in subjects_file.readlines()
+                        if re.match(r'^\d{2}[PC]', line)]
+    render_cohort(subjects, n_jobs=args.n_jobs)
@@ -0,0 +1,94 @@
+"""
+Collect the quality control items of all the steps in one report per subject.
+
+The report of a subject is an HDF5 file with all the items added so far, plus
+an HTML page. Opening it with `open_report`, adding items and saving it
+rewrites both files completely, so doing that in every step (and in 02_ica.py
+for every recording) serializes the growing report over and over again.
+
+Here, the report of a subject is read at most once per process and kept in
+memory. The steps add their items to it with `get_report`, which keeps the
+items already in the report, and call `save_report` when they are done.
+Within `collect`, saving is postponed until the end of the block: the
+scheduler runs the whole chain of a subject in it, so that the report of the
+subject is written once, whatever the number of steps and recordings. A step
+run on its own writes the report once, at its end.
+"""
+
+import os
+import sys
+from contextlib import contextmanager
+
+from mne import open_report
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+from config_eeg import fname
+from profiling import profiled
+
+# The reports that have been changed and not saved yet, by subject
+_reports = dict()
+
+# Whether saving is postponed until the end of `collect`
+_collecting = False
+
+
+def get_report(subject):
+    """Get the report of a subject, to add items to it.
+
+    Parameters
+    ----------
+    subject : str
+        The subject.
+
+    Returns
+    -------
+    report : instance of Report
+        The report, with the items that have been saved before and the ones
+        added since.
+    """
+    if subject not in _reports:
+        _reports[subject] = open_report(fname.report(subject=subject))
+    return _reports[subject]
+
+
+def _write_report(subject):
+    """Write the HDF5 file and the HTML page of a report."""
+    report = _reports.pop(subject)
+    with profiled('report_save', subject=subject):
+        report.save(fname.report(subject=subject), overwrite=True)
+        report.save(fname.report_html(subject=subject), overwrite=True,
+                    open_browser=False)
+
+
+def save_report(subject):
+    """Save the report of a subject, unless this is postponed by `collect`.
+
+    Nothing is written if no items were added to the report.
+
+    Parameters
+    ----------
+    subject : str
+        The subject.
+    """
+    if subject in _reports and not _collecting:
+        _write_report(subject)
+
+
+@contextmanager
+def collect():
+    """Postpone saving the reports until the end of the block.
+
+    The reports are also saved if the block raises an error, so that the
+    items of the steps that did finish are kept.
+    """
+    global _collecting
+    outer = _collecting
+    _collecting = True
+    try:
+        yield
+    finally:
+        _collecting = outer
+        if not outer:
+            for subject in list(_reports):
+                _write_report(subject)
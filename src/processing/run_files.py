@@ -3,7 +3,19 @@
 """
 Created on Wed Mar 15 11:23:04 2023
 
-Runs the scripts in the processing folder 
+Runs the scripts in the processing folder for all the subjects in subjects.txt.
+Subjects are processed in parallel using `n_jobs` workers (as defined in
+config_common.py, or with the --n_jobs argument), see scheduler.py. The cores
+of the machine (n_cores in config_common.py, or --n_cores) are split between
+the workers as BLAS threads, see blas_threads.py. With --n_jobs 1, all
+subjects and steps are run within this one process. With
+--fused, each recording is carried through all the steps in memory and only the
+final outputs are written (see fused.py). With --qc deferred, the steps only
+save the data of the quality control figures, and the reports are rendered
+by a separate pool of workers once all subjects have been processed (see
+qc.py). With --preflight, the raw recordings of the subjects are checked first
+and the subjects with a corrupted, truncated or too short recording are
+skipped (see preflight.py); --manifest uses the result of an earlier check.
 
 It could also be done in bash using something like 
     # Define the arguments for the first file
@@ -19,60 +31,106 @@ It could also be done in bash using something like
 @author: portae1
 """
 
-import subprocess
+import argparse
 import time
 import re
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+from config_common import n_jobs, n_cores, memory_budget
+from profiling import enable_profiling
+from scheduler import run_cohort, write_summary, steps, fused_steps
+from qc import qc_modes, render_cohort
+from preflight import run_preflight, write_manifest, read_manifest, blocked_subjects, flagged_recordings
+
+# The stages that make quality control figures
+qc_stages = ['freqfilt', 'ica', 'psds', 'fused']
 
 # Flag used for test run
 TEST_RUN = False
 
 
-# Save time of beginning of the execution to measure running time
-here_start_time = time.time()
-
-# Define a list of tuples containing the different argument combinations to use
-#subjects = ['10C', '30P']
-arg_set = [('--freq_band_type', 'thin'),
-            ('--freq_band_type', 'wide'),]
-
-subject_pattern = r'^\d{2}[PC]'   
-
-
-if TEST_RUN:
-    subjects = ['10C', '11P']
-else:
-    try:
-        with open('subjects.txt', 'r') as subjects_file:
-            subjects = [line.rstrip() for line in subjects_file.readlines()]
-            # Assert that each line has the expected format
-            for line in subjects:
-                assert re.match(subject_pattern, line), f"Subject '{line}' does not have the expected format."
-
-    except FileNotFoundError as e:
-        print("The file 'subjects.txt' does not exist in the current directory. The program will exit.")
-        raise e
-
-for subject in subjects:
-    print(f'### \nRunning using subject {subject}...\n')
-    # Call the first Python 
-    subprocess.run(['python3', '01_freqfilt.py', subject])
-    print(f'Finished executing 01_freqfilt for subject {subject}\n')
-    # Call the second Python file
-    subprocess.run(['python3', '02_ica.py', subject])
-    print(f'Finished executing 02_ica for subject {subject}\n')
-    # Call the third script
-    subprocess.run(['python3', '03_psds.py', subject])
-    print(f'Finished executing 03_psds for subject {subject}\n')
-    # Create bandpowers
-    for arg in arg_set:
-        subprocess.run(['python3', '04_bandpower.py', subject] + list(arg))
-    print(f'Finished executing 04_bandpower for subject {subject}\n')
-    
+if __name__ == '__main__':
+    # Save time of beginning of the execution to measure running time
+    here_start_time = time.time()
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n_jobs', type=int, help=f'Number of subjects processed in parallel. Default: {n_jobs}', default=n_jobs)
+    parser.add_argument('--n_cores', type=int, help='Number of cores the subjects processed in parallel may use together, split between them as BLAS threads. Default: as defined in config_common.py, or all the cores', default=n_cores)
+    parser.add_argument('--memory_budget', type=float, help='Memory (in GB) the subjects processed in parallel may use together. Default: as defined in config_common.py, or 80%% of the physical memory', default=memory_budget)
+    parser.add_argument('--force', action='store_true', help='Process all recordings, also the ones whose output is up to date. Default: False', default=False)
+    parser.add_argument('--profile', help='Append the time and memory used by each step to this JSONL file, see profiling.py. Default: no profiling', default=None)
+    parser.add_argument('--fused', action='store_true', help='Run all steps in memory, without writing the filtered and cleaned data. Default: False', default=False)
+    parser.add_argument('--save_intermediate', action='store_true', help='With --fused, also save the filtered and cleaned data. Default: False', default=False)
+    parser.add_argument('--qc', choices=qc_modes, help='Make the quality control figures during the processing, save their data and render them afterwards, or skip them. Default: inline', default='inline')
+    parser.add_argument('--preflight', action='store_true', help='Check the raw recordings first, write preflight_manifest.csv and skip the subjects whose recordings are broken. Default: False', default=False)
+    parser.add_argument('--manifest', help='Skip the subjects whose recordings are broken according to this manifest of an earlier check, see preflight.py. Default: no manifest', default=None)
+    args = parser.parse_args()
+
+    subject_pattern = r'^\d{2}[PC]'
+
+    if TEST_RUN:
+        subjects = ['10C', '11P']
+    else:
+        try:
+            with open('subjects.txt', 'r') as subjects_file:
+                subjects = [line.rstrip() for line in subjects_file.readlines()]
+                # Assert that each line has the expected format
+                for line in subjects:
+                    assert re.match(subject_pattern, line), f"Subject '{line}' does not have the expected format."
+
+        except FileNotFoundError as e:
+            print("The file 'subjects.txt' does not exist in the current directory. The program will exit.")
+            raise e
+
+    if args.profile is not None:
+        enable_profiling(args.profile)
+
+    # Leave out the subjects with broken recordings before any processing
+    manifest = None
+    if args.preflight:
+        manifest = run_preflight(subjects, n_jobs=args.n_jobs)
+        write_manifest(manifest)
+    elif args.manifest is not None:
+        manifest = read_manifest(args.manifest)
+    skipped = dict()
+    if manifest is not None:
+        skipped = {subject: reason for subject, reason in blocked_subjects(manifest).items()
+                   if subject in subjects}
+        for subject, reason in skipped.items():
+            print(f'WARNING: Skipping subject {subject} ({reason})')
+        for row in flagged_recordings(manifest):
+            if row['subject'] in subjects:
+                print(f'WARNING: Subject {row["subject"]}, {row["task"]} run {row["run"]}: '
+                      f'{row["status"]} ({row["message"]})')
+
+    # Run the steps for each subject, in order, using a pool of workers
+    if args.fused:
+        run_steps = [(stage, dict(kwargs, force=args.force, save_intermediate=args.save_intermediate))
+                     for stage, kwargs in fused_steps]
+    else:
+        run_steps = [(stage, dict(kwargs, force=args.force)) for stage, kwargs in steps]
+    for stage, kwargs in run_steps:
+        if stage in qc_stages:
+            kwargs['qc'] = args.qc
+    results = run_cohort([subject for subject in subjects if subject not in skipped],
+                         steps=run_steps, n_jobs=args.n_jobs,
+                         memory_budget=args.memory_budget, n_cores=args.n_cores)
+    results += [dict(subject=subject, step='preflight', status='skipped', seconds=0.0,
+                     error=reason) for subject, reason in skipped.items()]
+    write_summary(results)
+
+    # Build the reports from the saved quality control data
+    if args.qc == 'deferred':
+        render_cohort([subject for subject in subjects if subject not in skipped],
+                      n_jobs=args.n_jobs)
 
-# Calculate time that the script takes to run
-here_execution_time = (time.time() - here_start_time)
-print('\n###################################################')
-print('Processing pipeline has finalized executing')
-print(f'Total execution time is: {round(here_execution_time/60,1)} minutes')
-print(f'Average time is {round(here_execution_time/len(subjects),1)} seconds per subject')
-print('###################################################\n')
+    # Calculate time that the script takes to run
+    here_execution_time = (time.time() - here_start_time)
+    print('\n###################################################')
+    print('Processing pipeline has finalized executing')
+    print(f'Total execution time is: {round(here_execution_time/60,1)} minutes')
+    print(f'Average time is {round(here_execution_time/len(subjects),1)} seconds per subject')
+    print('###################################################\n')
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs the processing chain for a whole cohort using a pool of workers.
+
+Each subject is one job: its steps (01_freqfilt.py, 02_ica.py, 03_psds.py and
+04_bandpower.py) are executed in order inside a single worker, while different
+subjects are processed in parallel. The steps are the importable `run_*`
+functions of the processing scripts, which are called directly instead of
+spawning a new interpreter for every step of every subject. Heavy imports
+(mne, matplotlib) and reading the configuration are therefore paid once per
+worker. With ``n_jobs=1``, all subjects and steps run in the current process.
+
+The steps add their quality control figures to the report of the subject in
+memory, and the report is written once, after the last step (see reports.py).
+
+Alternatively, the steps can be run as one fused stage (``fused_steps``), which
+does not write the intermediate files of each recording to disk.
+
+Since every step loads whole recordings into memory, running too many subjects
+at once can exhaust the memory of the machine. The memory needed by each
+subject is therefore estimated beforehand from the headers of its raw files,
+and a subject is only started while the estimates of the running subjects fit
+within the memory budget. Subjects that do not fit are queued until enough
+memory is freed.
+
+The cores of the machine are split between the workers and the BLAS threads
+of each worker, so that the parallel subjects do not oversubscribe the cores
+(see blas_threads.py).
+
+When all subjects are done, one summary with the timing and the outcome of
+each (subject, step) pair is written to disk.
+"""
+
+import os
+import sys
+import csv
+import time
+import importlib
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+PROCESSING_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(PROCESSING_DIR))
+from profiling import profiled
+from blas_threads import blas_threads, get_core_budget, set_blas_threads, split_budget
+
+# The per-subject processing chain, in the order in which it must be run.
+# Each entry contains the name of the stage and the extra arguments for it.
+steps = [
+    ('freqfilt', dict()),
+    ('ica', dict()),
+    ('psds', dict()),
+    ('bandpower', dict(freq_band_type='thin')),
+    ('bandpower', dict(freq_band_type='wide')),
+]
+
+# The same chain, keeping each recording in memory from one step to the next
+# (see fused.py)
+fused_steps = [
+    ('fused', dict()),
+]
+
+# Estimated peak memory use of processing a recording, relative to the size of
+# its EEG, EOG, ECG and stim channels as float64. Filtering and ICA need some
+# working memory on top of the data itself.
+memory_overhead = 2
+
+# Memory used by a worker process before any data is loaded (mne, matplotlib)
+worker_memory = 0.5e9
+
+# The module and function implementing each stage
+stage_functions = {
+    'freqfilt': ('01_freqfilt', 'run_freqfilt'),
+    'ica': ('02_ica', 'run_ica'),
+    'psds': ('03_psds', 'run_psds'),
+    'bandpower': ('04_bandpower', 'run_bandpower'),
+    'fused': ('fused', 'run_fused'),
+}
+
+
+def get_stage(name):
+    """Get the function implementing a processing stage.
+
+    The modules are imported only once per process.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage, one of the keys of `stage_functions`.
+
+    Returns
+    -------
+    stage : function
+        The function, which takes the subject as first argument.
+    """
+    if PROCESSING_DIR not in sys.path:
+        sys.path.insert(0, PROCESSING_DIR)
+    module_name, function_name = stage_functions[name]
+    # Use importlib, as the module names start with a number
+    module = importlib.import_module(module_name)
+    return getattr(module, function_name)
+
+
+def run_step(stage, subject, kwargs=None):
+    """Run one of the processing stages for a subject in the current process.
+
+    Parameters
+    ----------
+    stage : str
+        The name of the stage, one of the keys of `stage_functions`.
+    subject : str
+        The subject to process.
+    kwargs : dict | None
+        Extra arguments for the stage.
+    """
+    import matplotlib.pyplot as plt
+
+    if kwargs is None:
+        kwargs = dict()
+    try:
+        with profiled('total', subject=subject, stage=stage):
+            get_stage(stage)(subject, **kwargs)
+    finally:
+        # The stages do not close their quality control figures. In a
+        # long-lived process these would pile up from subject to subject.
+        plt.close('all')
+
+
+def process_subject(subject, steps=steps):
+    """Run the whole processing chain for one subject.
+
+    The steps are run in order. Since each step reads the output of the
+    previous one, the chain is stopped for this subject at the first failure.
+
+    Parameters
+    ----------
+    subject : str
+        The subject to process.
+    steps : list of tuple
+        The (stage, kwargs) pairs to run.
+
+    Returns
+    -------
+    results : list of dict
+        One entry per step, containing the subject, the step, its status
+        ('ok', 'failed' or 'skipped'), the running time and the error message
+        in case of failure.
+    """
+    if PROCESSING_DIR not in sys.path:
+        sys.path.insert(0, PROCESSING_DIR)
+    import reports
+
+    results = []
+    failed = False
+    # The steps add their quality control figures to the report of the
+    # subject, which is written once, after the last step
+    with reports.collect():
+        for stage, kwargs in steps:
+            step = ' '.join([stage] + [f'{key}={value}' for key, value in kwargs.items()])
+            if failed:
+                results.append(dict(subject=subject, step=step, status='skipped',
+                                    seconds=0.0, error=''))
+                continue
+            print(f'INFO: Running {step} for subject {subject}')
+            start_time = time.time()
+            try:
+                run_step(stage, subject, kwargs)
+                status, error = 'ok', ''
+            except Exception as e:
+                traceback.print_exc()
+                status, error = 'failed', f'{type(e).__name__}: {e}'
+                failed = True
+            results.append(dict(subject=subject, step=step, status=status,
+                                seconds=round(time.time() - start_time, 2),
+                                error=error))
+    return results
+
+
+def run_cohort(subjects, steps=steps, n_jobs=1, memory_budget=None, n_cores=None):
+    """Run the processing chain for all subjects using a pool of workers.
+
+    Parameters
+    ----------
+    subjects : list of str
+        The subjects to process.
+    steps : list of tuple
+        The (stage, kwargs) pairs to run for each subject, in order.
+    n_jobs : int
+        Maximum number of subjects to process in parallel.
+    memory_budget : float | None
+        The memory (in GB) the subjects processed in parallel may use
+        together, see `get_memory_budget`.
+    n_cores : int | None
+        The number of cores the workers may use together, see
+        `get_core_budget`. Each worker gets an equal share of them as BLAS
+        threads.
+
+    Returns
+    -------
+    results : list of dict
+        The per-step results of all subjects, see `process_subject`.
+    """
+    results = []
+    n_jobs, n_threads = split_budget(get_core_budget(n_cores), n_jobs)
+    if n_jobs == 1:
+        with blas_threads(n_threads):
+            for subject in subjects:
+                results.extend(process_subject(subject, steps))
+        return results
+    print(f'INFO: {n_jobs} workers with {n_threads} BLAS thread(s) each')
+
+    # Use fresh worker processes instead of forking, as the parent might
+    # already have initialized BLAS thread pools or a GUI backend.
+    context = multiprocessing.get_context('spawn')
+    budget = get_memory_budget(memory_budget)
+    estimates = {subject: estimate_memory(subject) for subject in subjects}
+    for subject in subjects:
+        if estimates[subject] > budget:
+            print(f'WARNING: Subject {subject} needs an estimated '
+                  f'{estimates[subject] / 1e9:.1f} GB, more than the memory '
+                  f'budget of {budget / 1e9:.1f} GB. It will be run on its own.')
+
+    pending = list(subjects)
+    futures = dict()
+    n_done = 0
+    # The workers inherit the number of threads from the environment
+    with blas_threads(n_threads), \
+            ProcessPoolExecutor(max_workers=n_jobs, mp_context=context,
+                                initializer=set_blas_threads, initargs=(n_threads,)) as pool:
+        while pending or futures:
+            for subject in select_admissible(pending, list(futures.values()),
+                                             estimates, budget, n_jobs):
+                pending.remove(subject)
+                futures[pool.submit(process_subject, subject, steps)] = subject
+            if pending and len(futures) < n_jobs:
+                print(f'INFO: {len(pending)} subject(s) waiting for memory to be freed')
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                subject = futures.pop(future)
+                n_done += 1
+                try:
+                    subject_results = future.result()
+                except Exception as e:
+                    # The worker itself died (e.g. it ran out of memory)
+                    subject_results = [dict(subject=subject, step='', status='failed',
+                                            seconds=0.0,
+                                            error=f'{type(e).__name__}: {e}')]
+                print(f'INFO: Finished subject {subject} ({n_done}/{len(subjects)})')
+                results.extend(subject_results)
+
+    # Report the subjects in the order in which they were requested
+    order = {subject: i for i, subject in enumerate(subjects)}
+    results.sort(key=lambda result: order[result['subject']])
+    return results
+
+
+def estimate_memory(subject):
+    """Estimate the peak memory needed to process a subject.
+
+    The estimate is based on the number of EEG, EOG, ECG and stim channels and
+    the number of samples in the headers of the raw files (the MEG channels are
+    never loaded). The recordings are processed one at a time, so the
+    largest one determines the peak.
+
+    Parameters
+    ----------
+    subject : str
+        The subject to process.
+
+    Returns
+    -------
+    n_bytes : float
+        The estimated peak memory, in bytes.
+    """
+    from mne import pick_types
+    from mne.io import read_raw_fif
+    if os.path.dirname(PROCESSING_DIR) not in sys.path:
+        sys.path.append(os.path.dirname(PROCESSING_DIR))
+    from config_eeg import get_all_fnames
+
+    largest = 0
+    for raw_fname in get_all_fnames(subject, kind='raw', exclude=['emptyroom']):
+        try:
+            # Only the header is read
+            raw = read_raw_fif(raw_fname, preload=False, verbose='error')
+        except Exception:
+            # The step itself will report the broken file
+            continue
+        n_channels = len(pick_types(raw.info, meg=False, eeg=True, eog=True,
+                                    stim=True, ecg=True, exclude=[]))
+        largest = max(largest, n_channels * raw.n_times * 8)
+    return worker_memory + memory_overhead * largest
+
+
+def get_memory_budget(memory_budget=None):
+    """Get the memory that the parallel jobs may use together, in bytes.
+
+    Parameters
+    ----------
+    memory_budget : float | None
+        The budget in GB. With None, 80% of the physical memory is used, or an
+        unlimited budget if that cannot be determined.
+
+    Returns
+    -------
+    n_bytes : float
+        The budget, in bytes.
+    """
+    if memory_budget is not None:
+        return memory_budget * 1e9
+    try:
+        return 0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return float('inf')
+
+
+def select_admissible(pending, running, estimates, budget, n_jobs):
+    """Select the queued subjects that can be started now.
+
+    Subjects are started in order, as long as there is a free worker and their
+    estimated memory fits in what is left of the budget. A subject that does
+    not fit lets the following (smaller) subjects go first. A subject that
+    does not fit in the budget at all is started once nothing else is running.
+
+    Parameters
+    ----------
+    pending : list of str
+        The subjects waiting to be started, in order.
+    running : list of str
+        The subjects currently being processed.
+    estimates : dict
+        The estimated memory of each subject, in bytes.
+    budget : float
+        The memory budget, in bytes.
+    n_jobs : int
+        The number of workers.
+
+    Returns
+    -------
+    admitted : list of str
+        The subjects to start.
+    """
+    admitted = []
+    used = sum(estimates[subject] for subject in running)
+    n_running = len(running)
+    for subject in pending:
+        if n_running >= n_jobs:
+            break
+        if n_running == 0 or used + estimates[subject] <= budget:
+            admitted.append(subject)
+            used += estimates[subject]
+            n_running += 1
+    return admitted
+
+
+def write_summary(results, filename='processing_summary.csv'):
+    """Write the per-subject timings and failures to a CSV file.
+
+    Parameters
+    ----------
+    results : list of dict
+        The output of `run_cohort`.
+    filename : str
+        The file to write the summary to.
+    """
+    with open(filename, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=['subject', 'step', 'status',
+                                                  'seconds', 'error'])
+        writer.writeheader()
+        writer.writerows(results)
+
+    failed = sorted({r['subject'] for r in results if r['status'] == 'failed'})
+    total = dict()
+    for result in results:
+        total[result['subject']] = total.get(result['subject'], 0) + result['seconds']
+    print('\n###################################################')
+    print(f'Processed {len(total)} subjects, {len(failed)} with failures')
+    if failed:
+        print(f'Failed subjects: {", ".join(failed)}')
+    if total:
+        slowest = max(total, key=total.get)
+        print(f'Slowest subject: {slowest} ({round(total[slowest], 1)} seconds)')
+    print(f'Summary written to {filename}')
+    print('###################################################\n')
@@ -0,0 +1,223 @@
+"""
+Validate a fast ICA fit (the ica_* settings in config_eeg.py) against the full
+fit, on a sample of subjects.
+
+Each recording of the subjects is read and filtered once. The artifacts are
+then removed with an ICA fitted on all the samples with the default solver and
+number of components ('full'), and with an ICA fitted with the fast settings
+('fast'). The settings are taken from config_eeg.py, unless they are given as
+arguments. The validation writes:
+
+- fast_ica_components.csv: for each recording and kind of artifact (EOG, ECG),
+  the number of components excluded by each fit and how well the excluded
+  components of the full fit are matched by those of the fast fit: for each of
+  them, the largest absolute correlation of its topography with an excluded
+  component of the fast fit. ``min_correlation`` is the worst of these.
+- fast_ica_bandpowers.csv: for each recording segment and frequency band type,
+  the correlation of the log bandpowers of the two fits and their median and
+  largest difference in dB.
+- fast_ica_timing.csv: the number of components, the iterations of the solver
+  and the time the cleaning took, for each recording and fit. With a warm
+  start, the fast fit of each recording but the first starts from the fast
+  fit of the first recording.
+
+Running:
+python validate_fast_ica.py --n_subjects 5 --decim 3 --method picard --max_components 30
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+import importlib
+
+import numpy as np
+from mne import set_log_level
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+from config_eeg import get_all_fnames, task_from_fname
+from benchmark_decimation import write_csv
+from ica_fitting import full_fit_settings, ica_fit_settings
+
+# Use importlib, as the module names start with a number
+freqfilt = importlib.import_module('01_freqfilt')
+ica_step = importlib.import_module('02_ica')
+psds_step = importlib.import_module('03_psds')
+bandpower = importlib.import_module('04_bandpower')
+
+freq_band_types = ['thin', 'wide']
+
+
+def match_components(full_ica, full_bads, fast_ica, fast_bads):
+    """Match the excluded components of two ICA fits by their topographies.
+
+    Parameters
+    ----------
+    full_ica, fast_ica : instance of ICA
+        The two fits.
+    full_bads, fast_bads : list of int
+        The components of each fit that were excluded for an artifact.
+
+    Returns
+    -------
+    correlations : list of float
+        For each excluded component of the full fit, the largest absolute
+        correlation with an excluded component of the fast fit (0 if the fast
+        fit excluded none).
+    """
+    if not fast_bads:
+        return [0.] * len(full_bads)
+    full = full_ica.get_components()[:, full_bads]
+    fast = fast_ica.get_components()[:, fast_bads]
+    correlations = np.corrcoef(full.T, fast.T)[:len(full_bads), len(full_bads):]
+    return np.abs(correlations).max(axis=1).tolist()
+
+
+def compare_bandpowers(full_psds, fast_psds, freqs):
+    """Compare the bandpowers computed from the PSDs of the two fits.
+
+    Returns
+    -------
+    rows : list of dict
+        For each segment and frequency band type, the correlation of the log
+        bandpowers and their median and maximal absolute difference in dB.
+    """
+    rows = []
+    for freq_band_type in freq_band_types:
+        f_bands = bandpower.get_f_bands(freq_band_type)
+        for segment in full_psds:
+            full = np.log10(bandpower.compute_bandpowers(full_psds[segment], freqs, f_bands)).ravel()
+            fast = np.log10(bandpower.compute_bandpowers(fast_psds[segment], freqs, f_bands)).ravel()
+            difference_db = 10 * np.abs(fast - full)
+            rows.append(dict(segment=segment, freq_band_type=freq_band_type,
+                             correlation=round(float(np.corrcoef(full, fast)[0, 1]), 6),
+                             median_difference_db=round(float(np.median(difference_db)), 4),
+                             max_difference_db=round(float(difference_db.max()), 4)))
+    return rows
+
+
+def validate_subject(subject, fast_settings):
+    """Clean the recordings of a subject with the full and the fast ICA fit.
+
+    Parameters
+    ----------
+    subject : str
+        The subject.
+    fast_settings : dict
+        How to fit the fast ICA, see `fit_ica` in 02_ica.py.
+
+    Returns
+    -------
+    components : list of dict
+        The comparison of the excluded components, see the module docstring.
+    bandpowers : list of dict
+        The comparison of the bandpowers.
+    timings : list of dict
+        The number of components and cleaning time of each fit.
+    """
+    set_log_level(verbose='Warning')
+    components, bandpowers, timings = [], [], []
+    init_ica = None
+    for raw_fname in get_all_fnames(subject, kind='raw', exclude=['emptyroom']):
+        bads, filt_task = freqfilt.get_bads(subject, raw_fname)
+        task = task_from_fname(raw_fname)
+        raw = freqfilt.read_recording(raw_fname)
+        filt = freqfilt.filter_recording(raw, bads, filt_task)
+        # Both fits are scored on the same EOG and ECG events
+        events = ica_step.find_artifact_events(filt, task)
+
+        fits = dict()
+        for variant, settings in [('full', full_fit_settings), ('fast', fast_settings)]:
+            start = time.perf_counter()
+            ica, raw_ica, artifacts = ica_step.clean_recording(
+                filt.copy(), events, fit_settings=settings, init_ica=init_ica if variant == 'fast' else None)
+            ica_s = time.perf_counter() - start
+            psds, freqs = psds_step.compute_psds(raw_ica, task)
+            fits[variant] = (ica, artifacts, psds)
+            timings.append(dict(subject=subject, task=task, variant=variant,
+                                n_components=ica.n_components_, n_iter=ica.n_iter_,
+                                ica_s=round(ica_s, 2)))
+        if init_ica is None:
+            init_ica = fits['fast'][0]
+
+        (full_ica, full_artifacts, full_psds), (fast_ica, fast_artifacts, fast_psds) = fits['full'], fits['fast']
+        for kind in ('eog', 'ecg'):
+            full_bads, fast_bads = full_artifacts[f'bads_{kind}'], fast_artifacts[f'bads_{kind}']
+            correlations = match_components(full_ica, full_bads, fast_ica, fast_bads)
+            components.append(dict(subject=subject, task=task, kind=kind,
+                                   n_full=len(full_bads), n_fast=len(fast_bads),
+                                   min_correlation=round(min(correlations), 4) if correlations else ''))
+        bandpowers += [dict(subject=subject, **row)
+                       for row in compare_bandpowers(full_psds, fast_psds, freqs)]
+    return components, bandpowers, timings
+
+
+def run_validation(subjects, fast_settings, output_dir='.'):
+    """Run the validation for a list of subjects and write the results."""
+    os.makedirs(output_dir, exist_ok=True)
+    components, bandpowers, timings = [], [], []
+    for subject in subjects:
+        subject_components, subject_bandpowers, subject_timings = validate_subject(subject, fast_settings)
+        components += subject_components
+        bandpowers += subject_bandpowers
+        timings += subject_timings
+
+    write_csv(components, os.path.join(output_dir, 'fast_ica_components.csv'))
+    write_csv(bandpowers, os.path.join(output_dir, 'fast_ica_bandpowers.csv'))
+    write_csv(timings, os.path.join(output_dir, 'fast_ica_timing.csv'))
+
+    for variant in ('full', 'fast'):
+        ica_s = sum(row['ica_s'] for row in timings if row['variant'] == variant)
+        n_iter = sum(row['n_iter'] for row in timings if row['variant'] == variant)
+        print(f'{variant:>5}: cleaning took {ica_s:.1f} s, {n_iter} solver iterations')
+    for kind in ('eog', 'ecg'):
+        rows = [row for row in components if row['kind'] == kind]
+        same = sum(row['n_full'] == row['n_fast'] for row in rows)
+        correlations = [row['min_correlation'] for row in rows if row['min_correlation'] != '']
+        print(f'{kind.upper()}: same number of excluded components in {same}/{len(rows)} recordings'
+              + (f', worst topography match r={min(correlations):.3f}' if correlations else ''))
+    differences = [row['median_difference_db'] for row in bandpowers]
+    print(f'Bandpowers: median |difference| {np.median(differences):.3f} dB, '
+          f'largest {max(row["max_difference_db"] for row in bandpowers):.3f} dB')
+
+
+if __name__ == '__main__':
+    # Save time of beginning of the execution to measure running time
+    start_time = time.time()
+
+    settings = ica_fit_settings
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('subjects', nargs='*', help='The subjects to include. Default: a random sample of the subjects in subjects.txt')
+    parser.add_argument('--n_subjects', type=int, help='Size of the random sample of subjects. Default: 5', default=5)
+    parser.add_argument('--seed', type=int, help='Seed of the random sample of subjects. Default: 0', default=0)
+    parser.add_argument('--method', choices=['fastica', 'picard', 'infomax'], help='The solver of the fast fit. Default: ica_method in config_eeg.py', default=settings['method'])
+    parser.add_argument('--extended', action='store_true', help='Use extended infomax (or picard with its extended setting). Default: as ica_fit_params in config_eeg.py', default=False)
+    parser.add_argument('--decim', type=int, help='Fit on every n-th sample. Default: ica_fit_decim in config_eeg.py', default=settings['decim'])
+    parser.add_argument('--window', type=float, nargs=2, metavar=('TMIN', 'TMAX'), help='Fit on this window of the recording (in seconds). Default: ica_fit_window in config_eeg.py', default=settings['window'])
+    parser.add_argument('--warm_start', action=argparse.BooleanOptionalAction, help='Start the fast fit of the later recordings from that of the first recording (--no-warm_start to fit each from scratch). Default: ica_warm_start in config_eeg.py', default=settings['warm_start'])
+    parser.add_argument('--max_components', type=int, help='The maximal number of components. Default: ica_max_components in config_eeg.py', default=settings['max_components'])
+    parser.add_argument('--output_dir', help='Where to write the results. Default: fast_ica_validation', default='fast_ica_validation')
+    args = parser.parse_args()
+
+    fast_settings = dict(method=args.method,
+                         fit_params=dict(extended=True) if args.extended else settings['fit_params'],
+                         decim=args.decim, window=args.window, max_components=args.max_components,
+                         warm_start=args.warm_start)
+    if fast_settings == full_fit_settings:
+        print('WARNING: The fast settings are the same as those of the full fit.')
+
+    subjects = args.subjects
+    if not subjects:
+        with open('subjects.txt', 'r') as subjects_file:
+            subjects = [line.rstrip() for line in subjects_file.readlines()
+                        if re.match(r'^\d{2}[PC]', line)]
+        subjects = sorted(random.Random(args.seed).sample(subjects, min(args.n_subjects, len(subjects))))
+    run_validation(subjects, fast_settings, args.output_dir)
+
+    execution_time = (time.time() - start_time)
+    print('\n###################################################\n')
+    print(f'Execution time of validate_fast_ica.py is: {round(execution_time,2)} seconds\n')
+    print('###################################################\n')
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timing and memory measurements of the processing and analysis steps.
+
+Code blocks are measured with the `profiled` context manager:
+
+    with profiled('interpolate_bads', recording='ec'):
+        raw.interpolate_bads()
+
+For each block, the wall time, the CPU time, the number of bytes read and the
+peak resident memory (RSS) of the process are recorded, together with the
+subject, recording and stage it belongs to. These are inherited from the enclosing blocks, so the scheduler
+only needs to set the subject and stage, and the steps only the recording.
+Each measurement is appended as one line of JSON to the log file.
+
+Profiling is disabled unless a log file is set with `enable_profiling` (or the
+PROFILING_LOG environment variable, which is also how worker processes know
+where to write). The log can be summarized with
+
+    python profiling.py profile.jsonl --by step --top 20
+
+which ranks the (stage, step) pairs by their total wall time over the cohort.
+
+The peak RSS is the high water mark of the process. On Linux it is reset at the
+start of each outermost block, so it is the peak of that block; elsewhere it is
+the peak since the start of the process.
+"""
+
+import argparse
+import json
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# The context (subject, recording, stage) of the blocks currently being measured
+_context_stack = []
+
+
+def enable_profiling(filename='profile.jsonl'):
+    """Start recording the measurements to a log file.
+
+    The setting is passed on to the worker processes started after this call.
+
+    Parameters
+    ----------
+    filename : str
+        The JSONL file to append the measurements to.
+    """
+    os.environ['PROFILING_LOG'] = os.path.abspath(filename)
+
+
+def get_profiling_log():
+    """Get the log file, or None if profiling is disabled."""
+    return os.environ.get('PROFILING_LOG')
+
+
+def _peak_rss_mb():
+    """Get the peak resident memory of the process, in MB."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is in kB on Linux, in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024**2 if os.uname().sysname == 'Darwin' else maxrss / 1024
+
+
+def bytes_read():
+    """Get the number of bytes the process has read so far.
+
+    Includes the bytes served from the page cache, so it measures how much
+    data was requested, whether or not it had to come from the disk or the
+    network. Only available on Linux.
+
+    Returns
+    -------
+    n_bytes : int | None
+        The number of bytes, or None if it is not available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """Reset the peak resident memory of the process, if supported (Linux)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+@contextmanager
+def profiled(step, **context):
+    """Measure the time and memory used by a block of code.
+
+    Does nothing (apart from passing on the context) if profiling is disabled.
+
+    Parameters
+    ----------
+    step : str
+        The name of the block, e.g. 'read_raw_fif' or 'ica_fit'.
+    **context
+        The subject, recording and/or stage the block belongs to. Missing
+        values are taken from the enclosing blocks.
+    """
+    full_context = dict(subject=None, recording=None, stage=None)
+    for outer in _context_stack:
+        full_context.update({key: value for key, value in outer.items()
+                             if value is not None})
+    full_context.update({key: value for key, value in context.items()
+                         if value is not None})
+
+    log = get_profiling_log()
+    if log is not None and not _context_stack:
+        _reset_peak_rss()
+    _context_stack.append(full_context)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    read_start = bytes_read()
+    try:
+        yield
+    finally:
+        _context_stack.pop()
+        if log is not None:
+            read_end = bytes_read()
+            entry = dict(full_context, step=step,
+                         wall_s=round(time.perf_counter() - wall_start, 4),
+                         cpu_s=round(time.process_time() - cpu_start, 4),
+                         read_mb=(None if read_start is None or read_end is None
+                                  else round((read_end - read_start) / 1e6, 3)),
+                         peak_rss_mb=_peak_rss_mb(),
+                         host=socket.gethostname(), pid=os.getpid(),
+                         time=time.time())
+            # One line per write, so that entries from parallel workers do not
+            # get mixed up.
+            with open(log, 'a') as f:
+                f.write(json.dumps(entry, default=str) + '\n')
+
+
+def read_log(filename):
+    """Read the measurements from a log file.
+
+    Parameters
+    ----------
+    filename : str
+        The JSONL log file.
+
+    Returns
+    -------
+    entries : list of dict
+        The measurements, in the order they were written.
+    """
+    entries = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    return entries
+
+
+def summarize(entries, by='step'):
+    """Combine the measurements over subjects and recordings.
+
+    Parameters
+    ----------
+    entries : list of dict
+        The measurements, as returned by `read_log`.
+    by : 'step' | 'stage' | 'subject'
+        How to group the measurements. With 'step', they are grouped by
+        (stage, step).
+
+    Returns
+    -------
+    summary : list of dict
+        For each group, the number of measurements, the total and mean wall
+        time, the total CPU time, the total MB read and the largest peak RSS. Sorted by the total
+        wall time, largest first.
+    """
+    groups = dict()
+    for entry in entries:
+        if by == 'step':
+            key = (entry.get('stage'), entry['step'])
+        else:
+            key = (entry.get(by),)
+        group = groups.setdefault(key, dict(count=0, wall_s=0.0, cpu_s=0.0,
+                                            read_mb=0.0, peak_rss_mb=0.0))
+        group['count'] += 1
+        group['wall_s'] += entry['wall_s']
+        group['cpu_s'] += entry['cpu_s']
+        group['read_mb'] += entry.get('read_mb') or 0.0
+        group['peak_rss_mb'] = max(group['peak_rss_mb'], entry.get('peak_rss_mb') or 0.0)
+
+    summary = []
+    for key, group in groups.items():
+        name = ' / '.join(str(part) for part in key if part is not None)
+        summary.append(dict(name=name, count=group['count'],
+                            total_wall_s=round(group['wall_s'], 2),
+                            mean_wall_s=round(group['wall_s'] / group['count'], 2),
+                            total_cpu_s=round(group['cpu_s'], 2),
+                            total_read_mb=round(group['read_mb'], 1),
+                            peak_rss_mb=round(group['peak_rss_mb'], 1)))
+    summary.sort(key=lambda row: row['total_wall_s'], reverse=True)
+    return summary
+
+
+def print_summary(summary, top=None):
+    """Print the output of `summarize` as a table."""
+    rows = summary if top is None else summary[:top]
+    total = sum(row['total_wall_s'] for row in summary) or 1.0
+    print(f'{"name":<40} {"count":>6} {"total [s]":>10} {"share":>6} '
+          f'{"mean [s]":>9} {"cpu [s]":>10} {"read [MB]":>10} {"peak RSS [MB]":>14}')
+    for row in rows:
+        print(f'{row["name"][:40]:<40} {row["count"]:>6} {row["total_wall_s"]:>10.1f} '
+              f'{100 * row["total_wall_s"] / total:>5.1f}% {row["mean_wall_s"]:>9.2f} '
+              f'{row["total_cpu_s"]:>10.1f} {row["total_read_mb"]:>10.1f} '
+              f'{row["peak_rss_mb"]:>14.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rank the hot spots in a profiling log.')
+    parser.add_argument('log', help='The JSONL log file', nargs='?', default='profile.jsonl')
+    parser.add_argument('--by', choices=['step', 'stage', 'subject'], default='step',
+                        help='How to group the measurements. Default: step')
+    parser.add_argument('--top', type=int, default=None,
+                        help='Only show this many groups. Default: all')
+    args = parser.parse_args()
+
+    print_summary(summarize(read_log(args.log), by=args.by), top=args.top)
@@ -45,6 +45,28 @@ def test_create_subjects_and_tasks():
         assert isinstance(element, tuple)
         assert len(element) == 2
 
+def test_read_segment_index():
+    import mne
+    import psds_io
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        info = mne.create_info(['EEG001'], 200., 'eeg')
+        segments = {'ec_1': dict(task='ec'), 'ec_2': dict(task='ec'), 'ec_3': dict(task='ec'),
+                    'PASAT_run1_1': dict(task='PASAT_run1')}
+        for subject, names in [('01P', list(segments)), ('02C', ['ec_1', 'ec_3', 'PASAT_run1_1'])]:
+            psds_fname = os.path.join(tmp_dir, f'sub-{subject}', 'ses-01', 'eeg', f'sub-{subject}_psds.h5')
+            psds_io.write_psds(psds_fname, {name: np.ones((1, 3)) for name in names}, np.arange(3.),
+                               info, {name: segments[name] for name in names})
+
+        # The segments are those of the PSD files, not those of the segments table
+        index = read_processed_data.read_segment_index(['01P', '02C'], tmp_dir)
+        assert read_processed_data.select_task_segments('ec', index) == ['ec_1', 'ec_3']
+        assert read_processed_data.select_task_segments('PASAT_1', index) == ['PASAT_run1_1']
+        with pytest.raises(ValueError):
+            read_processed_data.select_task_segments('PASAT_2', index)
+    finally:
+        shutil.rmtree(tmp_dir)
+
 def test_read_data():
     # NOTE> This is only testing for 'thin' bands.
     # NOTE: I should check if data is empty?
@@ -75,6 +97,24 @@ def test_read_data():
     # Remove the temporary directory
     shutil.rmtree(tmp_dir)
 
+def test_create_band_vectors_matches_read_data():
+    # Reading the data once and deriving both normalizations should give the same as reading it twice
+    tmp_dir = tempfile.mkdtemp()
+    subjects_and_tasks = [('01P', 'ec_1'), ('02C', 'ec_1')]
+    freq_bands = 'thin'
+    for subject, task in subjects_and_tasks:
+        subject_dir = os.path.join(tmp_dir, f'sub-{subject}', 'ses-01', 'eeg', 'bandpowers')
+        os.makedirs(subject_dir, exist_ok=True)
+        np.savetxt(os.path.join(subject_dir, f'{freq_bands}_{task}.csv'), np.random.rand(89, 64), delimiter=',')
+
+    all_bands_arrays = read_processed_data.read_band_arrays(subjects_and_tasks, freq_bands, tmp_dir)
+    for not_normalized in (False, True):
+        expected = read_processed_data.read_data(subjects_and_tasks, freq_bands, not_normalized, tmp_dir)
+        result = read_processed_data.create_band_vectors(subjects_and_tasks, all_bands_arrays, freq_bands, not_normalized)
+        np.testing.assert_array_equal(result, expected)
+
+    shutil.rmtree(tmp_dir)
+
 def test_create_data_frame():
     # define subjects_and_tasks: list of 2-uples (same as above?)
     subjects_and_tasks = [('01P', 'ec_1'), ('01P', 'ec_2'), ('01C', 'ec_1'), ('01C', 'ec_2'),]
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_02_ica.py #
+#############################
+
+Tests the functions from module processing/02_ica.py
+Use `python3 -m pytest test_02_ica.py` to run it from terminal
+"""
+
+import importlib
+import os
+import sys
+import tempfile
+import shutil
+import numpy as np
+import mne
+
+processing_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'processing'))
+sys.path.append(processing_dir)
+ica_step = importlib.import_module('02_ica')
+
+
+def _create_raw(sfreq=200., duration=60.):
+    """EEG with blinks and heartbeats, and the EOG and ECG channels."""
+    rng = np.random.default_rng(0)
+    n_samples = int(sfreq * duration)
+    times = np.arange(n_samples) / sfreq
+    blinks = np.zeros(n_samples)
+    for onset in np.arange(2., duration - 2., 4.):
+        blinks += 20 * np.exp(-0.5 * ((times - onset) / 0.1) ** 2)
+    heartbeats = np.zeros(n_samples)
+    heartbeats[(np.arange(0.5, duration - 0.5, 0.9) * sfreq).astype(int)] = 10.
+    heartbeats = np.convolve(heartbeats, np.hanning(11), mode='same')
+
+    sources = np.vstack([blinks, heartbeats, rng.laplace(size=(18, n_samples))])
+    eeg = rng.standard_normal((30, len(sources))) @ sources
+    eeg += 0.1 * rng.standard_normal(eeg.shape)
+    data = np.vstack([eeg, blinks, heartbeats]) * 1e-5
+    ch_names = [f'EEG{i + 1:03}' for i in range(30)] + ['EOG001', 'ECG002']
+    info = mne.create_info(ch_names, sfreq, ['eeg'] * 30 + ['eog', 'ecg'])
+    with info._unlock():
+        info['highpass'] = 1.
+    return mne.io.RawArray(data, info, verbose=False)
+
+def test_find_artifact_events():
+    raw = _create_raw()
+    events = ica_step.find_artifact_events(raw, 'eo')
+    assert len(events['eog']) > 0
+    assert len(events['ecg']) > 0
+
+    # No EOG events in the eyes closed recordings
+    events = ica_step.find_artifact_events(raw, 'ec')
+    assert events['eog'] is None
+    assert len(events['ecg']) > 0
+
+def test_artifact_events_cache(monkeypatch):
+    monkeypatch.delenv('PROFILING_LOG', raising=False)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filt_fname = os.path.join(tmp_dir, 'sub-10C_ses-01_task-eo_run-01_filt.fif')
+        events_fname = os.path.join(tmp_dir, 'sub-10C_ses-01_task-eo_run-01_eog-ecg-events.h5')
+        raw = _create_raw()
+        raw.save(filt_fname, verbose=False)
+        fingerprint = ica_step.compute_events_fingerprint([filt_fname], events_fname, 'eo')
+        events = ica_step.get_artifact_events(raw, 'eo', events_fname, fingerprint)
+        assert os.path.exists(events_fname)
+
+        # The saved events are read back instead of found again
+        monkeypatch.setattr(ica_step, 'find_artifact_events', None)
+        cached = ica_step.get_artifact_events(raw, 'eo', events_fname, fingerprint)
+        np.testing.assert_array_equal(cached['eog'], events['eog'])
+        np.testing.assert_array_equal(cached['ecg'], events['ecg'])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_clean_recording():
+    raw = _create_raw()
+    events = ica_step.find_artifact_events(raw, 'eo')
+    ica, raw_ica, artifacts = ica_step.clean_recording(raw, events)
+    # The scores are computed on the same epochs as the averages in the report
+    assert len(artifacts['eog_events']) == len(events['eog'])
+    assert artifacts['eog_evoked'].nave == len(artifacts['eog_events'])
+    assert len(artifacts['bads_eog']) > 0
+    assert artifacts['fit_seconds'] is not None
+
+    # Reusing the fitted ICA, without EOG events
+    raw = _create_raw()
+    events = ica_step.find_artifact_events(raw, 'ec')
+    _, _, artifacts = ica_step.clean_recording(raw, events, ica=ica)
+    assert artifacts['bads_eog'] == []
+    assert artifacts['eog_evoked'] is None
+    assert artifacts['fit_seconds'] is None
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_03_psds.py #
+#############################
+
+Tests the functions from module processing/03_psds.py
+Use `python3 -m pytest test_03_psds.py` to run it from terminal
+"""
+
+import importlib
+import os
+import sys
+import tempfile
+import shutil
+import numpy as np
+import mne
+from mne.time_frequency import psd_array_welch
+
+processing_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'processing'))
+sys.path.append(processing_dir)
+import intermediate
+psds_step = importlib.import_module('03_psds')
+
+
+def test_compute_psds_array_matches_welch_per_segment():
+    sfreq = 200.
+    info = mne.create_info(['EEG001', 'EEG002', 'EOG001'], sfreq, ['eeg', 'eeg', 'eog'])
+    data = np.random.default_rng(0).standard_normal((3, int(270 * sfreq)))
+    psds, freqs = psds_step.compute_psds_array(data, info, 'ec', n_fft=256)
+    assert sorted(psds) == ['ec_1', 'ec_2', 'ec_3']
+
+    for name, tmin, tmax in psds_step.get_segments('ec'):
+        start, stop = int(tmin * sfreq), int(tmax * sfreq) + 1
+        expected, expected_freqs = psd_array_welch(
+            data[:2, start:stop], sfreq=sfreq, fmax=psds_step.freq_max, n_fft=256, verbose=False)
+        np.testing.assert_allclose(psds[name], expected, rtol=1e-10)
+        np.testing.assert_array_equal(freqs, expected_freqs)
+
+def test_compute_psds_array_overlap_and_rejection(monkeypatch):
+    sfreq = 200.
+    info = mne.create_info(['EEG001', 'EEG002'], sfreq, 'eeg')
+    data = np.random.default_rng(0).standard_normal((2, int(130 * sfreq)))
+    tmin, tmax = psds_step.get_segments('PASAT_run1')[0][1:]
+    start, stop = int(tmin * sfreq), int(tmax * sfreq) + 1
+
+    monkeypatch.setattr(psds_step, 'psd_overlap', 0.5)
+    psds, _ = psds_step.compute_psds_array(data, info, 'PASAT_run1', n_fft=256)
+    expected, _ = psd_array_welch(data[:, start:stop], sfreq=sfreq, fmax=psds_step.freq_max,
+                                  n_fft=256, n_overlap=128, verbose=False)
+    np.testing.assert_allclose(psds['PASAT_run1_1'], expected, rtol=1e-10)
+
+    # The windows overlapping the bad annotation are left out
+    monkeypatch.setattr(psds_step, 'psd_overlap', 0.)
+    monkeypatch.setattr(psds_step, 'psd_reject_by_annotation', True)
+    annotations = mne.Annotations([tmin + 10.], [5.], ['BAD_muscle'])
+    psds, _ = psds_step.compute_psds_array(data, info, 'PASAT_run1', n_fft=256,
+                                           annotations=annotations)
+    bad_start, bad_stop = int((tmin + 10.) * sfreq), int((tmin + 15.) * sfreq)
+    windows = [data[:, i:i + 256] for i in range(start, stop - 255, 256)
+               if i + 256 <= bad_start or i >= bad_stop]
+    expected, _ = psd_array_welch(np.concatenate(windows, axis=1), sfreq=sfreq,
+                                  fmax=psds_step.freq_max, n_fft=256, verbose=False)
+    np.testing.assert_allclose(psds['PASAT_run1_1'], expected, rtol=1e-10)
+
+def test_task_segments():
+    index = psds_step.segment_index('PASAT_run1')
+    assert list(index) == ['PASAT_run1_1', 'PASAT_run1_2']
+    assert index['PASAT_run1_2']['tmax'] == psds_step.get_segments('PASAT_run1')[1][2]
+    index.update(psds_step.segment_index('ec'))
+    assert psds_step.task_segments(index, 'PASAT_run1') == ['PASAT_run1_1', 'PASAT_run1_2']
+    assert psds_step.task_segments(index, 'eo') == []
+
+def test_compute_psds_streaming_matches_welch(monkeypatch):
+    sfreq = 200.
+    info = mne.create_info(['EEG001', 'EEG002', 'EOG001'], sfreq, ['eeg', 'eeg', 'eog'])
+    data = np.random.default_rng(0).standard_normal((3, int(130 * sfreq)))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # A .fif file that is read in blocks, without preloading it
+        fif_fname = os.path.join(tmp_dir, 'test_raw.fif')
+        mne.io.RawArray(data, info, verbose=False).save(fif_fname, verbose=False)
+        raw, _ = intermediate.open_data(fif_fname, fmt='fif')
+        assert not raw.preload
+
+        monkeypatch.setattr(psds_step, 'psd_overlap', 0.5)
+        psds, freqs = psds_step.compute_psds_streaming(raw, info, 'PASAT_run1', n_fft=256,
+                                                       block_windows=3)
+        for name, tmin, tmax in psds_step.get_segments('PASAT_run1'):
+            start, stop = int(tmin * sfreq), int(tmax * sfreq) + 1
+            expected, expected_freqs = psd_array_welch(
+                raw.get_data(picks=[0, 1], start=start, stop=stop), sfreq=sfreq,
+                fmax=psds_step.freq_max, n_fft=256, n_overlap=128, verbose=False)
+            np.testing.assert_allclose(psds[name], expected, rtol=1e-10)
+            np.testing.assert_array_equal(freqs, expected_freqs)
+        del raw
+
+        # The same PSDs as when all the windows are transformed at once, also
+        # with windows left out
+        monkeypatch.setattr(psds_step, 'psd_reject_by_annotation', True)
+        annotations = mne.Annotations([10.], [5.], ['BAD_muscle'])
+        expected, _ = psds_step.compute_psds_array(data, info, 'PASAT_run1', n_fft=256,
+                                                   annotations=annotations)
+        psds, _ = psds_step.compute_psds_streaming(data, info, 'PASAT_run1', n_fft=256,
+                                                   annotations=annotations, block_windows=4)
+        for name in expected:
+            np.testing.assert_allclose(psds[name], expected[name], rtol=1e-10)
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_blas_threads.py #
+#############################
+
+Tests the functions from module blas_threads.py
+Use `python3 -m pytest test_blas_threads.py` to run it from terminal
+"""
+
+import os
+import sys
+import numpy as np
+from threadpoolctl import threadpool_info
+
+src_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(src_dir)
+from blas_threads import blas_threads, get_core_budget, split_budget
+
+
+def test_split_budget():
+    assert split_budget(16, 4) == (4, 4)
+    assert split_budget(16, 3) == (3, 5)
+    assert split_budget(16, 1) == (1, 16)
+    # No more workers than cores, and at least one thread each
+    assert split_budget(4, 8) == (4, 1)
+    assert get_core_budget(6) == 6
+    assert get_core_budget() >= 1
+
+def test_blas_threads_are_restored(monkeypatch):
+    monkeypatch.setenv('OMP_NUM_THREADS', '7')
+    monkeypatch.delenv('MKL_NUM_THREADS', raising=False)
+    np.ones((2, 2)) @ np.ones((2, 2))
+    before = [pool['num_threads'] for pool in threadpool_info()]
+    with blas_threads(1):
+        assert os.environ['OMP_NUM_THREADS'] == '1'
+        assert os.environ['MKL_NUM_THREADS'] == '1'
+        assert all(pool['num_threads'] == 1 for pool in threadpool_info())
+    assert os.environ['OMP_NUM_THREADS'] == '7'
+    assert 'MKL_NUM_THREADS' not in os.environ
+    assert [pool['num_threads'] for pool in threadpool_info()] == before
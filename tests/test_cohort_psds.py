@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_cohort_psds.py #
+#############################
+
+Tests the functions from module processing/cohort_psds.py
+Use `python3 -m pytest test_cohort_psds.py` to run it from terminal
+"""
+
+import importlib
+import os
+import sys
+import tempfile
+import shutil
+import numpy as np
+import mne
+import pytest
+
+processing_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'processing'))
+sys.path.append(processing_dir)
+import cohort_psds
+import psds_io
+psds_step = importlib.import_module('03_psds')
+
+
+def _save_psds(psds_fname, seed, tasks=('ec', 'PASAT_run1')):
+    info = mne.create_info(['EEG001', 'EEG002'], 200., 'eeg')
+    segments = dict()
+    for task in tasks:
+        segments.update(psds_step.segment_index(task))
+    rng = np.random.default_rng(seed)
+    psds = {name: rng.random((2, 5)) + 1 for name in segments}
+    psds_io.write_psds(psds_fname, psds, np.arange(5.), info, segments)
+    return psds
+
+def test_build_cohort_psds(monkeypatch):
+    monkeypatch.delenv('PROFILING_LOG', raising=False)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cohort_fname = os.path.join(tmp_dir, 'cohort_psds.npy')
+        psds_fnames = {subject: os.path.join(tmp_dir, f'sub-{subject}_psds.h5')
+                       for subject in ('10C', '11P', '12P')}
+        psds = {'10C': _save_psds(psds_fnames['10C'], 0),
+                '11P': _save_psds(psds_fnames['11P'], 1, tasks=('ec',))}
+
+        read = cohort_psds.build_cohort_psds({subject: psds_fnames[subject] for subject in psds},
+                                             cohort_fname)
+        assert read == ['10C', '11P']
+        cube, index = cohort_psds.read_cohort_psds(cohort_fname)
+        assert isinstance(cube, np.memmap)
+        assert cube.shape == (2, len(index['segments']), 2, 5)
+        assert index['groups'] == ['Control', 'Patient']
+        ec_2 = index['segments'].index('ec_2')
+        assert index['tasks'][ec_2] == 'ec'
+        np.testing.assert_allclose(cube[1, ec_2], psds['11P']['ec_2'], rtol=1e-6)
+        # 11P has no PASAT segments
+        assert np.isnan(cube[1, index['segments'].index('PASAT_run1_1')]).all()
+
+        # Only the new subject is read, the others are kept
+        psds['12P'] = _save_psds(psds_fnames['12P'], 2)
+        assert cohort_psds.build_cohort_psds({'12P': psds_fnames['12P']}, cohort_fname) == ['12P']
+        cube, index = cohort_psds.read_cohort_psds(cohort_fname)
+        assert index['subjects'] == ['10C', '11P', '12P']
+        np.testing.assert_allclose(cube[0, ec_2], psds['10C']['ec_2'], rtol=1e-6)
+
+        means = cohort_psds.group_means(cube, index['groups'])
+        np.testing.assert_allclose(means['Patient'][ec_2],
+                                   (psds['11P']['ec_2'] + psds['12P']['ec_2']) / 2, rtol=1e-6)
+        pasat = index['segments'].index('PASAT_run1_2')
+        np.testing.assert_allclose(means['Patient'][pasat], psds['12P']['PASAT_run1_2'], rtol=1e-6)
+
+        # A subject whose PSDs changed is read again
+        psds['10C'] = _save_psds(psds_fnames['10C'], 3)
+        assert cohort_psds.build_cohort_psds(dict(), cohort_fname) == ['10C']
+        cube, _ = cohort_psds.read_cohort_psds(cohort_fname)
+        np.testing.assert_allclose(cube[0, ec_2], psds['10C']['ec_2'], rtol=1e-6)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_cohort_psds_sidecar_mismatch(monkeypatch):
+    monkeypatch.delenv('PROFILING_LOG', raising=False)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cohort_fname = os.path.join(tmp_dir, 'cohort_psds.npy')
+        psds_fnames = {subject: os.path.join(tmp_dir, f'sub-{subject}_psds.h5')
+                       for subject in ('10C', '11P')}
+        psds = {'11P': _save_psds(psds_fnames['11P'], 1)}
+        cohort_psds.build_cohort_psds({'11P': psds_fnames['11P']}, cohort_fname)
+        sidecar = cohort_psds._sidecar(cohort_fname)
+        shutil.copy(sidecar, str(sidecar) + '.old')
+
+        # Interrupted after the array was written, but before its sidecar
+        psds['10C'] = _save_psds(psds_fnames['10C'], 0)
+        cohort_psds.build_cohort_psds({'10C': psds_fnames['10C']}, cohort_fname)
+        os.replace(str(sidecar) + '.old', sidecar)
+        with pytest.raises(ValueError, match='does not match'):
+            cohort_psds.read_cohort_psds(cohort_fname)
+
+        # All subjects are read again, instead of copying the wrong rows
+        assert cohort_psds.build_cohort_psds(psds_fnames, cohort_fname) == ['10C', '11P']
+        cube, index = cohort_psds.read_cohort_psds(cohort_fname)
+        assert index['subjects'] == ['10C', '11P']
+        ec_1 = index['segments'].index('ec_1')
+        np.testing.assert_allclose(cube[1, ec_1], psds['11P']['ec_1'], rtol=1e-6)
+    finally:
+        shutil.rmtree(tmp_dir)
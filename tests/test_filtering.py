@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_filtering.py #
+#############################
+
+Tests the functions from module processing/filtering.py
+Use `python3 -m pytest test_filtering.py` to run it from terminal
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+import mne
+
+processing_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'processing'))
+sys.path.append(processing_dir)
+import filtering
+
+
+def _create_raw(sfreq=250., duration=60., n_channels=4):
+    rng = np.random.default_rng(0)
+    info = mne.create_info([f'EEG{i + 1:03}' for i in range(n_channels)], sfreq, 'eeg')
+    data = 1e-5 * rng.standard_normal((n_channels, int(sfreq * duration)))
+    # Add some powerline noise and an offset
+    times = np.arange(data.shape[1]) / sfreq
+    data += 1e-5 * np.sin(2 * np.pi * 50 * times) + 1e-4
+    return mne.io.RawArray(data, info, verbose=False)
+
+def test_kernel_is_symmetric():
+    kernel = filtering.design_kernel(250., 1, 90, [50, 100])
+    assert len(kernel) % 2 == 1
+    np.testing.assert_allclose(kernel, kernel[::-1], atol=1e-12)
+
+def test_filter_matches_mne():
+    raw = _create_raw()
+    interior, edges = filtering.compare_with_mne(raw, 1, 90, [50, 100], picks=['eeg'])
+    assert interior < filtering.filter_tolerance
+
+def test_filter_raw_updates_info():
+    raw = _create_raw()
+    filtering.filter_raw(raw, 1, 90, [50, 100], picks=['eeg'], cache=False)
+    assert raw.info['highpass'] == 1
+    assert raw.info['lowpass'] == 90
+    # The powerline noise and the offset are gone
+    psd, freqs = mne.time_frequency.psd_array_welch(raw.get_data(), 250., n_fft=1000, verbose=False)
+    assert psd[:, freqs == 50].mean() < 0.1 * psd[:, (freqs > 20) & (freqs < 40)].mean()
+    assert abs(raw.get_data()[:, 1000:-1000].mean()) < 1e-6
+
+def test_decimation_factor():
+    # 90 Hz low-pass: the stop band ends at 112.5 Hz
+    assert filtering.decimation_factor(1000., 250., 90) == 4
+    assert filtering.decimation_factor(1000., 300., 90) == 3
+    assert filtering.decimation_factor(250., 250., 90) == 1
+    with pytest.raises(ValueError):
+        filtering.decimation_factor(1000., 200., 90)
+
+def test_decimate_raw_keeps_stim_events():
+    sfreq = 1000.
+    info = mne.create_info(['EEG001', 'STI101'], sfreq, ['eeg', 'stim'])
+    data = np.zeros((2, 10000))
+    data[0] = np.sin(2 * np.pi * 10 * np.arange(10000) / sfreq)
+    # A trigger pulse shorter than the decimation factor, between kept samples
+    data[1, 4001:4003] = 5
+    raw = mne.io.RawArray(data, info, verbose=False)
+    decimated = filtering.decimate_raw(raw, 250., 90)
+    assert decimated.info['sfreq'] == 250.
+    np.testing.assert_array_equal(decimated.get_data()[0], data[0, ::4])
+    assert decimated.get_data()[1, 1000] == 5
+    assert filtering.decimate_raw(raw, None, 90) is raw
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_fingerprint.py #
+#############################
+
+Tests the functions from module processing/fingerprint.py
+Use `python3 -m pytest test_fingerprint.py` to run it from terminal
+"""
+
+import os
+import sys
+import tempfile
+import shutil
+
+processing_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'processing'))
+sys.path.append(processing_dir)
+from fingerprint import compute_fingerprint, file_stat, is_up_to_date, load_fingerprint, save_fingerprint
+
+
+def _write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_fingerprint_depends_on_content_and_params():
+    tmp_dir = tempfile.mkdtemp()
+    input_fname = os.path.join(tmp_dir, 'raw.fif')
+    _write(input_fname, 'some data')
+
+    fingerprint = compute_fingerprint(files=[input_fname], params=dict(bads=['EEG017']))
+    assert fingerprint == compute_fingerprint(files=[input_fname], params=dict(bads=['EEG017']))
+
+    # Changing the parameters changes the fingerprint
+    other = compute_fingerprint(files=[input_fname], params=dict(bads=['EEG017', 'EEG018']))
+    assert other['hash'] != fingerprint['hash']
+
+    # Changing the content of the input changes the fingerprint
+    _write(input_fname, 'other data')
+    other = compute_fingerprint(files=[input_fname], params=dict(bads=['EEG017']))
+    assert other['hash'] != fingerprint['hash']
+
+    shutil.rmtree(tmp_dir)
+
+def test_file_stat_does_not_read_the_file(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    input_fname = os.path.join(tmp_dir, 'raw.fif')
+    _write(input_fname, 'some data')
+    monkeypatch.setattr('fingerprint.hash_file', None)
+
+    fingerprint = compute_fingerprint(params=dict(raw=file_stat(input_fname)))
+    assert fingerprint['files'] == dict()
+    assert compute_fingerprint(params=dict(raw=file_stat(input_fname))) == fingerprint
+
+    # A new version of the file has another size or modification time
+    _write(input_fname, 'other, longer data')
+    other = compute_fingerprint(params=dict(raw=file_stat(input_fname)))
+    assert other['hash'] != fingerprint['hash']
+
+    shutil.rmtree(tmp_dir)
+
+def test_is_up_to_date():
+    tmp_dir = tempfile.mkdtemp()
+    input_fname = os.path.join(tmp_dir, 'raw.fif')
+    output_fname = os.path.join(tmp_dir, 'filt.fif')
+    _write(input_fname, 'some data')
+    fingerprint = compute_fingerprint(files=[input_fname], params=dict(freq_min=1))
+
+    # The output does not exist yet
+    assert not is_up_to_date(output_fname, fingerprint)
+
+    _write(output_fname, 'filtered data')
+    assert not is_up_to_date(output_fname, fingerprint)
+    save_fingerprint(output_fname, fingerprint)
+    assert is_up_to_date(output_fname, fingerprint)
+
+    # New parameters require the output to be created again
+    fingerprint = compute_fingerprint(files=[input_fname], params=dict(freq_min=2))
+    assert not is_up_to_date(output_fname, fingerprint)
+
+    shutil.rmtree(tmp_dir)
+
+def test_fingerprints_with_keys():
+    tmp_dir = tempfile.mkdtemp()
+    output_fname = os.path.join(tmp_dir, 'psds.h5')
+    _write(output_fname, 'psds')
+    fingerprint_ec = compute_fingerprint(params=dict(task='ec'))
+    fingerprint_eo = compute_fingerprint(params=dict(task='eo'))
+
+    save_fingerprint(output_fname, fingerprint_ec, key='ec')
+    save_fingerprint(output_fname, fingerprint_eo, key='eo')
+    assert load_fingerprint(output_fname, key='ec') == fingerprint_ec
+    assert is_up_to_date(output_fname, fingerprint_eo, key='eo')
+    assert not is_up_to_date(output_fname, fingerprint_eo, key='ec')
+    assert load_fingerprint(output_fname, key='PASAT_run1') is None
+
+    shutil.rmtree(tmp_dir)
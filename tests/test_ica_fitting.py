@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_ica_fitting.py #
+#############################
+
+Tests the functions from module processing/ica_fitting.py
+Use `python3 -m pytest test_ica_fitting.py` to run it from terminal
+"""
+
+import os
+import sys
+import tempfile
+import shutil
+import numpy as np
+import mne
+
+processing_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'processing'))
+sys.path.append(processing_dir)
+import ica_fitting
+
+
+def _create_raw(n_channels=10, sfreq=100., duration=60.):
+    rng = np.random.default_rng(0)
+    info = mne.create_info([f'EEG{i + 1:03}' for i in range(n_channels)], sfreq, 'eeg')
+    with info._unlock():
+        info['highpass'] = 1.
+    # A few strong sources mixed into all channels, plus some noise
+    sources = rng.laplace(size=(4, int(sfreq * duration)))
+    data = rng.standard_normal((n_channels, 4)) @ sources
+    data += 0.1 * rng.standard_normal(data.shape)
+    return mne.io.RawArray(1e-5 * data, info, verbose=False)
+
+def test_n_components_for_variance():
+    raw = _create_raw()
+    ica = mne.preprocessing.ICA(n_components=0.99, random_state=0).fit(raw, verbose=False)
+    assert ica_fitting.n_components_for_variance(raw, 0.99) == ica.n_components_
+
+def test_fit_ica_settings():
+    raw = _create_raw()
+    full = ica_fitting.fit_ica(raw, **ica_fitting.full_fit_settings)
+    assert full.n_components_ > 3
+
+    # The number of components is capped, not raised
+    capped = ica_fitting.fit_ica(raw, max_components=3)
+    assert capped.n_components_ == 3
+    assert ica_fitting.fit_ica(raw, max_components=50).n_components_ == full.n_components_
+
+    fast = ica_fitting.fit_ica(raw, method='infomax', fit_params=dict(extended=True),
+                            decim=2, window=(10., 50.))
+    assert fast.method == 'infomax'
+    assert fast.n_samples_ == len(raw.times[int(10 * 100):int(50 * 100):2])
+
+def test_warm_start():
+    first = _create_raw()
+    # Another recording with the same mixing of the sources
+    data = 1.5 * first.get_data()[:, ::-1]
+    second = mne.io.RawArray(data.copy(), first.info, verbose=False)
+    init_ica = ica_fitting.fit_ica(first)
+    cold = ica_fitting.fit_ica(second)
+    warm = ica_fitting.fit_ica(second, warm_start=True, init_ica=init_ica)
+    assert warm.n_components_ == cold.n_components_
+    assert warm.n_iter_ < cold.n_iter_
+    # The same components, up to their order and sign
+    correlations = np.corrcoef(cold.get_components().T, warm.get_components().T)
+    assert np.all(np.abs(correlations[:cold.n_components_, cold.n_components_:]).max(axis=1) > 0.99)
+
+def test_fitted_ica_cache(monkeypatch):
+    monkeypatch.delenv('PROFILING_LOG', raising=False)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filt_fname = os.path.join(tmp_dir, 'sub-10C_ses-01_task-ec_run-01_filt.fif')
+        ica_fname = os.path.join(tmp_dir, 'sub-10C_ses-01_task-ec_run-01_ica.h5')
+        raw = _create_raw()
+        raw.save(filt_fname, verbose=False)
+
+        fingerprint = ica_fitting.compute_fit_fingerprint([filt_fname], ica_fname)
+        assert ica_fitting.load_fitted_ica(ica_fname, fingerprint) is None
+        ica = ica_fitting.fit_ica(raw)
+        ica.exclude = [0]
+        ica_fitting.save_fitted_ica(ica, ica_fname, fingerprint)
+
+        # The same inputs give the saved ICA back
+        fingerprint = ica_fitting.compute_fit_fingerprint([filt_fname], ica_fname)
+        cached = ica_fitting.load_fitted_ica(ica_fname, fingerprint)
+        assert cached is not None
+        np.testing.assert_allclose(cached.get_components(), ica.get_components())
+
+        # Other fit settings, or other data, need a new fit
+        monkeypatch.setitem(ica_fitting.ica_fit_settings, 'decim', 3)
+        fingerprint = ica_fitting.compute_fit_fingerprint([filt_fname], ica_fname)
+        assert ica_fitting.load_fitted_ica(ica_fname, fingerprint) is None
+        monkeypatch.undo()
+        raw.crop(0, 30).save(filt_fname, overwrite=True, verbose=False)
+        fingerprint = ica_fitting.compute_fit_fingerprint([filt_fname], ica_fname)
+        assert ica_fitting.load_fitted_ica(ica_fname, fingerprint) is None
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_intermediate.py #
+#############################
+
+Tests the functions from module processing/intermediate.py
+Use `python3 -m pytest test_intermediate.py` to run it from terminal
+"""
+
+import importlib
+import os
+import sys
+import tempfile
+import shutil
+import numpy as np
+import mne
+
+processing_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'processing'))
+sys.path.append(processing_dir)
+import intermediate
+psds_step = importlib.import_module('03_psds')
+
+
+def _create_raw(sfreq=250., duration=130.):
+    rng = np.random.default_rng(0)
+    info = mne.create_info(['EEG001', 'EEG002', 'EOG1'], sfreq, ['eeg', 'eeg', 'eog'])
+    raw = mne.io.RawArray(1e-5 * rng.standard_normal((3, int(sfreq * duration))), info,
+                          first_samp=100, verbose=False)
+    raw.set_annotations(mne.Annotations([1.], [0.5], ['BAD_test']))
+    return raw
+
+def test_npy_round_trip():
+    tmp_dir = tempfile.mkdtemp()
+    fif_fname = os.path.join(tmp_dir, 'sub-01P_ses-01_task-PASAT_run-01_filt.fif')
+    raw = _create_raw()
+    saved = intermediate.save_raw(raw, fif_fname, fmt='npy')
+    assert saved.suffix == '.npy'
+    assert not os.path.exists(fif_fname)
+
+    data, info = intermediate.read_data(fif_fname, fmt='npy')
+    assert isinstance(data, np.memmap)
+    assert data.dtype == np.float32
+    np.testing.assert_allclose(data, raw.get_data(), rtol=1e-6)
+
+    loaded = intermediate.read_raw(fif_fname, fmt='npy')
+    assert loaded.first_samp == raw.first_samp
+    assert loaded.ch_names == raw.ch_names
+    assert list(loaded.annotations.description) == ['BAD_test']
+    np.testing.assert_allclose(loaded.annotations.onset, raw.annotations.onset)
+
+    # Relative to the first sample of the data
+    annotations = intermediate.read_annotations(fif_fname, fmt='npy')
+    np.testing.assert_allclose(annotations.onset, raw.annotations.onset - raw.first_time)
+    assert list(annotations.description) == ['BAD_test']
+
+    shutil.rmtree(tmp_dir)
+
+def test_psds_of_mapped_data_match_crop():
+    tmp_dir = tempfile.mkdtemp()
+    fif_fname = os.path.join(tmp_dir, 'sub-01P_ses-01_task-PASAT_run-01_clean.fif')
+    raw = _create_raw()
+    intermediate.save_raw(raw, fif_fname, fmt='npy')
+    data, info = intermediate.read_data(fif_fname, fmt='npy')
+    psds, freqs = psds_step.compute_psds_array(data, info, 'PASAT_run1', n_fft=256)
+
+    expected, _ = mne.time_frequency.psd_array_welch(
+        raw.copy().crop(tmin=62, tmax=122).get_data(picks=['eeg']), sfreq=250.,
+        fmax=43, n_fft=256, verbose=False)
+    assert sorted(psds) == ['PASAT_run1_1', 'PASAT_run1_2']
+    np.testing.assert_allclose(psds['PASAT_run1_2'], expected, rtol=1e-5)
+
+    shutil.rmtree(tmp_dir)
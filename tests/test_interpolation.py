@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_interpolation.py #
+#############################
+
+Tests the functions from module processing/interpolation.py
+Use `python3 -m pytest test_interpolation.py` to run it from terminal
+"""
+
+import os
+import sys
+import numpy as np
+import mne
+
+processing_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'processing'))
+sys.path.append(processing_dir)
+import interpolation
+
+
+def _create_raw(bads, sfreq=250., duration=10.):
+    rng = np.random.default_rng(0)
+    montage = mne.channels.make_standard_montage('standard_1020')
+    ch_names = montage.ch_names[:32]
+    info = mne.create_info(ch_names + ['EOG1'], sfreq, ['eeg'] * 32 + ['eog'])
+    raw = mne.io.RawArray(1e-5 * rng.standard_normal((33, int(sfreq * duration))), info, verbose=False)
+    raw.set_montage(montage, on_missing='ignore')
+    raw.info['bads'] = [ch_names[i] for i in bads]
+    return raw
+
+def test_interpolate_bads_matches_mne():
+    raw = _create_raw(bads=[3, 17])
+    expected = raw.copy().interpolate_bads(verbose=False)
+    interpolation.interpolate_bads(raw, cache=False)
+    assert raw.info['bads'] == []
+    np.testing.assert_allclose(raw.get_data(), expected.get_data(), rtol=1e-10, atol=1e-20)
+
+def test_matrix_is_reused():
+    interpolation._matrices.clear()
+    interpolation.interpolate_bads(_create_raw(bads=[5]), cache=False)
+    interpolation.interpolate_bads(_create_raw(bads=[5]), cache=False)
+    assert len(interpolation._matrices) == 1
+    # Other bad channels need another matrix
+    interpolation.interpolate_bads(_create_raw(bads=[5, 6]), cache=False)
+    assert len(interpolation._matrices) == 2
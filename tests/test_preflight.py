@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_preflight.py #
+#############################
+
+Tests the functions from module processing/preflight.py
+Use `python3 -m pytest test_preflight.py` to run it from terminal
+"""
+
+import os
+import sys
+import tempfile
+import shutil
+import numpy as np
+import mne
+
+processing_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'processing'))
+sys.path.append(processing_dir)
+from preflight import check_recording, blocked_subjects, flagged_recordings
+
+
+def _save_raw(fname, sfreq=100., duration=150.):
+    info = mne.create_info(['EEG001', 'EEG002', 'STI101'], sfreq, ['eeg', 'eeg', 'stim'])
+    raw = mne.io.RawArray(np.zeros((3, int(sfreq * duration))), info, verbose=False)
+    raw.save(fname, overwrite=True, verbose=False)
+
+def test_check_recording():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmp_dir, 'test_raw.fif')
+        assert check_recording(fname, 'PASAT', n_eeg=2)['status'] == 'missing'
+
+        _save_raw(fname)
+        row = check_recording(fname, 'PASAT', n_eeg=2)
+        assert row['status'] == 'ok'
+        assert row['n_eeg'] == 2 and row['duration'] == 150.
+        assert check_recording(fname, 'PASAT', n_eeg=64)['status'] == 'incomplete'
+        # The eyes open and closed recordings need more than 150 s
+        assert check_recording(fname, 'ec', n_eeg=2)['status'] == 'short'
+
+        # Cut the file in the middle of the data
+        with open(fname, 'rb') as f:
+            content = f.read()
+        with open(fname, 'wb') as f:
+            f.write(content[:len(content) // 2])
+        assert check_recording(fname, 'PASAT', n_eeg=2)['status'] == 'truncated'
+
+        with open(fname, 'wb') as f:
+            f.write(b'not a fif file')
+        assert check_recording(fname, 'PASAT', n_eeg=2)['status'] == 'unreadable'
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_blocked_and_flagged():
+    manifest = [
+        dict(subject='10C', task='ec', run='1', status='ok', message=''),
+        dict(subject='11P', task='ec', run='1', status='truncated', message=''),
+        dict(subject='11P', task='PASAT', run='2', status='short', message=''),
+        dict(subject='12P', task='PASAT', run='2', status='missing', message=''),
+    ]
+    assert blocked_subjects(manifest) == {'11P': 'ec run 1: truncated; PASAT run 2: short'}
+    assert [row['subject'] for row in flagged_recordings(manifest)] == ['12P']
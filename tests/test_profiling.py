@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_profiling.py #
+#############################
+
+Tests the functions from module profiling.py
+Use `python3 -m pytest test_profiling.py` to run it from terminal
+"""
+
+import os
+import sys
+import tempfile
+import shutil
+
+src_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(src_dir)
+from profiling import enable_profiling, profiled, read_log, summarize
+
+
+def test_profiled_writes_nested_context(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    log = os.path.join(tmp_dir, 'profile.jsonl')
+    monkeypatch.delenv('PROFILING_LOG', raising=False)
+
+    # Nothing is written while profiling is disabled
+    with profiled('total', subject='10C', stage='freqfilt'):
+        pass
+    assert not os.path.exists(log)
+
+    enable_profiling(log)
+    with profiled('total', subject='10C', stage='freqfilt'):
+        with profiled('read_raw_fif', recording='ec'):
+            pass
+        with profiled('interpolate_bads', recording='eo'):
+            pass
+
+    entries = read_log(log)
+    # The blocks are written in the order in which they finish
+    assert [entry['step'] for entry in entries] == ['read_raw_fif', 'interpolate_bads', 'total']
+    assert entries[0]['subject'] == '10C'
+    assert entries[0]['stage'] == 'freqfilt'
+    assert entries[0]['recording'] == 'ec'
+    assert entries[2]['recording'] is None
+    for entry in entries:
+        assert entry['wall_s'] >= 0
+        assert entry['cpu_s'] >= 0
+        assert entry['read_mb'] is None or entry['read_mb'] >= 0
+
+    shutil.rmtree(tmp_dir)
+
+def test_summarize_ranks_by_total_time():
+    entries = [
+        dict(subject='10C', stage='ica', step='ica_fit', wall_s=10.0, cpu_s=30.0, peak_rss_mb=900.0),
+        dict(subject='11P', stage='ica', step='ica_fit', wall_s=12.0, cpu_s=35.0, peak_rss_mb=1000.0),
+        dict(subject='10C', stage='freqfilt', step='read_raw_fif', wall_s=15.0, cpu_s=1.0, peak_rss_mb=2000.0),
+    ]
+    summary = summarize(entries)
+    assert [row['name'] for row in summary] == ['ica / ica_fit', 'freqfilt / read_raw_fif']
+    assert summary[0]['count'] == 2
+    assert summary[0]['total_wall_s'] == 22.0
+    assert summary[0]['mean_wall_s'] == 11.0
+    assert summary[0]['peak_rss_mb'] == 1000.0
+
+    summary = summarize(entries, by='subject')
+    assert [row['name'] for row in summary] == ['10C', '11P']
+    assert summary[0]['total_wall_s'] == 25.0
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_psds_io.py #
+#############################
+
+Tests the functions from module processing/psds_io.py
+Use `python3 -m pytest test_psds_io.py` to run it from terminal
+"""
+
+import importlib
+import os
+import sys
+import tempfile
+import shutil
+import h5py
+import numpy as np
+import mne
+
+processing_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'processing'))
+sys.path.append(processing_dir)
+import psds_io
+psds_step = importlib.import_module('03_psds')
+
+
+def _create_psds():
+    info = mne.create_info(['EEG001', 'EEG002', 'EEG003', 'EOG001'], 200., ['eeg', 'eeg', 'eeg', 'eog'])
+    info.set_montage(mne.channels.make_dig_montage(
+        ch_pos={'EEG001': [0.05, 0, 0.05], 'EEG002': [-0.05, 0, 0.05], 'EEG003': [0, 0.05, 0.05]},
+        coord_frame='head'))
+    segments = dict(psds_step.segment_index('ec'), **psds_step.segment_index('PASAT_run1'))
+    rng = np.random.default_rng(0)
+    psds = {name: rng.random((3, 10)) for name in segments}
+    return psds, np.linspace(0, 43, 10), info, segments
+
+def test_write_and_read_psds():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        psds_fname = os.path.join(tmp_dir, 'sub-01P_psds.h5')
+        psds, freqs, info, segments = _create_psds()
+        psds_io.write_psds(psds_fname, psds, freqs, info, segments, compression='gzip')
+        assert not os.path.exists(psds_fname + '.tmp')
+
+        assert psds_io.read_index(psds_fname) == segments
+        np.testing.assert_array_equal(psds_io.read_freqs(psds_fname), freqs)
+        read_info = psds_io.read_info(psds_fname)
+        assert read_info['ch_names'] == ['EEG001', 'EEG002', 'EEG003']
+        np.testing.assert_allclose(read_info['chs'][1]['loc'][:3], info['chs'][1]['loc'][:3])
+
+        # The PSDs are stored as chunked float32 datasets
+        with h5py.File(psds_fname, 'r') as f:
+            dataset = f['psds/ec/ec_2']
+            assert dataset.dtype == np.float32
+            assert dataset.chunks == (1, 10)
+            assert dataset.compression == 'gzip'
+
+        all_psds, read_freqs = psds_io.read_psds(psds_fname)
+        assert list(all_psds) == list(segments)
+        np.testing.assert_allclose(all_psds['PASAT_run1_2'], psds['PASAT_run1_2'], rtol=1e-6)
+
+        # Only the requested tasks, segments and channels are read
+        task_psds, _ = psds_io.read_psds(psds_fname, tasks=['PASAT_run1'])
+        assert list(task_psds) == ['PASAT_run1_1', 'PASAT_run1_2']
+        picked, _ = psds_io.read_psds(psds_fname, segments=['ec_3'], picks=['EEG003', 'EEG001'])
+        assert list(picked) == ['ec_3']
+        np.testing.assert_allclose(picked['ec_3'], psds['ec_3'][[2, 0]], rtol=1e-6)
+    finally:
+        shutil.rmtree(tmp_dir)
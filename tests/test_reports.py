@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_reports.py #
+#############################
+
+Tests the functions from module processing/reports.py
+Use `python3 -m pytest test_reports.py` to run it from terminal
+"""
+
+import os
+import sys
+import tempfile
+import shutil
+import matplotlib.pyplot as plt
+from mne import open_report
+
+processing_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'processing'))
+sys.path.append(processing_dir)
+sys.path.append(os.path.dirname(processing_dir))
+import reports
+from fnames import FileNames
+
+
+def test_collect_writes_report_once(monkeypatch):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fname = FileNames()
+        fname.add('reports_dir', tmp_dir)
+        fname.add('report', '{reports_dir}/sub-{subject}-report.h5')
+        fname.add('report_html', '{reports_dir}/sub-{subject}-report.html')
+        monkeypatch.setattr(reports, 'fname', fname)
+        monkeypatch.delenv('PROFILING_LOG', raising=False)
+        report_fname = fname.report(subject='10C')
+
+        # Without collect, each step writes the report
+        reports.get_report('10C').add_figure(plt.figure(), 'first')
+        reports.save_report('10C')
+        assert os.path.exists(report_fname)
+        assert os.path.exists(fname.report_html(subject='10C'))
+
+        # Within collect, the report is written at the end, and keeps the
+        # items that were saved before
+        with reports.collect():
+            reports.get_report('10C').add_figure(plt.figure(), 'second')
+            reports.save_report('10C')
+            assert len(open_report(report_fname)._content) == 1
+            reports.get_report('10C').add_figure(plt.figure(), 'third')
+            reports.save_report('10C')
+        titles = [content.name for content in open_report(report_fname)._content]
+        assert titles == ['first', 'second', 'third']
+
+        # Nothing is written if no items were added
+        os.remove(report_fname)
+        reports.save_report('10C')
+        assert not os.path.exists(report_fname)
+    finally:
+        plt.close('all')
+        shutil.rmtree(tmp_dir)
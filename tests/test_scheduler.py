@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+#############################
+# test_scheduler.py #
+#############################
+
+Tests the functions from module processing/scheduler.py
+Use `python3 -m pytest test_scheduler.py` to run it from terminal
+"""
+
+import os
+import sys
+
+processing_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'processing'))
+sys.path.append(processing_dir)
+from scheduler import select_admissible, get_memory_budget
+
+
+def test_select_admissible_respects_budget_and_workers():
+    estimates = {'10C': 4, '11P': 4, '12P': 8, '13C': 2}
+    pending = ['10C', '11P', '12P', '13C']
+
+    # Limited by the number of workers
+    assert select_admissible(pending, [], estimates, budget=100, n_jobs=2) == ['10C', '11P']
+
+    # Limited by the memory: the large subject waits, the small one goes first
+    assert select_admissible(pending, [], estimates, budget=10, n_jobs=4) == ['10C', '11P', '13C']
+    assert select_admissible(['12P', '13C'], ['10C'], estimates, budget=10, n_jobs=4) == ['13C']
+
+    # No free workers
+    assert select_admissible(['12P'], ['10C', '11P'], estimates, budget=100, n_jobs=2) == []
+
+def test_select_admissible_runs_oversized_subject_alone():
+    estimates = {'10C': 20, '11P': 4}
+    assert select_admissible(['10C', '11P'], [], estimates, budget=10, n_jobs=4) == ['10C']
+    assert select_admissible(['10C'], ['11P'], estimates, budget=10, n_jobs=4) == []
+
+def test_get_memory_budget():
+    assert get_memory_budget(16) == 16e9
+    assert get_memory_budget() > 0